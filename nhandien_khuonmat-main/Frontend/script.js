@@ -29,8 +29,9 @@ const sessionList = document.getElementById("sessionList");
 let recognizedStudents = new Set();
 let currentClassId = null;
 let currentTimetableId = null;
+let currentSessionId = null; // Phiên nhận diện của phòng học hiện tại trên server
 let studentMap = new Map();
-let recognitionInterval = null;
+let recognitionEvents = null;
 let isSaving = false;
 
 if (!pageUpload) console.error("Không tìm thấy pageUpload!");
@@ -57,10 +58,7 @@ function showPage(page) {
   if (sidebar) {
     sidebar.classList.remove("sidebar-collapsed");
   }
-  if (recognitionInterval) {
-    clearInterval(recognitionInterval);
-    recognitionInterval = null;
-  }
+  stopRecognitionEvents();
   if (sessionList) {
     sessionList.innerHTML = "";
   }
@@ -397,50 +395,50 @@ async function fetchStudents(classId) {
   }
 }
 
-function startRecognitionPolling() {
-  recognitionInterval = setInterval(async () => {
-    if (
-      pageAttendance &&
-      !pageAttendance.classList.contains("hidden") &&
-      videoContainer &&
-      !videoContainer.classList.contains("hidden")
-    ) {
-      try {
-        const res = await fetch(`${BASE_URL}/api/recognize`, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({}),
-        });
-        const data = await res.json();
-        const uniqueRecognized = [...new Set(data.recognized)];
-
-        if (uniqueRecognized.length > 0) {
-          console.log("Recognized MSVs:", uniqueRecognized);
-        }
-
-        if (data.recognized) {
-          data.recognized.forEach((msv) => {
-            if (studentMap.has(msv) && !recognizedStudents.has(msv)) {
-              recognizedStudents.add(msv);
-              const row = studentMap.get(msv);
-              if (row) {
-                const checkbox = row.querySelector(".status-checkbox");
-                if (checkbox && !checkbox.checked) {
-                  checkbox.checked = true;
-                }
-              }
-            }
-          });
-        }
-      } catch (error) {
-        console.error("Error during recognition:", error);
+function markRecognized(msv) {
+  if (studentMap.has(msv) && !recognizedStudents.has(msv)) {
+    recognizedStudents.add(msv);
+    const row = studentMap.get(msv);
+    if (row) {
+      const checkbox = row.querySelector(".status-checkbox");
+      if (checkbox && !checkbox.checked) {
+        checkbox.checked = true;
       }
-    } else {
-      clearInterval(recognitionInterval);
-      recognitionInterval = null;
-      sidebar && sidebar.classList.remove("sidebar-collapsed");
     }
-  }, 2000);
+  }
+}
+
+// Nhận kết quả điểm danh do server đẩy về (SSE) thay vì hỏi /api/recognize mỗi 2 giây.
+// Khi mất kết nối, EventSource tự kết nối lại kèm Last-Event-ID nên không bỏ sót sinh viên nào
+function startRecognitionEvents() {
+  stopRecognitionEvents();
+  recognitionEvents = new EventSource(
+    `${BASE_URL}/api/recognition_events?session_id=${encodeURIComponent(
+      currentSessionId
+    )}`
+  );
+  recognitionEvents.addEventListener("snapshot", (e) => {
+    const data = JSON.parse(e.data);
+    (data.recognized || []).forEach((item) => markRecognized(item.msv));
+  });
+  recognitionEvents.addEventListener("recognized", (e) => {
+    const data = JSON.parse(e.data);
+    console.log("Recognized MSV:", data.msv);
+    markRecognized(data.msv);
+  });
+  recognitionEvents.addEventListener("stopped", () => {
+    stopRecognitionEvents();
+  });
+  recognitionEvents.onerror = (error) => {
+    console.error("Error during recognition:", error);
+  };
+}
+
+function stopRecognitionEvents() {
+  if (recognitionEvents) {
+    recognitionEvents.close();
+    recognitionEvents = null;
+  }
 }
 
 if (startFaceRecognitionBtn) {
@@ -464,14 +462,21 @@ if (startFaceRecognitionBtn) {
       const res = await fetch(`${BASE_URL}/api/start_stream`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ class_id: currentClassId }),
+        body: JSON.stringify({
+          class_id: currentClassId,
+          timetable_id: currentTimetableId,
+        }),
       });
       const data = await res.json();
       if (data.status === "success") {
+        currentSessionId = data.session_id;
         if (videoContainer) videoContainer.classList.remove("hidden");
-        if (streamFrame) streamFrame.src = `${BASE_URL}/stream`;
+        if (streamFrame)
+          streamFrame.src = `${BASE_URL}/stream?session_id=${encodeURIComponent(
+            currentSessionId
+          )}`;
         if (sidebar) sidebar.classList.add("sidebar-collapsed");
-        startRecognitionPolling();
+        startRecognitionEvents();
         if (statusIcon && statusMessage && statusModal) {
           statusIcon.innerHTML = `
                         <svg class="checkmark" viewBox="0 0 52 52">
@@ -525,17 +530,14 @@ if (stopFaceRecognitionBtn) {
       const res = await fetch(`${BASE_URL}/api/stop_stream`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({}),
+        body: JSON.stringify({ session_id: currentSessionId }),
       });
       const data = await res.json();
       if (data.status === "success") {
         if (videoContainer) videoContainer.classList.add("hidden");
         if (streamFrame) streamFrame.src = "";
         if (sidebar) sidebar.classList.remove("sidebar-collapsed");
-        if (recognitionInterval) {
-          clearInterval(recognitionInterval);
-          recognitionInterval = null;
-        }
+        stopRecognitionEvents();
         if (statusIcon && statusMessage && statusModal) {
           statusIcon.innerHTML = `
                         <svg class="checkmark" viewBox="0 0 52 52">
@@ -632,6 +634,7 @@ if (uploadForm) {
 
       if (data.status === "success") {
         alert(data.message || "Đã gửi ảnh thành công!");
+        if (data.job_id) waitForEnrollment(data.job_id, resultElement);
       } else {
         showErrorModal(data.message || "Lỗi khi gửi ảnh!");
       }
@@ -651,6 +654,36 @@ if (uploadForm) {
   console.error("uploadForm not found!");
 }
 
+// Hỏi trạng thái cập nhật dữ liệu khuôn mặt đến khi server xử lý xong
+async function waitForEnrollment(jobId, resultElement) {
+  while (true) {
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+    try {
+      const res = await fetch(`${BASE_URL}/api/enroll_status/${jobId}`);
+      const data = await res.json();
+      if (data.status !== "success") throw new Error(data.message);
+      const job = data.job;
+      if (job.status === "done") {
+        if (resultElement) {
+          resultElement.innerText = `Đã cập nhật dữ liệu khuôn mặt (thêm ${job.result.added}, cập nhật ${job.result.updated}, xóa ${job.result.removed} ảnh).`;
+          resultElement.className = "mt-3 text-success";
+        }
+        return;
+      }
+      if (job.status === "error") {
+        if (resultElement) {
+          resultElement.innerText = "Lỗi khi cập nhật dữ liệu khuôn mặt: " + job.error;
+          resultElement.className = "mt-3 text-danger";
+        }
+        return;
+      }
+    } catch (error) {
+      console.error("Error fetching enrollment status:", error);
+      return;
+    }
+  }
+}
+
 function showSuccessModal(message) {
   if (statusIcon && statusMessage && statusModal) {
     statusIcon.innerHTML = `
@@ -730,10 +763,7 @@ if (saveAttendanceBtn) {
           showSuccessModal(result.message || "Đã lưu điểm danh thành công!");
 
           // Dừng nhận diện và ẩn video sau khi lưu thành công
-          if (recognitionInterval) {
-            clearInterval(recognitionInterval);
-            recognitionInterval = null;
-          }
+          stopRecognitionEvents();
           if (videoContainer) videoContainer.classList.add("hidden");
           if (streamFrame) streamFrame.src = "";
           if (sidebar) sidebar.classList.remove("sidebar-collapsed");
@@ -747,7 +777,7 @@ if (saveAttendanceBtn) {
             const stopRes = await fetch(`${BASE_URL}/api/stop_stream`, {
               method: "POST",
               headers: { "Content-Type": "application/json" },
-              body: JSON.stringify({}),
+              body: JSON.stringify({ session_id: currentSessionId }),
             });
             const stopData = await stopRes.json();
             if (stopData.status !== "success") {
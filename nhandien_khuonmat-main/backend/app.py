@@ -2,18 +2,23 @@ import sqlite3
 import os
 from datetime import datetime
 import time
-import numpy as np
 import cv2
-import pickle
 from flask import Flask, request, jsonify, Response, render_template
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import base64
-from insightface.app import FaceAnalysis
-import subprocess
-import sys
-import queue
 import threading
+from gallery import GALLERY_INDEX, GalleryHolder
+from face_tracker import FaceTracker, track_and_recognize
+from cadence import AdaptiveCadence
+from face_pipeline import embed_faces
+from model_loader import load_face_app
+from inference_service import InferenceService, InferenceOverloaded
+from embedding_store import migrate_if_needed
+from enroller import Enroller
+from frame_ring import read_frame, LatestChannel
+from stream_encoder import JPEG_QUALITY, JPEG_SUBSAMPLING, multipart_chunk
+from jpeg_codec import decode_jpeg, encode_jpeg
 
 # Flask app setup
 base_dir = os.path.abspath(os.path.dirname(__file__))
@@ -30,18 +35,34 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 # Paths
 DATABASE = os.path.join(base_dir, 'dtb.db')
 dataset_dir = os.path.abspath(os.path.join(base_dir, '..', 'dataset'))
-embeddings_path = os.path.join(base_dir, 'face_embeddings.pkl')
+embeddings_path = os.path.join(base_dir, 'face_embeddings.emb')
+legacy_embeddings_path = os.path.join(base_dir, 'face_embeddings.pkl')
 
 os.makedirs(dataset_dir, exist_ok=True)
+# Chuyển face_embeddings.pkl cũ sang file memmap .emb nếu chưa có
+migrate_if_needed(legacy_embeddings_path, embeddings_path)
 
-# Initialize FaceAnalysis
-face_app = FaceAnalysis(name="buffalo_l", providers=["CUDAExecutionProvider"])
-face_app.prepare(ctx_id=0, det_size=(640, 640), det_thresh=0.6)
+# Initialize FaceAnalysis (provider và cấu hình ONNX Runtime theo hồ sơ ORT_PROFILE)
+DET_SIZE = (640, 640)
+face_app = load_face_app(det_size=DET_SIZE, det_thresh=0.6)
+# Một bản model phục vụ mọi phiên: gom lô, chia lượt công bằng giữa các lớp học
+inference_service = InferenceService(face_app)
+recognize_session = inference_service.session('api-recognize')
+
+# Gallery dùng chung cho stream và /api/recognize, tự nạp lại khi face_embeddings.emb thay đổi
+gallery_holder = GalleryHolder(embeddings_path, index=GALLERY_INDEX).start_watching()
+
+# Cập nhật embeddings trong tiến trình, dùng lại face_app ở trên
+enroller = Enroller(face_app, on_update=gallery_holder.reload)
 
 # Global variables for streaming
 recognized_faces = {}
 recognized_faces_lock = threading.Lock()
-frame_queue = queue.Queue(maxsize=10)
+# Camera -> detector: vòng đệm khung hình, detector luôn lấy khung hình mới nhất.
+# Detector -> người xem /stream: kênh chunk multipart mới nhất (mã hóa một lần), mỗi người xem tự chờ phiên bản mới
+capture_ring = None
+stream_channel = LatestChannel()
+stream_lock = threading.Lock()
 running = False
 cap = None
 student_list = []
@@ -63,25 +84,13 @@ def get_student_list(class_id):
     conn.close()
     return [row['MSV'] for row in rows]
 
-def recognize_faces(img, embeddings, threshold=0.5):
-    faces = face_app.get(img)
-    recognized = []
-    for face in faces:
-        emb = face.normed_embedding
-        max_sim = -1
-        best_name = "Unknown"
-        for name, embs in embeddings.items():
-            for saved_emb in embs:
-                sim = np.dot(emb, saved_emb)
-                if sim > max_sim:
-                    max_sim = sim
-                    best_name = name
-        if max_sim >= threshold:
-            recognized.append(best_name)
+def recognize_faces(img, gallery, threshold=0.5):
+    faces = embed_faces(face_app, img, recognize_session.detect(img), recognize_session)
+    recognized = [name for name, _ in gallery.match_faces(faces, threshold) if name != "Unknown"]
     return list(set(recognized))
 
 def video_capture_thread():
-    global frame_count, running, cap
+    global frame_count, running, cap, capture_ring
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         print("Không thể mở webcam!")
@@ -92,28 +101,38 @@ def video_capture_thread():
 
     frame_count = 0
     while running:
-        success, frame = cap.read()
+        success, handle, capture_ring = read_frame(cap, capture_ring)
         if not success:
             print("Không thể đọc khung hình từ webcam!")
             break
+        if handle is None:
+            continue  # Detector còn giữ mọi ô, bỏ khung hình này
         frame_count += 1
-        try:
-            frame_queue.put_nowait((frame, frame_count))
-        except queue.Full:
-            pass
+        capture_ring.publish(handle, time.time())
     running = False
+    cap.release()
 
-def face_detection_thread(class_id):
+def face_detection_thread(class_id, foreign_fallback=False):
     global running, fps, frame_count, start_time_fps
-    faces = []
-    embeddings = {}
-    if os.path.exists(embeddings_path):
-        with open(embeddings_path, 'rb') as f:
-            embeddings = pickle.load(f)
+    tracker = FaceTracker()  # Track ID ổn định giữa các khung hình
+    cadence = AdaptiveCadence()  # Nhịp detector theo chuyển động và số track chưa xác nhận
+    inference_session = inference_service.session()
+    tracks = []
+    student_set = set(student_list)  # Tra cứu O(1) trong vòng lặp
+    frame_seq = 0
 
     while running:
+        ring = capture_ring  # Có thể được dựng lại khi đổi kích thước, seq vẫn tiếp nối
+        if ring is None:
+            time.sleep(0.01)
+            continue
+        # Luôn xử lý khung hình mới nhất, bỏ qua khung hình đã cũ trong lúc đang nhận diện
+        handle = ring.latest(frame_seq, 1.0)
+        if handle is None:
+            continue
+        frame_seq = handle.seq
+        frame = handle.array
         try:
-            frame, frame_idx = frame_queue.get(timeout=1.0)
             current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
             # Calculate FPS
@@ -123,83 +142,86 @@ def face_detection_thread(class_id):
                 frame_count = 0
                 start_time_fps = time.time()
 
-            # Process every 5th frame
-            if frame_idx % 5 == 0:
-                faces = face_app.get(frame)
-
-            for face in faces:
-                box = face.bbox.astype(int)
-                emb = face.normed_embedding
-                name = "Unknown"
-                max_sim = -1
-
-                for person_name, person_embs in embeddings.items():
-                    for saved_emb in person_embs:
-                        sim = np.dot(emb, saved_emb)
-                        if sim > max_sim:
-                            max_sim = sim
-                            name = person_name
-
-                if max_sim < 0.5:
-                    name = "Unknown"
-
-                if name != "Unknown" and name not in recognized_faces and name in student_list:
+            if tracker.resolved and not recognized_faces:
+                # Danh sách điểm danh vừa bị xóa: nhận diện lại từ đầu
+                tracker.resolved.clear()
+                tracker.low_power = False
+            # Detector chạy theo nhịp thích ứng, ArcFace chỉ chạy cho track mới hoặc có độ tin cậy
+            # đã suy giảm; so khớp với sinh viên của lớp chưa điểm danh, rồi cả lớp (toàn trường chỉ khi
+            # bật foreign_fallback)
+            tracks = track_and_recognize(
+                tracker, face_app, frame,
+                lambda faces: gallery_holder.current.match_faces(
+                    faces, 0.5, class_id, student_list, foreign_fallback,
+                    resolved=tracker.resolved),
+                inference_session, cadence)
+
+            for track in tracks:
+                name = track.name
+                box = track.bbox.astype(int)
+
+                if name != "Unknown" and name not in recognized_faces and name in student_set:
                     with recognized_faces_lock:
                         recognized_faces[name] = current_time
                         print(f"-> Ghi nhận: {name}")
+                    tracker.resolve(name)
+                    if student_set and student_set <= tracker.resolved:
+                        tracker.low_power = True  # Cả lớp đã có mặt: chỉ chạy detector
 
-                color = (0, 255, 0) if name == "Unknown" or name in student_list else (0, 0, 255)
+                color = (0, 255, 0) if name == "Unknown" or name in student_set else (0, 0, 255)
                 cv2.rectangle(frame, (box[0], box[1]), (box[2], box[3]), color, 2)
                 cv2.putText(frame, name, (box[0], box[1] - 10),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
 
             # Add timestamp and stats
             cv2.putText(frame, current_time, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-            cv2.putText(frame, f"So nguoi: {len(faces)}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+            cv2.putText(frame, f"So nguoi: {len(tracks)}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
             cv2.putText(frame, f"FPS: {fps:.2f}", (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
 
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            frame_queue.put_nowait(('processed', frame_bytes))  # Put processed frame back for streaming
-            frame_queue.task_done()
-        except queue.Empty:
-            continue
+            # Mã hóa một lần, mọi người xem nhận cùng một bộ đệm
+            stream_channel.publish(multipart_chunk(encode_jpeg(frame, JPEG_QUALITY, JPEG_SUBSAMPLING)))
         except Exception as e:
             print(f"Error in face_detection_thread: {e}")
             break
+        finally:
+            handle.release()
+    running = False
+    inference_session.close()
 
-def gen_frames(class_id=None):
+def start_streaming(class_id=None, foreign_fallback=False):
+    # Chỉ một cặp luồng camera/detector; người xem thứ hai trở đi (máy chiếu, laptop giáo viên)
+    # chỉ đăng ký vào stream_channel, không tốn thêm suy luận
     global running, student_list, fps, frame_count, start_time_fps
-    running = True
-    start_time_fps = time.time()
-    frame_count = 0
-    fps = 0
-    student_list = get_student_list(class_id)
-
-    # Start threads
-    video_thread = threading.Thread(target=video_capture_thread, daemon=True)
-    detection_thread = threading.Thread(target=face_detection_thread, args=(class_id,), daemon=True)
-    video_thread.start()
-    detection_thread.start()
-
+    with stream_lock:
+        if running:
+            print("Luồng xử lý đã chạy")
+            return
+        running = True
+        start_time_fps = time.time()
+        frame_count = 0
+        fps = 0
+        student_list = get_student_list(class_id)
+
+        # Start threads
+        video_thread = threading.Thread(target=video_capture_thread, daemon=True)
+        detection_thread = threading.Thread(target=face_detection_thread, args=(class_id, foreign_fallback), daemon=True)
+        video_thread.start()
+        detection_thread.start()
+
+def gen_frames(class_id=None, foreign_fallback=False):
+    start_streaming(class_id, foreign_fallback)
+    seq = stream_channel.seq  # Chỉ gửi khung hình mới, không gửi lại khung hình của phiên trước
     while running:
-        try:
-            frame_type, frame_bytes = frame_queue.get(timeout=1.0)
-            if frame_type == 'processed':
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-            frame_queue.task_done()
-        except queue.Empty:
-            continue
-    running = False
-    if cap is not None:
-        cap.release()
+        seq, chunk = stream_channel.wait(seq, 1.0)
+        if chunk is not None:
+            yield chunk
 
 @app.route('/stream')
 def stream():
     class_id = request.args.get('class_id', type=int)
+    foreign_fallback = request.args.get('foreign_fallback', default=0, type=int) == 1
     print(f"Received class_id: {class_id}")
-    return Response(gen_frames(class_id), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(gen_frames(class_id, foreign_fallback), mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/api/upload', methods=['POST'])
 def upload():
@@ -224,15 +246,21 @@ def upload():
         save_path = os.path.join(student_folder, filename)
         file.save(save_path)
 
-    face_register_path = os.path.join(base_dir, 'face_register.py')
-    try:
-        venv_python = sys.executable
-        subprocess.run([venv_python, face_register_path], check=True)
-        message = f"Ảnh đã được lưu và dữ liệu khuôn mặt đã được cập nhật cho {student_name}."
-    except subprocess.CalledProcessError as e:
-        message = f"Ảnh đã được lưu nhưng lỗi khi cập nhật dữ liệu khuôn mặt: {str(e)}."
+    job_id = enroller.submit(student_name)
+    message = f"Ảnh đã được lưu, đang cập nhật dữ liệu khuôn mặt cho {student_name}."
+
+    return jsonify({'status': 'success', 'message': message, 'job_id': job_id}), 200
+
+@app.route('/api/enroll_status/<job_id>', methods=['GET'])
+def enroll_status(job_id):
+    job = enroller.status(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Không tìm thấy công việc cập nhật'}), 404
+    return jsonify({'status': 'success', 'job': job}), 200
 
-    return jsonify({'status': 'success', 'message': message}), 200
+@app.route('/api/inference_stats', methods=['GET'])
+def inference_stats():
+    return jsonify({'status': 'success', 'stats': inference_service.stats()}), 200
 
 @app.route('/api/recognize', methods=['OPTIONS'])
 def recognize_options():
@@ -256,18 +284,16 @@ def recognize():
         img_data = img_data.split(',', 1)[1]
     try:
         img_bytes = base64.b64decode(img_data)
-        np_arr = np.frombuffer(img_bytes, np.uint8)
-        if np_arr.size == 0:
+        if len(img_bytes) == 0:
             return jsonify({'status': 'error', 'message': 'Không thể giải mã ảnh, dữ liệu rỗng'}), 400
-        img = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+        # Ảnh lớn được thu nhỏ ngay khi giải mã (miền DCT), vẫn không nhỏ hơn kích thước detector
+        img = decode_jpeg(img_bytes, max(DET_SIZE))
         if img is None:
             return jsonify({'status': 'error', 'message': 'Không đọc được ảnh'}), 400
-        embeddings = {}
-        if os.path.exists(embeddings_path):
-            with open(embeddings_path, 'rb') as f:
-                embeddings = pickle.load(f)
-        names = recognize_faces(img, embeddings)
+        names = recognize_faces(img, gallery_holder.current)
         return jsonify({'recognized': names}), 200
+    except InferenceOverloaded as e:
+        return jsonify({'status': 'error', 'message': f'Máy chủ đang quá tải: {str(e)}'}), 503
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Lỗi khi xử lý ảnh: {str(e)}'}), 500
 
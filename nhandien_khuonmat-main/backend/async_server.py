@@ -0,0 +1,537 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from aiohttp import web
+from werkzeug.utils import secure_filename
+from stream_encoder import chunk_jpeg
+from recognition_events import KEEPALIVE, format_sse, parse_last_seq
+
+# Server asyncio (aiohttp) thay cho Flask threaded: mỗi người xem /stream hoặc /ws/stream là một
+# coroutine chờ khung hình mới, không chiếm một luồng. Việc chặn chạy trong các executor có giới hạn:
+#  - capture + theo dõi khuôn mặt: luồng của từng CameraSession (tối đa max_sessions)
+#  - phát hiện / ArcFace: luồng worker của InferenceService, hoặc các tiến trình của InferencePool
+#  - mã hóa JPEG: ENCODE_WORKERS luồng, mỗi khung hình mỗi bản stream mã hóa một lần
+#  - SQLite: DB_WORKERS luồng; mở/dừng camera, lưu ảnh upload: CONTROL_WORKERS luồng
+# Chạy: python async_server.py (INFERENCE_WORKERS=N để suy luận trong N tiến trình)
+DATABASE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'dtb.db')
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+dataset_dir = os.path.abspath(os.path.join(BASE_DIR, '..', 'dataset'))
+
+ENCODE_WORKERS = 2
+DB_WORKERS = 4
+CONTROL_WORKERS = 4
+VIEWER_TIMEOUT = 1.0  # Giây chờ khung hình mới trước khi kiểm tra lại phiên còn chạy không
+
+os.makedirs(dataset_dir, exist_ok=True)
+
+
+class RenditionFeed:
+    # Một bản stream của một phiên phía asyncio: khi có khung hình mới (báo từ luồng capture),
+    # mã hóa một lần trong executor qua session.encoder rồi đánh thức mọi người xem
+    def __init__(self, hub, session, rendition):
+        self.hub = hub
+        self.session = session
+        self.rendition = rendition
+        self.viewers = 0
+        self.seq = 0
+        self.chunk = None
+        self.changed = asyncio.Condition()
+        self._task = None
+        self._pending = False
+
+    def kick(self):
+        if time.monotonic() < self.rendition.next_due:
+            return  # Bản giảm fps chưa tới lượt
+        if self._task is not None:
+            self._pending = True  # Đang mã hóa: mã hóa tiếp khung hình mới nhất khi xong
+            return
+        self._task = asyncio.ensure_future(self._encode())
+
+    async def _encode(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                self._pending = False
+                seq, chunk = await loop.run_in_executor(
+                    self.hub.encode_executor, self.session.encoder.next_chunk, self.rendition, self.seq, 0)
+                if chunk is not None and seq > self.seq:
+                    async with self.changed:
+                        self.seq, self.chunk = seq, chunk
+                        self.changed.notify_all()
+                if not self._pending:
+                    break
+        except Exception as e:
+            print(f"[{self.session.session_id}] Error in stream encoder: {e}")
+        finally:
+            self._task = None
+
+    async def next(self, after_seq, timeout=VIEWER_TIMEOUT):
+        # (seq, chunk) mới hơn after_seq, hoặc (after_seq, None) khi hết thời gian chờ
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(lambda: self.seq > after_seq), timeout)
+            except asyncio.TimeoutError:
+                return after_seq, None
+            return self.seq, self.chunk
+
+
+class StreamHub:
+    # Các RenditionFeed đang có người xem. Listener chỉ gắn vào phiên khi có người xem,
+    # mỗi khung hình chuyển sang event loop đúng một lần dù có bao nhiêu người xem
+    def __init__(self, loop, encode_executor):
+        self.loop = loop
+        self.encode_executor = encode_executor
+        self._feeds = {}  # session_id -> {tên bản stream: RenditionFeed}
+
+    def _on_frame(self, session, seq):
+        # Gọi từ luồng capture
+        self.loop.call_soon_threadsafe(self._dispatch, session.session_id)
+
+    def _dispatch(self, session_id):
+        for feed in self._feeds.get(session_id, {}).values():
+            feed.kick()
+
+    def acquire(self, session, name):
+        feeds = self._feeds.get(session.session_id)
+        if feeds is None:
+            feeds = self._feeds[session.session_id] = {}
+            session.frame_listeners.append(self._on_frame)
+        feed = feeds.get(name)
+        if feed is None:
+            feed = feeds[name] = RenditionFeed(self, session, session.encoder.get(name))
+        feed.viewers += 1
+        feed.rendition.viewers += 1
+        return feed
+
+    def release(self, feed):
+        feed.viewers -= 1
+        feed.rendition.viewers -= 1
+        if feed.viewers > 0:
+            return
+        feeds = self._feeds.get(feed.session.session_id, {})
+        feeds.pop(feed.rendition.name, None)
+        if not feeds:
+            self._feeds.pop(feed.session.session_id, None)
+            if self._on_frame in feed.session.frame_listeners:
+                feed.session.frame_listeners.remove(self._on_frame)
+
+    def stats(self):
+        return {session_id: {name: feed.viewers for name, feed in feeds.items()}
+                for session_id, feeds in self._feeds.items()}
+
+
+def error(message, status):
+    return web.json_response({'status': 'error', 'message': message}, status=status)
+
+
+def resolve_session(request, session_id):
+    # Không truyền session_id thì dùng phiên duy nhất đang có (client một phòng học).
+    # Gọi thẳng trên event loop được: SessionManager chỉ giữ _lock khi tra / sửa dict phiên,
+    # việc mở camera (có thể mất hàng chục giây với RTSP) nằm ngoài khóa
+    session = request.app['session_manager'].get(session_id)
+    if session is None:
+        return None, error('Không tìm thấy phiên nhận diện', 404)
+    return session, None
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except Exception:
+        return {}
+
+
+async def run_db(request, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(request.app['db_executor'], fn, *args)
+
+
+async def run_control(request, fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(request.app['control_executor'], fn, *args)
+
+
+def get_db_connection():
+    conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+# Truy vấn SQLite (chạy trong db_executor)
+def query_schedule():
+    conn = get_db_connection()
+    try:
+        rows = conn.execute("""
+            SELECT
+                sub.Name_Subject AS subject_name,
+                cls.NameClass AS class_name,
+                tt.Day_of_week AS day_of_week,
+                tt.Start_Time AS start_time,
+                tt.End_Time AS end_time,
+                tt.ID_Class AS class_id,
+                tt.ID AS timetable_id
+            FROM Time_Table tt
+            LEFT JOIN Subject sub ON tt.ID_Subject = sub.ID
+            LEFT JOIN Classes cls ON tt.ID_Class = cls.ID
+        """).fetchall()
+    finally:
+        conn.close()
+
+    day_mapping = {
+        "thu 2": "Thứ 2",
+        "thu 3": "Thứ 3",
+        "thu 4": "Thứ 4",
+        "thu 5": "Thứ 5",
+        "thu 6": "Thứ 6",
+        "thu 7": "Thứ 7",
+        "chu nhat": "Chủ nhật"
+    }
+    schedule_list = []
+    for row in rows:
+        day_of_week = row['day_of_week'] if row['day_of_week'] else 'Chưa xác định'
+        day_of_week = day_mapping.get(day_of_week.lower(), day_of_week)
+        schedule_list.append({
+            "subject": row["subject_name"] or "Chưa có môn học",
+            "class": row["class_name"] or "Chưa có lớp",
+            "time": f"{day_of_week} {row['start_time']}-{row['end_time']}",
+            "class_id": row["class_id"],
+            "timetable_id": row["timetable_id"]
+        })
+    return schedule_list
+
+
+def query_students(class_id):
+    conn = get_db_connection()
+    try:
+        rows = conn.execute("SELECT MSV, FullName FROM Student WHERE ID_Class = ?", (class_id,)).fetchall()
+    finally:
+        conn.close()
+    return [{"MSV": row["MSV"], "FullName": row["FullName"]} for row in rows]
+
+
+def insert_attendance(timetable_id, attendance_data):
+    attendance_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_db_connection()
+    try:
+        for record in attendance_data:
+            conn.execute("""
+                INSERT INTO Attendance (ID_TimeTable, MSV, Status, Attendance_Date)
+                VALUES (?, ?, ?, ?)
+            """, (timetable_id, record['MSV'], record['Status'], attendance_date))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def save_uploads(student_folder, files):
+    os.makedirs(student_folder, exist_ok=True)
+    for filename, source in files:
+        with open(os.path.join(student_folder, filename), 'wb') as f:
+            shutil.copyfileobj(source, f)
+
+
+# API phiên nhận diện (giống web_stream.py)
+async def start_stream(request):
+    data = await read_json(request)
+    class_id = data.get('class_id')
+    if class_id is None:
+        return error('Chưa cung cấp class_id', 400)
+    try:
+        # Mở camera và truy vấn danh sách sinh viên đều chặn: chạy trong control_executor
+        # camera: mã camera trong cameras.json của server ('source' cũ cũng được hiểu là mã camera)
+        session = await run_control(request, request.app['session_manager'].start, class_id,
+                                    data.get('timetable_id'), data.get('camera', data.get('source')),
+                                    bool(data.get('foreign_fallback', False)), data.get('session_id'))
+        return web.json_response({'status': 'success', 'message': 'Bắt đầu luồng video',
+                                  'session_id': session.session_id})
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return error(f'Lỗi khi bắt đầu luồng: {str(e)}', 500)
+
+
+async def stop_stream(request):
+    data = await read_json(request)
+    session, err = resolve_session(request, data.get('session_id'))
+    if err:
+        return err
+    try:
+        await run_control(request, request.app['session_manager'].stop, session.session_id)
+        return web.json_response({'status': 'success', 'message': 'Đã dừng luồng video'})
+    except Exception as e:
+        return error(f'Lỗi khi dừng luồng: {str(e)}', 500)
+
+
+async def stream_status(request):
+    session_id = request.query.get('session_id')
+    if session_id is not None:
+        session, err = resolve_session(request, session_id)
+        if err:
+            return err
+        return web.json_response({'status': 'success', 'is_streaming': session.active, 'session': session.stats()})
+    # Số liệu của mọi phiên: tính trong control_executor, không chiếm event loop
+    manager = request.app['session_manager']
+    sessions = await run_control(request, manager.list_sessions)
+    return web.json_response({'status': 'success', 'is_streaming': any(s['active'] for s in sessions),
+                              'sessions': sessions, 'viewers': request.app['hub'].stats()})
+
+
+async def recognize(request):
+    data = await read_json(request)
+    session, err = resolve_session(request, data.get('session_id'))
+    if err:
+        return err
+    return web.json_response({'status': 'success', 'session_id': session.session_id,
+                              'recognized': session.recognized_names()})
+
+
+async def clear_recognized(request):
+    data = await read_json(request)
+    session, err = resolve_session(request, data.get('session_id'))
+    if err:
+        return err
+    session.clear_recognized()
+    return web.json_response({'status': 'success', 'message': 'Đã xóa danh sách khuôn mặt nhận diện'})
+
+
+async def inference_stats(request):
+    return web.json_response({'status': 'success', 'stats': request.app['inference_service'].stats()})
+
+
+# Người xem: MJPEG qua HTTP và JPEG nhị phân qua WebSocket, cùng dùng RenditionFeed
+def open_feed(request):
+    session, err = resolve_session(request, request.query.get('session_id'))
+    if err:
+        return None, None, err
+    rendition = request.query.get('rendition', 'full')
+    if session.encoder.get(rendition) is None:
+        return None, None, error(f'Không có bản stream {rendition}', 400)
+    return session, request.app['hub'].acquire(session, rendition), None
+
+
+async def stream(request):
+    session, feed, err = open_feed(request)
+    if err:
+        return err
+    response = web.StreamResponse(headers={'Content-Type': 'multipart/x-mixed-replace; boundary=frame',
+                                           'Cache-Control': 'no-cache'})
+    try:
+        await response.prepare(request)
+        seq = 0  # Khung hình cuối cùng người xem này đã nhận
+        while session.active:
+            seq, chunk = await feed.next(seq)
+            if chunk is not None:
+                await response.write(chunk)  # Người xem chậm chỉ chờ ở đây, lần sau nhận khung hình mới nhất
+    except ConnectionResetError:
+        pass
+    finally:
+        request.app['hub'].release(feed)
+    return response
+
+
+async def stream_ws(request):
+    session, feed, err = open_feed(request)
+    if err:
+        return err
+    ws = web.WebSocketResponse(heartbeat=30)
+    try:
+        await ws.prepare(request)
+        seq = 0
+        while session.active and not ws.closed:
+            seq, chunk = await feed.next(seq)
+            if chunk is not None:
+                await ws.send_bytes(chunk_jpeg(chunk))
+    except ConnectionResetError:
+        pass
+    finally:
+        request.app['hub'].release(feed)
+    await ws.close()
+    return ws
+
+
+# Sự kiện điểm danh: SSE (/api/recognition_events) và WebSocket (/ws/recognition_events).
+# Mỗi kết nối chỉ được đánh thức khi có sự kiện mới, không hỏi định kỳ
+async def watch_events(session, last_seq):
+    # Sinh sự kiện sau last_seq (snapshot nếu client mới hoặc bị hụt); None = đã tới lúc gửi keepalive
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    listener = lambda event: loop.call_soon_threadsafe(changed.set)
+    session.events.listeners.append(listener)
+    try:
+        if last_seq == 0 or session.events.since(last_seq) is None:
+            event = session.snapshot_event()
+            last_seq = event['seq']
+            yield event
+        while True:
+            changed.clear()
+            pending = session.events.since(last_seq)
+            if pending is None:
+                event = session.snapshot_event()
+                last_seq = event['seq']
+                yield event
+                continue
+            if not pending:
+                if not session.active:
+                    return
+                try:
+                    await asyncio.wait_for(changed.wait(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield None
+                continue
+            for event in pending:
+                last_seq = event['seq']
+                yield event
+                if event['type'] == 'stopped':
+                    return
+    finally:
+        session.events.listeners.remove(listener)
+
+
+async def recognition_events(request):
+    session, err = resolve_session(request, request.query.get('session_id'))
+    if err:
+        return err
+    last_seq = parse_last_seq(request.headers.get('Last-Event-ID', request.query.get('since')))
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    try:
+        await response.prepare(request)
+        async for event in watch_events(session, last_seq):
+            await response.write(format_sse(event).encode() if event is not None else b': keepalive\n\n')
+    except ConnectionResetError:
+        pass
+    return response
+
+
+async def recognition_events_ws(request):
+    session, err = resolve_session(request, request.query.get('session_id'))
+    if err:
+        return err
+    ws = web.WebSocketResponse(heartbeat=30)
+    try:
+        await ws.prepare(request)
+        async for event in watch_events(session, parse_last_seq(request.query.get('since'))):
+            if ws.closed:
+                break
+            if event is not None:
+                await ws.send_json(event)
+    except ConnectionResetError:
+        pass
+    await ws.close()
+    return ws
+
+
+# API dữ liệu: SQLite chạy trong db_executor, không chặn event loop
+async def get_schedule(request):
+    return web.json_response(await run_db(request, query_schedule))
+
+
+async def get_students(request):
+    return web.json_response(await run_db(request, query_students, int(request.match_info['class_id'])))
+
+
+async def save_attendance(request):
+    data = await read_json(request)
+    if not data or 'timetable_id' not in data or 'data' not in data:
+        return error('Dữ liệu không hợp lệ', 400)
+    if any(record.get('Status') not in ['Present', 'Absent'] for record in data['data']):
+        return error('Giá trị Status không hợp lệ', 400)
+    try:
+        await run_db(request, insert_attendance, data['timetable_id'], data['data'])
+        return web.json_response({'status': 'success', 'message': 'Đã lưu điểm danh thành công'})
+    except sqlite3.Error as e:
+        return error(f'Lỗi khi lưu điểm danh: {str(e)}', 500)
+
+
+async def upload(request):
+    form = await request.post()
+    student_name = form.get('student_name')
+    if not student_name:
+        return error('Chưa cung cấp tên học sinh', 400)
+    files = form.getall('images[]', [])
+    if not files:
+        return error('Chưa tải ảnh lên', 400)
+    saved = []
+    for file in files:
+        if not getattr(file, 'filename', ''):
+            return error('Tên file không hợp lệ', 400)
+        saved.append((secure_filename(file.filename), file.file))
+    enroller = request.app.get('enroller')
+    if enroller is None:
+        return error('Enroller chưa được khởi tạo', 500)
+    await run_control(request, save_uploads, os.path.join(dataset_dir, student_name), saved)
+    job_id = enroller.submit(student_name)
+    return web.json_response({'status': 'success', 'job_id': job_id,
+                              'message': f"Ảnh đã được lưu, đang cập nhật dữ liệu khuôn mặt cho {student_name}."})
+
+
+async def enroll_status(request):
+    enroller = request.app.get('enroller')
+    if enroller is None:
+        return error('Enroller chưa được khởi tạo', 500)
+    job = enroller.status(request.match_info['job_id'])
+    if job is None:
+        return error('Không tìm thấy công việc cập nhật', 404)
+    return web.json_response({'status': 'success', 'job': job})
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    # Giống flask_cors với origins="*"; preflight OPTIONS trả lời luôn, không cần route riêng
+    if request.method == 'OPTIONS':
+        response = web.Response(status=204)
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    return response
+
+
+async def on_startup(app):
+    app['hub'] = StreamHub(asyncio.get_running_loop(), app['encode_executor'])
+
+
+async def on_cleanup(app):
+    await asyncio.get_running_loop().run_in_executor(None, app['session_manager'].stop_all)
+    close = getattr(app['inference_service'], 'close', None)  # InferencePool: dừng các tiến trình worker
+    if close is not None:
+        close()
+    for name in ('encode_executor', 'db_executor', 'control_executor'):
+        app[name].shutdown(wait=False)
+
+
+def create_app(session_manager, inference_service, enroller=None):
+    app = web.Application(middlewares=[cors_middleware], client_max_size=64 * 1024 * 1024)
+    app['session_manager'] = session_manager
+    app['inference_service'] = inference_service
+    app['enroller'] = enroller
+    app['encode_executor'] = ThreadPoolExecutor(ENCODE_WORKERS, thread_name_prefix='encode')
+    app['db_executor'] = ThreadPoolExecutor(DB_WORKERS, thread_name_prefix='db')
+    app['control_executor'] = ThreadPoolExecutor(CONTROL_WORKERS, thread_name_prefix='control')
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post('/api/start_stream', start_stream)
+    app.router.add_post('/api/stop_stream', stop_stream)
+    app.router.add_get('/api/stream_status', stream_status)
+    app.router.add_post('/api/recognize', recognize)
+    app.router.add_post('/api/clear_recognized', clear_recognized)
+    app.router.add_get('/api/inference_stats', inference_stats)
+    app.router.add_get('/stream', stream)
+    app.router.add_get('/ws/stream', stream_ws)
+    app.router.add_get('/api/recognition_events', recognition_events)
+    app.router.add_get('/ws/recognition_events', recognition_events_ws)
+    app.router.add_get('/api/schedule', get_schedule)
+    app.router.add_get('/api/class/{class_id:\\d+}/students', get_students)
+    app.router.add_post('/api/save_attendance', save_attendance)
+    app.router.add_post('/api/upload', upload)
+    app.router.add_get('/api/enroll_status/{job_id}', enroll_status)
+    return app
+
+
+if __name__ == '__main__':
+    from opencv_with_queue import session_manager, inference_service, face_app, gallery_holder
+    from enroller import Enroller
+    app = create_app(session_manager, inference_service, Enroller(face_app, on_update=gallery_holder.reload))
+    web.run_app(app, host='0.0.0.0', port=5000)
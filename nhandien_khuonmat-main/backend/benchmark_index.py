@@ -0,0 +1,77 @@
+import argparse
+import time
+import numpy as np
+from face_index import EMBEDDING_DIM, FlatIndex, hnswlib, make_index
+
+# So sánh recall@1 và độ trễ của các index ANN với tìm kiếm chính xác (FlatIndex)
+# trên gallery giả lập: mỗi danh tính có một tâm ngẫu nhiên, mỗi ảnh là tâm cộng nhiễu.
+# Ví dụ: python benchmark_index.py --identities 20000 --images 5
+
+
+def normalize(x):
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def make_gallery(rng, identities, images, noise):
+    centers = normalize(rng.standard_normal((identities, EMBEDDING_DIM)))
+    labels = np.repeat(np.arange(identities), images)
+    vectors = normalize(centers[labels] + noise * rng.standard_normal((labels.shape[0], EMBEDDING_DIM)))
+    return centers, labels, vectors
+
+
+def time_search(index, queries, batch):
+    start = time.perf_counter()
+    results = [index.search(queries[i:i + batch], 1)[1][:, 0] for i in range(0, queries.shape[0], batch)]
+    elapsed = time.perf_counter() - start
+    return np.concatenate(results), elapsed / queries.shape[0] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recall@1 / độ trễ của index embedding")
+    parser.add_argument("--identities", type=int, default=20000)
+    parser.add_argument("--images", type=int, default=5, help="số ảnh mỗi danh tính")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=8, help="số khuôn mặt mỗi lần tìm (một khung hình)")
+    parser.add_argument("--noise", type=float, default=0.06)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers, labels, vectors = make_gallery(rng, args.identities, args.images, args.noise)
+    ids = np.arange(vectors.shape[0], dtype=np.int64)
+    query_labels = rng.integers(0, args.identities, args.queries)
+    queries = normalize(centers[query_labels] + args.noise * rng.standard_normal((args.queries, EMBEDDING_DIM)))
+    print(f"Gallery: {vectors.shape[0]} embeddings, {args.identities} danh tính, {args.queries} truy vấn")
+
+    flat = FlatIndex()
+    flat.add(ids, vectors)
+    exact, flat_ms = time_search(flat, queries, args.batch)
+    print(f"{'index':<24}{'build (s)':>10}{'recall@1':>10}{'ms/face':>10}")
+    print(f"{'flat':<24}{0.0:>10.2f}{1.0:>10.3f}{flat_ms:>10.3f}")
+
+    configs = [("ivf", {"nprobe": nprobe}) for nprobe in (1, 4, 8, 16, 32)]
+    if hnswlib is not None:
+        configs += [("hnsw", {"ef": ef}) for ef in (16, 32, 64, 128)]
+    else:
+        print("(bỏ qua hnsw: chưa cài hnswlib)")
+
+    built = {}
+    for kind, params in configs:
+        if kind not in built:
+            start = time.perf_counter()
+            index = make_index(kind)
+            index.add(ids, vectors)
+            built[kind] = (index, time.perf_counter() - start)
+        index, build_time = built[kind]
+        if kind == "ivf":
+            index.nprobe = params["nprobe"]
+        else:
+            index.index.set_ef(params["ef"])
+        found, ms = time_search(index, queries, args.batch)
+        recall = np.mean(labels[found] == labels[exact])
+        name = f"{kind} " + " ".join(f"{k}={v}" for k, v in params.items())
+        print(f"{name:<24}{build_time:>10.2f}{recall:>10.3f}{ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+from jpeg_codec import DEFAULT_QUALITY, available_codecs, choose_scale, jpeg_size
+
+# So sánh tốc độ giải mã / mã hóa JPEG của các codec (OpenCV, libjpeg-turbo nếu đã cài PyTurboJPEG)
+# trên ảnh trong dataset/: giải mã đầy đủ, giải mã thu nhỏ về kích thước detector, mã hóa theo
+# từng kiểu lấy mẫu màu.
+# Ví dụ: python benchmark_jpeg.py --max-side 640 --repeat 5
+
+
+def load_images(dataset_dir, limit):
+    paths = sorted(glob.glob(os.path.join(dataset_dir, '**', '*.jp*g'), recursive=True))[:limit]
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if jpeg_size(data) is not None:
+            images.append(data)
+    return images
+
+
+def time_ms(fn, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            fn(item)
+    return (time.perf_counter() - start) / (repeat * len(items)) * 1000
+
+
+def main():
+    base_dir = os.path.abspath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark giải mã / mã hóa JPEG")
+    parser.add_argument("--dataset", default=os.path.join(base_dir, '..', 'dataset'))
+    parser.add_argument("--limit", type=int, default=200, help="số ảnh tối đa")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-side", type=int, default=640, help="kích thước detector khi giải mã thu nhỏ")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY)
+    args = parser.parse_args()
+
+    images = load_images(args.dataset, args.limit)
+    if not images:
+        print(f"Không tìm thấy ảnh JPEG trong {args.dataset}")
+        return
+    sizes = [jpeg_size(data) for data in images]
+    scales = [choose_scale(size, args.max_side) for size in sizes]
+    print(f"{len(images)} ảnh, trung bình {np.mean([w for w, _ in sizes]):.0f}x{np.mean([h for _, h in sizes]):.0f}, "
+          f"{np.mean([len(d) for d in images]) / 1024:.1f} KB; thu nhỏ 1/{max(scales)} tối đa khi --max-side {args.max_side}")
+
+    print(f"{'codec':<12}{'decode':>10}{'decode@' + str(args.max_side):>14}"
+          f"{'enc 444':>10}{'enc 422':>10}{'enc 420':>10}{'KB 420':>8}   (ms/ảnh)")
+    for name, codec_class in available_codecs().items():
+        try:
+            codec = codec_class()
+        except (OSError, RuntimeError) as e:
+            print(f"{name:<12}bỏ qua: {e}")
+            continue
+        decode_ms = time_ms(codec.decode, images, args.repeat)
+        scaled = list(zip(images, scales))
+        scaled_ms = time_ms(lambda item: codec.decode(item[0], item[1]), scaled, args.repeat)
+        frames = [codec.decode(data) for data in images]
+        row = f"{name:<12}{decode_ms:>10.2f}{scaled_ms:>14.2f}"
+        for subsampling in ('444', '422', '420'):
+            row += f"{time_ms(lambda f: codec.encode(f, args.quality, subsampling), frames, args.repeat):>10.2f}"
+        kb = np.mean([len(codec.encode(f, args.quality, '420')) for f in frames]) / 1024
+        print(row + f"{kb:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import time
+import numpy as np
+from face_index import EMBEDDING_DIM, FlatIndex, make_index
+from benchmark_index import make_gallery, normalize
+
+# Đo sai lệch độ chính xác, bộ nhớ và độ trễ của gallery lượng tử hóa (float16 / int8,
+# có và không chấm lại bằng float32) so với tìm kiếm float32 chính xác.
+# Một nửa truy vấn là người đã đăng ký, nửa còn lại là người lạ để kiểm tra ngưỡng.
+# Ví dụ: python benchmark_quantization.py --identities 20000 --images 5
+
+
+def hot_bytes(index):
+    # Phần dữ liệu phải quét ở mỗi lần tìm kiếm
+    if hasattr(index, "codes"):
+        return index.codes.nbytes + index.scales.nbytes
+    return index.vectors.nbytes
+
+
+def run(index, queries, batch):
+    scores, ids = [], []
+    start = time.perf_counter()
+    for i in range(0, queries.shape[0], batch):
+        s, found = index.search(queries[i:i + batch], 1)
+        scores.append(s[:, 0])
+        ids.append(found[:, 0])
+    elapsed = time.perf_counter() - start
+    return np.concatenate(scores), np.concatenate(ids), elapsed / queries.shape[0] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gallery lượng tử hóa so với float32")
+    parser.add_argument("--identities", type=int, default=20000)
+    parser.add_argument("--images", type=int, default=5, help="số ảnh mỗi danh tính")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=8, help="số khuôn mặt mỗi lần tìm (một khung hình)")
+    parser.add_argument("--noise", type=float, default=0.04)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--rerank", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers, labels, vectors = make_gallery(rng, args.identities, args.images, args.noise)
+    ids = np.arange(vectors.shape[0], dtype=np.int64)
+    known = args.queries // 2
+    query_centers = np.vstack([centers[rng.integers(0, args.identities, known)],
+                               normalize(rng.standard_normal((args.queries - known, EMBEDDING_DIM)))])
+    queries = normalize(query_centers + args.noise * rng.standard_normal(query_centers.shape))
+    print(f"Gallery: {vectors.shape[0]} embeddings, {args.identities} danh tính, "
+          f"{args.queries} truy vấn ({known} người đã đăng ký), ngưỡng {args.threshold}")
+
+    flat = FlatIndex()
+    flat.add(ids, vectors)
+    exact_scores, exact_ids, flat_ms = run(flat, queries, args.batch)
+    exact_accept = exact_scores >= args.threshold
+
+    print(f"{'index':<22}{'MB quét':>9}{'ms/face':>9}{'top-1 khớp':>12}{'|Δđiểm| TB':>12}"
+          f"{'|Δđiểm| max':>13}{'đổi quyết định':>16}")
+    print(f"{'flat float32':<22}{hot_bytes(flat) / 2**20:>9.1f}{flat_ms:>9.3f}{1.0:>12.4f}"
+          f"{0.0:>12.5f}{0.0:>13.5f}{0:>16d}")
+
+    for kind in ("flat_fp16", "flat_int8"):
+        for rerank in (0, args.rerank):
+            index = make_index(kind, rerank=rerank)
+            index.add(ids, vectors)
+            scores, found, ms = run(index, queries, args.batch)
+            agree = np.mean(labels[found] == labels[exact_ids])
+            drift = np.abs(scores - exact_scores)
+            flips = int(np.sum((scores >= args.threshold) != exact_accept))
+            name = f"{kind} rerank={rerank}"
+            print(f"{name:<22}{hot_bytes(index) / 2**20:>9.1f}{ms:>9.3f}{agree:>12.4f}"
+                  f"{drift.mean():>12.5f}{drift.max():>13.5f}{flips:>16d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import math
+import time
+import cv2
+import numpy as np
+
+
+class AdaptiveCadence:
+    # Chọn khung hình nào chạy detector thay cho quy tắc cố định "mỗi 5 khung hình":
+    #  - chuyển động (sai khác trung bình giữa ảnh thu nhỏ xám hiện tại và ảnh của lần chạy detector gần
+    #    nhất, nên chuyển động chậm vẫn được cộng dồn qua các khung hình bỏ qua) hoặc còn track chưa xác nhận
+    #    -> chạy dày nhất có thể trong ngân sách
+    #  - phòng tĩnh, mọi track đã xác nhận -> giãn dần khoảng cách tới max_interval (gần như không tốn gì)
+    #  - budget: tỉ lệ thời gian thực mà một phiên được dùng cho suy luận (1.0 = toàn bộ),
+    #    khoảng cách tối thiểu = thời gian suy luận / (budget * chu kỳ khung hình)
+    def __init__(self, min_interval=1, max_interval=30, motion_threshold=3.0, budget=1.0,
+                 thumb_size=(64, 48), smoothing=0.2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.motion_threshold = motion_threshold
+        self.budget = budget
+        self.thumb_size = thumb_size
+        self.smoothing = smoothing
+        self.interval = min_interval
+        self.idle_interval = min_interval
+        self.motion = 0.0
+        self.unresolved = 0
+        self.rate = 0.0  # Số lần chạy detector mỗi giây (trung bình trượt), dùng làm số liệu
+        self._thumb = None  # Ảnh thu nhỏ của khung hình chạy detector gần nhất (mốc so sánh)
+        self._current_thumb = None
+        self._since_detect = 0
+        self._cost = 0.0
+        self._frame_period = 0.0
+        self._last_frame = None
+        self._last_detect = None
+
+    def _ema(self, current, value):
+        return value if current == 0.0 else current + self.smoothing * (value - current)
+
+    def measure_motion(self, frame):
+        thumb = cv2.cvtColor(cv2.resize(frame, self.thumb_size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        if self._thumb is None:
+            motion = float('inf')  # Khung hình đầu tiên luôn chạy detector
+        else:
+            motion = float(np.abs(thumb.astype(np.int16) - self._thumb).mean())
+        self._current_thumb = thumb  # Chỉ thành mốc mới khi khung hình này chạy detector
+        return motion
+
+    def budget_interval(self):
+        if self._cost == 0.0 or self._frame_period == 0.0:
+            return self.min_interval
+        return max(self.min_interval, math.ceil(self._cost / (self.budget * self._frame_period)))
+
+    def should_detect(self, frame, tracker):
+        now = time.monotonic()
+        if self._last_frame is not None:
+            self._frame_period = self._ema(self._frame_period, now - self._last_frame)
+        self._last_frame = now
+        self._since_detect += 1
+
+        self.motion = self.measure_motion(frame)
+        # Chế độ tiết kiệm (cả lớp đã có mặt): track chưa xác nhận không còn đòi chạy dày
+        self.unresolved = 0 if tracker.low_power else sum(1 for t in tracker.tracks if not t.confirmed)
+        if self.motion >= self.motion_threshold or self.unresolved:
+            self.idle_interval = self.min_interval
+        busy_interval = self.budget_interval()
+        self.interval = min(self.max_interval, max(busy_interval, self.idle_interval))
+        if self._since_detect < self.interval:
+            return False
+
+        self._since_detect = 0
+        self._thumb = self._current_thumb
+        if self._last_detect is not None:
+            self.rate = self._ema(self.rate, 1.0 / max(now - self._last_detect, 1e-6))
+        self._last_detect = now
+        if self.motion < self.motion_threshold and not self.unresolved:
+            # Phòng tĩnh: mỗi lần chạy mà không có gì mới thì giãn gấp đôi
+            self.idle_interval = min(self.max_interval, self.idle_interval * 2)
+        return True
+
+    def record(self, seconds):
+        # Thời gian phát hiện + nhận diện của khung hình vừa chạy detector
+        self._cost = self._ema(self._cost, seconds)
+
+    def stats(self):
+        return {
+            'detect_interval': self.interval,
+            'detect_rate': round(self.rate, 2),
+            'motion': round(self.motion, 2) if math.isfinite(self.motion) else None,
+            'unresolved_tracks': self.unresolved,
+            'inference_ms': round(self._cost * 1000, 2),
+        }
@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import pickle
+import struct
+from collections.abc import Mapping
+import numpy as np
+
+# Định dạng file .emb (little-endian):
+#   header 128 byte: magic, version, dtype, dim, số dòng, số nhãn và offset của từng phần
+#   khối embedding liên tục (số dòng x dim, float32 hoặc float16), các dòng của cùng
+#   một người nằm liền nhau
+#   nhãn int32 của từng dòng
+#   bảng offset int64 (số nhãn x 2): (dòng bắt đầu, số dòng) của từng người
+#   bảng tên (JSON UTF-8)
+# File được mở bằng np.memmap nên nhiều tiến trình dùng chung một bản trong page cache
+MAGIC = b"FEMB"
+VERSION = 1
+HEADER_FORMAT = "<4sIIIQQQQQQQ"
+HEADER_SIZE = 128
+ALIGN = 64
+DTYPES = {0: np.float32, 1: np.float16}
+DTYPE_CODES = {np.dtype(np.float32): 0, np.dtype(np.float16): 1}
+
+
+def _align(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_store(path, embeddings, dtype=np.float32):
+    # Ghi {tên: [emb, ...]} ra file .emb (ghi file tạm rồi đổi tên)
+    dtype = np.dtype(dtype)
+    names = [name for name, embs in embeddings.items() if len(embs) > 0]
+    blocks = [np.asarray(embeddings[name], dtype=np.float32).reshape(len(embeddings[name]), -1) for name in names]
+    dim = blocks[0].shape[1] if blocks else 512
+    counts = np.asarray([block.shape[0] for block in blocks], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64) if blocks else counts
+    matrix = np.vstack(blocks).astype(dtype) if blocks else np.zeros((0, dim), dtype=dtype)
+    labels = np.repeat(np.arange(len(names), dtype=np.int32), counts)
+    offsets = np.stack([starts, counts], axis=1) if blocks else np.zeros((0, 2), dtype=np.int64)
+    names_bytes = json.dumps(names, ensure_ascii=False).encode("utf-8")
+
+    matrix_offset = _align(HEADER_SIZE)
+    labels_offset = _align(matrix_offset + matrix.nbytes)
+    index_offset = _align(labels_offset + labels.nbytes)
+    names_offset = _align(index_offset + offsets.nbytes)
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, DTYPE_CODES[dtype], dim,
+                         matrix.shape[0], len(names), matrix_offset, labels_offset,
+                         index_offset, names_offset, len(names_bytes))
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for offset, data in ((0, header), (matrix_offset, matrix.tobytes()),
+                             (labels_offset, labels.tobytes()), (index_offset, offsets.tobytes()),
+                             (names_offset, names_bytes)):
+            f.seek(offset)
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore(Mapping):
+    # Đọc file .emb; dùng được như dict {tên: mảng embeddings} của face_embeddings.pkl cũ.
+    # mmap=False thì đọc hẳn vào RAM (cần trên Windows, nơi không thể thay thế file đang được map)
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+            (magic, version, dtype_code, dim, n_rows, n_labels, matrix_offset, labels_offset,
+             index_offset, names_offset, names_size) = struct.unpack_from(HEADER_FORMAT, header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} không phải file embedding hợp lệ")
+            f.seek(names_offset)
+            self.names = json.loads(f.read(names_size).decode("utf-8"))
+
+        dtype = DTYPES[dtype_code]
+
+        def section(offset, section_dtype, shape):
+            if shape[0] == 0:
+                return np.zeros(shape, dtype=section_dtype)
+            if mmap:
+                return np.memmap(path, dtype=section_dtype, mode="r", offset=offset, shape=shape)
+            return np.fromfile(path, dtype=section_dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+        self.dim = dim
+        self.matrix = section(matrix_offset, dtype, (n_rows, dim))
+        self.labels = np.asarray(section(labels_offset, np.int32, (n_rows,)))
+        self.offsets = np.asarray(section(index_offset, np.int64, (n_labels, 2)))
+        self._label_of = {name: label for label, name in enumerate(self.names)}
+
+    def __getitem__(self, name):
+        start, count = self.offsets[self._label_of[name]]
+        return self.matrix[start:start + count]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._label_of
+
+
+def load_embeddings(path):
+    # Trả về đối tượng kiểu dict {tên: embeddings} cho cả file .emb lẫn file .pkl cũ
+    if path.endswith(".emb"):
+        return EmbeddingStore(path, mmap=os.name != "nt")
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def migrate(pkl_path, store_path, dtype=np.float32):
+    with open(pkl_path, "rb") as f:
+        embeddings = pickle.load(f)
+    write_store(store_path, embeddings, dtype)
+    print(f"Đã chuyển {pkl_path} sang {store_path}: {sum(len(v) for v in embeddings.values())} embeddings")
+
+
+def migrate_if_needed(pkl_path, store_path):
+    # Tạo file .emb từ face_embeddings.pkl cũ nếu chưa có
+    if not os.path.exists(store_path) and os.path.exists(pkl_path):
+        migrate(pkl_path, store_path)
+
+
+if __name__ == '__main__':
+    # python embedding_store.py face_embeddings.pkl face_embeddings.emb [float16]
+    if len(sys.argv) < 3:
+        print("Cách dùng: python embedding_store.py <file .pkl> <file .emb> [float32|float16]")
+        sys.exit(1)
+    migrate(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else "float32")
@@ -0,0 +1,82 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import face_register
+
+
+class Enroller:
+    # Cập nhật embeddings ngay trong tiến trình server, dùng lại face_app đã load sẵn
+    # thay vì chạy face_register.py bằng subprocess. Công việc chạy trên một luồng nền,
+    # route upload chỉ nhận về job_id để client hỏi trạng thái.
+    # register_dataset đồng bộ toàn bộ dataset nên các yêu cầu đến khi đã có một job
+    # đang chờ sẽ được gộp vào job đó: hàng đợi không bao giờ dài quá một job chờ + một job chạy
+    def __init__(self, face_app, on_update=None, max_jobs=100, compact=None):
+        self.face_app = face_app
+        self.on_update = on_update  # Gọi sau khi face_embeddings.emb được ghi lại
+        # Tham số thu gọn gallery, None = giữ thiết lập đã lưu bởi face_register.py --compact
+        self.compact = compact
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self._pending_id = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="enroller")
+
+    def submit(self, student_name=None):
+        with self._lock:
+            if self._pending_id is not None:
+                job = self.jobs[self._pending_id]
+                if student_name and student_name not in job["students"]:
+                    job["students"].append(student_name)
+                return job["id"]
+
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "students": [student_name] if student_name else [],
+                "created": time.time(),
+                "finished": None,
+                "result": None,
+                "error": None,
+            }
+            self._pending_id = job_id
+            self._trim_jobs()
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def status(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job, students=list(job["students"])) if job else None
+
+    def _trim_jobs(self):
+        # Chỉ giữ lại max_jobs job gần nhất
+        for job_id in list(self.jobs)[:max(0, len(self.jobs) - self.max_jobs)]:
+            if self.jobs[job_id]["status"] in ("done", "error"):
+                del self.jobs[job_id]
+
+    def _run(self, job_id):
+        with self._lock:
+            self._pending_id = None
+            self.jobs[job_id]["status"] = "running"
+        try:
+            stats = face_register.register_dataset(self.face_app, compact=self.compact)
+            result = {
+                "added": len(stats["added"]),
+                "updated": len(stats["updated"]),
+                "removed": len(stats["removed"]),
+                "unchanged": stats["unchanged"],
+            }
+            if self.on_update is not None and (stats["added"] or stats["updated"] or stats["removed"]):
+                self.on_update()
+            with self._lock:
+                self.jobs[job_id].update(status="done", result=result, finished=time.time())
+        except Exception as e:
+            print(f"Lỗi khi cập nhật dữ liệu khuôn mặt: {e}")
+            with self._lock:
+                self.jobs[job_id].update(status="error", error=str(e), finished=time.time())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,314 @@
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Kích thước embedding của buffalo_l (ArcFace)
+EMBEDDING_DIM = 512
+
+
+def _top_k(scores, k):
+    # Lấy k cột có điểm cao nhất cho từng dòng, sắp xếp giảm dần
+    if k >= scores.shape[1]:
+        order = np.argsort(-scores, axis=1)
+    else:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(scores, part, axis=1)
+        order = np.take_along_axis(part, np.argsort(-part_scores, axis=1), axis=1)
+    return np.take_along_axis(scores, order, axis=1), order
+
+
+def _pad(scores, ids, k):
+    # Bổ sung (-inf, -1) khi index có ít hơn k vector
+    missing = k - scores.shape[1]
+    if missing > 0:
+        scores = np.hstack([scores, np.full((scores.shape[0], missing), -np.inf, dtype=np.float32)])
+        ids = np.hstack([ids, np.full((ids.shape[0], missing), -1, dtype=np.int64)])
+    return scores, ids
+
+
+class FlatIndex:
+    # Tìm kiếm chính xác: một phép nhân ma trận trên toàn bộ vector
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def add(self, ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if vectors.shape[0] == 0:
+            return
+        self.vectors = np.ascontiguousarray(np.vstack([self.vectors, vectors]))
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.vectors = np.ascontiguousarray(self.vectors[keep])
+        self.ids = self.ids[keep]
+
+    def adopt(self, ids, vectors):
+        # Dùng thẳng mảng có sẵn (ví dụ memmap của EmbeddingStore), không sao chép
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.vectors = vectors
+
+    def items(self):
+        return self.ids, self.vectors
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(-1, self.dim)
+        ids, vectors = self.ids, self.vectors
+        if ids.shape[0] == 0:
+            return _pad(np.zeros((query.shape[0], 0), np.float32), np.zeros((query.shape[0], 0), np.int64), k)
+        sims = query @ vectors.T
+        if k == 1:
+            best = sims.argmax(axis=1)[:, None]
+            return np.take_along_axis(sims, best, axis=1), ids[best]
+        scores, cols = _top_k(sims, k)
+        return _pad(scores, ids[cols], k)
+
+
+class QuantizedIndex(FlatIndex):
+    # Quét toàn bộ gallery trên bản lượng tử hóa (float16, hoặc int8 đối xứng với một hệ số
+    # cho mỗi vector) theo từng khối, rồi chấm lại rerank ứng viên tốt nhất bằng vector float32.
+    # Khi vector float32 là memmap của EmbeddingStore thì chỉ các dòng ứng viên được đọc,
+    # phần nằm thường trực trong cache chỉ còn 1/2 (float16) hoặc 1/4 (int8).
+    # rerank=0: trả về thẳng điểm xấp xỉ
+    def __init__(self, dim=EMBEDDING_DIM, dtype="int8", rerank=8, chunk_rows=8192):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Kiểu lượng tử hóa không hợp lệ: {dtype} (hỗ trợ: float16, int8)")
+        super().__init__(dim)
+        self.dtype = dtype
+        self.rerank = rerank
+        self.chunk_rows = chunk_rows
+        self.codes = np.zeros((0, dim), dtype=np.dtype(dtype))
+        self.scales = np.zeros(0, dtype=np.float32)
+
+    def _quantize(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if self.dtype == "float16":
+            return vectors.astype(np.float16), np.ones(vectors.shape[0], dtype=np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def add(self, ids, vectors):
+        super().add(ids, vectors)
+        codes, scales = self._quantize(vectors)
+        self.codes = np.ascontiguousarray(np.vstack([self.codes, codes]))
+        self.scales = np.concatenate([self.scales, scales])
+
+    def remove(self, ids):
+        keep = ~np.isin(self.ids, np.asarray(ids, dtype=np.int64))
+        self.codes = np.ascontiguousarray(self.codes[keep])
+        self.scales = self.scales[keep]
+        super().remove(ids)
+
+    def adopt(self, ids, vectors):
+        super().adopt(ids, vectors)
+        codes, scales = [], []
+        for start in range(0, vectors.shape[0], self.chunk_rows):
+            block_codes, block_scales = self._quantize(vectors[start:start + self.chunk_rows])
+            codes.append(block_codes)
+            scales.append(block_scales)
+        if codes:
+            self.codes = np.ascontiguousarray(np.vstack(codes))
+            self.scales = np.concatenate(scales)
+
+    def approximate_scores(self, query):
+        query = np.asarray(query, dtype=np.float32).reshape(-1, self.dim)
+        scores = np.empty((query.shape[0], self.codes.shape[0]), dtype=np.float32)
+        for start in range(0, self.codes.shape[0], self.chunk_rows):
+            end = start + self.chunk_rows
+            block = self.codes[start:end].astype(np.float32)
+            scores[:, start:end] = (query @ block.T) * self.scales[start:end]
+        return scores
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(-1, self.dim)
+        ids = self.ids
+        if ids.shape[0] == 0:
+            return _pad(np.zeros((query.shape[0], 0), np.float32), np.zeros((query.shape[0], 0), np.int64), k)
+        approx = self.approximate_scores(query)
+        if self.rerank <= 0:
+            scores, cols = _top_k(approx, k)
+            return _pad(scores, ids[cols], k)
+
+        # Chấm lại các ứng viên bằng tích vô hướng float32 chính xác
+        candidates = _top_k(approx, max(self.rerank, k))[1]
+        exact = np.einsum("qd,qrd->qr", query, np.asarray(self.vectors[candidates], dtype=np.float32))
+        scores, order = _top_k(exact, k)
+        return _pad(scores, ids[np.take_along_axis(candidates, order, axis=1)], k)
+
+
+class IVFIndex:
+    # Inverted file index thuần NumPy: chia vector thành nlist cụm bằng spherical k-means,
+    # khi tìm kiếm chỉ quét nprobe cụm gần nhất. nprobe càng lớn recall càng cao, càng chậm
+    def __init__(self, dim=EMBEDDING_DIM, nlist=None, nprobe=8, train_size=None, n_iter=10, seed=0):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.list_ids = []
+        self.list_vectors = []
+        self._list_of = {}  # id -> số thứ tự cụm, dùng khi xóa
+        # Vector được thêm trước khi train được giữ ở đây và tìm kiếm chính xác
+        self._pending = FlatIndex(dim)
+
+    def __len__(self):
+        return len(self._pending) + len(self._list_of)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _min_train_size(self):
+        if self.train_size is not None:
+            return self.train_size
+        return 39 * self.nlist if self.nlist else 1024
+
+    def train(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(vectors.shape[0])))
+        nlist = min(nlist, vectors.shape[0])
+        rng = np.random.default_rng(self.seed)
+        centroids = vectors[rng.choice(vectors.shape[0], nlist, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assign = (vectors @ centroids.T).argmax(axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            # Cụm rỗng được gán lại một vector ngẫu nhiên
+            sums[empty] = vectors[rng.choice(vectors.shape[0], int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.maximum(norms, 1e-12)
+        self.nlist = nlist
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_ids = [np.zeros(0, dtype=np.int64) for _ in range(nlist)]
+        self.list_vectors = [np.zeros((0, self.dim), dtype=np.float32) for _ in range(nlist)]
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if not self.is_trained:
+            self._pending.add(ids, vectors)
+            if len(self._pending) < self._min_train_size():
+                return
+            ids, vectors = self._pending.items()
+            self._pending = FlatIndex(self.dim)
+            self.train(vectors)
+        if vectors.shape[0] == 0:
+            return
+        assign = (vectors @ self.centroids.T).argmax(axis=1)
+        for list_no in np.unique(assign):
+            rows = assign == list_no
+            self.list_ids[list_no] = np.concatenate([self.list_ids[list_no], ids[rows]])
+            self.list_vectors[list_no] = np.vstack([self.list_vectors[list_no], vectors[rows]])
+            for item_id in ids[rows]:
+                self._list_of[int(item_id)] = int(list_no)
+
+    def remove(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        self._pending.remove(ids)
+        touched = {self._list_of.pop(int(item_id)) for item_id in ids if int(item_id) in self._list_of}
+        for list_no in touched:
+            keep = ~np.isin(self.list_ids[list_no], ids)
+            self.list_ids[list_no] = self.list_ids[list_no][keep]
+            self.list_vectors[list_no] = self.list_vectors[list_no][keep]
+
+    def items(self):
+        ids = [self._pending.ids] + self.list_ids
+        vectors = [self._pending.vectors] + self.list_vectors
+        return np.concatenate(ids), np.vstack(vectors)
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(-1, self.dim)
+        if not self.is_trained:
+            return self._pending.search(query, k)
+
+        nprobe = min(self.nprobe, self.nlist)
+        probes = np.argpartition(-(query @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        out_scores = np.full((query.shape[0], k), -np.inf, dtype=np.float32)
+        out_ids = np.full((query.shape[0], k), -1, dtype=np.int64)
+        for i, q in enumerate(query):
+            cand_ids = [self.list_ids[l] for l in probes[i]]
+            cand_scores = [self.list_vectors[l] @ q for l in probes[i]]
+            cand_ids = np.concatenate(cand_ids)
+            if cand_ids.shape[0] == 0:
+                continue
+            scores, cols = _top_k(np.concatenate(cand_scores)[None, :], k)
+            n = scores.shape[1]
+            out_scores[i, :n] = scores[0]
+            out_ids[i, :n] = cand_ids[cols[0]]
+        return out_scores, out_ids
+
+
+class HNSWIndex:
+    # Đồ thị HNSW qua thư viện hnswlib (tùy chọn). ef càng lớn recall càng cao, càng chậm
+    def __init__(self, dim=EMBEDDING_DIM, M=16, ef_construction=200, ef=64, capacity=1024):
+        if hnswlib is None:
+            raise ImportError("Cần cài đặt hnswlib để dùng HNSWIndex (pip install hnswlib)")
+        self.dim = dim
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        self.index.init_index(max_elements=capacity, M=M, ef_construction=ef_construction, allow_replace_deleted=True)
+        self.index.set_ef(ef)
+        self._ids = set()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if vectors.shape[0] == 0:
+            return
+        needed = self.index.get_current_count() + vectors.shape[0]
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, ids, replace_deleted=True)
+        self._ids.update(int(item_id) for item_id in ids)
+
+    def remove(self, ids):
+        for item_id in ids:
+            if int(item_id) in self._ids:
+                self.index.mark_deleted(int(item_id))
+                self._ids.discard(int(item_id))
+
+    def items(self):
+        ids = np.asarray(sorted(self._ids), dtype=np.int64)
+        if ids.shape[0] == 0:
+            return ids, np.zeros((0, self.dim), dtype=np.float32)
+        return ids, np.asarray(self.index.get_items(ids), dtype=np.float32)
+
+    def search(self, query, k=1):
+        query = np.asarray(query, dtype=np.float32).reshape(-1, self.dim)
+        n = min(k, len(self._ids))
+        if n == 0:
+            return _pad(np.zeros((query.shape[0], 0), np.float32), np.zeros((query.shape[0], 0), np.int64), k)
+        labels, distances = self.index.knn_query(query, k=n)
+        # Với space="ip", hnswlib trả về 1 - tích vô hướng
+        return _pad((1.0 - distances).astype(np.float32), labels.astype(np.int64), k)
+
+
+INDEX_TYPES = {
+    "flat": FlatIndex,
+    "flat_fp16": lambda dim, **params: QuantizedIndex(dim, dtype="float16", **params),
+    "flat_int8": lambda dim, **params: QuantizedIndex(dim, dtype="int8", **params),
+    "ivf": IVFIndex,
+    "hnsw": HNSWIndex,
+}
+
+
+def make_index(kind="flat", dim=EMBEDDING_DIM, **params):
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Loại index không hợp lệ: {kind} (hỗ trợ: {', '.join(INDEX_TYPES)})")
+    return INDEX_TYPES[kind](dim=dim, **params)
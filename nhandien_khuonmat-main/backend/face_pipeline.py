@@ -0,0 +1,51 @@
+import numpy as np
+from insightface.app.common import Face
+from insightface.utils import face_align
+
+# Pipeline chỉ cần phát hiện và nhận diện: bỏ landmark 2d/3d và genderage của buffalo_l,
+# các đầu ra đó không backend nào dùng. Truyền vào FaceAnalysis(allowed_modules=...).
+# face_app.get() vẫn hoạt động bình thường, chỉ chạy hai model này.
+PIPELINE_MODULES = ['detection', 'recognition']
+
+
+def detect_faces(face_app, frame, max_num=0):
+    # Chỉ chạy model phát hiện: trả về Face có bbox, kps (5 điểm mốc) và det_score
+    bboxes, kpss = face_app.det_model.detect(frame, max_num=max_num, metric='default')
+    return faces_from_detections(bboxes, kpss)
+
+
+def faces_from_detections(bboxes, kpss):
+    # Dựng Face từ đầu ra thô của detector (bboxes (N, 5) gồm điểm tin cậy, kpss (N, 5, 2) hoặc None)
+    faces = []
+    for i in range(bboxes.shape[0]):
+        kps = kpss[i] if kpss is not None else None
+        faces.append(Face(bbox=bboxes[i, 0:4], kps=kps, det_score=bboxes[i, 4]))
+    return faces
+
+
+def align_faces(face_app, frame, faces):
+    # Căn chỉnh khuôn mặt theo 5 điểm mốc về kích thước đầu vào của ArcFace (112x112)
+    image_size = face_app.models['recognition'].input_size[0]
+    return [face_align.norm_crop(frame, landmark=face.kps, image_size=image_size) for face in faces]
+
+
+def embed_crops(face_app, crops):
+    # Chỉ chạy model nhận diện trên danh sách ảnh đã căn chỉnh, một lần suy luận cho cả lô.
+    # Trả về ma trận (N, 512) chưa chuẩn hóa
+    rec_model = face_app.models['recognition']
+    if not crops:
+        return np.empty((0, rec_model.output_shape[1]), dtype=np.float32)
+    return rec_model.get_feat(crops)
+
+
+def embed_faces(face_app, frame, faces, client=None):
+    # Căn chỉnh + ArcFace cho các khuôn mặt đã phát hiện, gán face.embedding.
+    # Có client (InferenceSession / PoolSession) thì việc suy luận do client đảm nhận
+    if faces:
+        if client is not None:
+            embs = client.embed_faces(frame, faces)
+        else:
+            embs = embed_crops(face_app, align_faces(face_app, frame, faces))
+        for face, emb in zip(faces, embs):
+            face.embedding = emb
+    return faces
@@ -1,46 +1,189 @@
 import os
 import cv2
+import argparse
+import json
 import pickle
+import hashlib
 import numpy as np
-from insightface.app import FaceAnalysis
+from embedding_store import write_store
+from model_loader import load_face_app
+from gallery_compaction import compact_embeddings, print_report
 
 # Đường dẫn đến thư mục dataset chứa ảnh học sinh
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 dataset_dir = os.path.abspath(os.path.join(BASE_DIR, '..', 'dataset'))
+embeddings_path = os.path.join(BASE_DIR, "face_embeddings.emb")
+# Manifest ghi lại từng ảnh đã xử lý: đường dẫn, mtime, kích thước, hash nội dung và embedding
+manifest_path = os.path.join(BASE_DIR, "enroll_manifest.pkl")
+# Thiết lập dùng khi ghi file embeddings (tham số thu gọn), để lần đồng bộ sau (Enroller trong server)
+# ghi lại file theo đúng thiết lập đó thay vì làm mất kết quả của --compact
+settings_path = os.path.join(BASE_DIR, "enroll_settings.json")
 
-# Khởi tạo model InsightFace trên CPU
-app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-app.prepare(ctx_id=0, det_size=(640, 640))
-
-embeddings = {}
-print("Bắt đầu xử lý ảnh trong dataset để tạo embeddings...")
-
-# Duyệt qua từng thư mục con (tên học sinh) trong dataset
-for person_name in os.listdir(dataset_dir):
-    person_path = os.path.join(dataset_dir, person_name)
-    if not os.path.isdir(person_path):
-        continue
-    print(f"--- Xử lý học sinh: {person_name}")
-    # Duyệt qua các ảnh trong thư mục của học sinh đó
-    for img_name in os.listdir(person_path):
-        img_path = os.path.join(person_path, img_name)
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"Không thể đọc ảnh: {img_path}")
+
+def create_face_app():
+    # Khởi tạo model InsightFace trên CPU
+    return load_face_app(det_size=(640, 640), profile='cpu')
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(path=manifest_path):
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    return {}
+
+
+def load_settings(path=settings_path):
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+
+def save_settings(settings, path=settings_path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(settings, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def atomic_dump(obj, path):
+    # Ghi ra file tạm rồi đổi tên để tiến trình khác không bao giờ đọc phải file ghi dở
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def scan_dataset(root=dataset_dir):
+    # Trả về {đường dẫn tương đối: (tên học sinh, đường dẫn tuyệt đối, os.stat)}
+    images = {}
+    for person_name in sorted(os.listdir(root)):
+        person_path = os.path.join(root, person_name)
+        if not os.path.isdir(person_path):
             continue
-        # Giảm kích thước nếu ảnh quá lớn (max 800x800)
-        if img.shape[0] > 800 or img.shape[1] > 800:
-            img = cv2.resize(img, (640, 640))
-        faces = app.get(img)
-        if len(faces) > 0:
-            emb = faces[0].normed_embedding
-            embeddings.setdefault(person_name, []).append(emb)
-            print(f"Lấy embedding từ ảnh: {img_name}")
-        else:
-            print(f"Không tìm thấy khuôn mặt trong ảnh: {img_name}")
-
-# Lưu embeddings vào file face_embeddings.pkl trong thư mục backend
-output_path = os.path.join(BASE_DIR, "face_embeddings.pkl")
-with open(output_path, "wb") as f:
-    pickle.dump(embeddings, f)
-print(f"Đã lưu file embeddings: {output_path}")
+        for img_name in sorted(os.listdir(person_path)):
+            img_path = os.path.join(person_path, img_name)
+            if os.path.isfile(img_path):
+                images[f"{person_name}/{img_name}"] = (person_name, img_path, os.stat(img_path))
+    return images
+
+
+def embed_image(app, img_path):
+    img = cv2.imread(img_path)
+    if img is None:
+        print(f"Không thể đọc ảnh: {img_path}")
+        return None
+    # Giảm kích thước nếu ảnh quá lớn (max 800x800)
+    if img.shape[0] > 800 or img.shape[1] > 800:
+        img = cv2.resize(img, (640, 640))
+    faces = app.get(img)
+    if len(faces) > 0:
+        print(f"Lấy embedding từ ảnh: {img_path}")
+        return faces[0].normed_embedding
+    print(f"Không tìm thấy khuôn mặt trong ảnh: {img_path}")
+    return None
+
+
+def build_embeddings(manifest):
+    # Gom embeddings theo học sinh dạng {tên: [emb, ...]} để ghi ra face_embeddings.emb
+    embeddings = {}
+    for rel_path in sorted(manifest):
+        entry = manifest[rel_path]
+        if entry["embedding"] is not None:
+            embeddings.setdefault(entry["person"], []).append(entry["embedding"])
+    return embeddings
+
+
+def register_dataset(app=None, root=dataset_dir, output_path=embeddings_path,
+                     manifest_file=manifest_path, rebuild=False, compact=None, force_write=False,
+                     settings_file=settings_path):
+    # Chỉ tính embedding cho ảnh mới hoặc đã thay đổi, bỏ ảnh đã bị xóa khỏi dataset.
+    # Model chỉ được khởi tạo khi thực sự có ảnh cần xử lý.
+    # compact: dict tham số của compact_embeddings để mỗi học sinh chỉ còn vài prototype trong file
+    # embeddings (manifest vẫn giữ embedding của từng ảnh), False để tắt thu gọn, None để giữ
+    # thiết lập đã lưu trong settings_file của lần ghi trước
+    settings = load_settings(settings_file)
+    if compact is None:
+        compact = settings.get("compact")
+    elif compact is False:
+        compact = None
+    settings_changed = compact != settings.get("compact")
+    manifest = {} if rebuild else load_manifest(manifest_file)
+    images = scan_dataset(root)
+    new_manifest = {}
+    stats = {"added": [], "updated": [], "removed": [], "unchanged": 0}
+
+    for rel_path, (person_name, img_path, st) in images.items():
+        entry = manifest.get(rel_path)
+        if entry is not None and entry["person"] == person_name \
+                and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+            new_manifest[rel_path] = entry
+            stats["unchanged"] += 1
+            continue
+
+        digest = file_hash(img_path)
+        if entry is not None and entry["person"] == person_name and entry["sha1"] == digest:
+            # Chỉ đổi mtime (ví dụ copy lại), nội dung không đổi
+            new_manifest[rel_path] = dict(entry, mtime=st.st_mtime, size=st.st_size)
+            stats["unchanged"] += 1
+            continue
+
+        if app is None:
+            app = create_face_app()
+        new_manifest[rel_path] = {
+            "person": person_name,
+            "mtime": st.st_mtime,
+            "size": st.st_size,
+            "sha1": digest,
+            "embedding": embed_image(app, img_path),
+        }
+        stats["updated" if entry is not None else "added"].append(rel_path)
+
+    stats["removed"] = sorted(set(manifest) - set(new_manifest))
+    for rel_path in stats["removed"]:
+        print(f"Bỏ ảnh đã bị xóa: {rel_path}")
+
+    changed = stats["added"] or stats["updated"] or stats["removed"]
+    # Bật/tắt hoặc đổi tham số thu gọn thì phải ghi lại file embeddings dù dataset không đổi
+    if changed or force_write or settings_changed or not os.path.exists(output_path):
+        embeddings = build_embeddings(new_manifest)
+        if compact is not None:
+            embeddings, report = compact_embeddings(embeddings, **compact)
+            print_report(report)
+        write_store(output_path, embeddings)
+        print(f"Đã lưu file embeddings: {output_path}")
+        if settings_changed:
+            save_settings(dict(settings, compact=compact), settings_file)
+    atomic_dump(new_manifest, manifest_file)
+    print(f"Thêm {len(stats['added'])}, cập nhật {len(stats['updated'])}, "
+          f"xóa {len(stats['removed'])}, giữ nguyên {stats['unchanged']} ảnh")
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tạo embeddings khuôn mặt từ thư mục dataset")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="bỏ qua manifest và tính lại embeddings cho toàn bộ dataset")
+    parser.add_argument("--compact", choices=["mean", "medoids"],
+                        help="thu gọn mỗi học sinh thành vài prototype")
+    parser.add_argument("--no-compact", action="store_true",
+                        help="tắt thu gọn đã bật ở lần chạy trước")
+    parser.add_argument("--prototypes", type=int, default=1, help="số prototype tối đa mỗi học sinh")
+    args = parser.parse_args()
+
+    print("Bắt đầu xử lý ảnh trong dataset để tạo embeddings...")
+    compact = None  # Không có tham số: giữ thiết lập thu gọn đã lưu
+    if args.compact:
+        compact = {"method": args.compact, "max_prototypes": args.prototypes}
+    elif args.no_compact:
+        compact = False
+    # Chỉ ghi lại file embeddings khi dataset hoặc thiết lập thay đổi, trừ khi yêu cầu --compact / --rebuild
+    register_dataset(rebuild=args.rebuild, compact=compact, force_write=args.rebuild or bool(args.compact))
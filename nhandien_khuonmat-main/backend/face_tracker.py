@@ -0,0 +1,175 @@
+import itertools
+import time
+import numpy as np
+from face_pipeline import detect_faces, embed_faces
+
+
+def iou_matrix(boxes_a, boxes_b):
+    # IoU giữa từng cặp bbox (x1, y1, x2, y2)
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+class Track:
+    def __init__(self, track_id, face, frame_index):
+        self.track_id = track_id
+        self.bbox = np.asarray(face.bbox, dtype=np.float32)
+        self.measured = self.bbox  # bbox của lần phát hiện gần nhất
+        self.updated = frame_index
+        self.velocity = np.zeros(4, dtype=np.float32)
+        self.face = face  # Kết quả phát hiện của khung hình hiện tại, None nếu chỉ là dự đoán
+        self.misses = 0
+        self.name = "Unknown"
+        self.score = -1.0
+        self.confidence = 0.0
+        self.confirmed = False
+        self.streak = 0
+        self.last_recognized = None
+        self.created = frame_index
+
+
+class FaceTracker:
+    # Gán track ID ổn định cho khuôn mặt giữa các khung hình bằng IoU và dự đoán vận tốc
+    # không đổi (bộ lọc alpha-beta), để ArcFace chỉ chạy khi có track mới hoặc khi độ tin
+    # cậy của danh tính đã suy giảm. Track đã xác nhận (confirm_hits lần khớp liên tiếp
+    # cùng một tên) không bao giờ phải tính embedding lại.
+    #   detect_interval: chạy detector mỗi bao nhiêu khung hình, giữa hai lần thì bbox được dự đoán
+    #   retry_interval: số khung hình chờ trước khi thử nhận diện lại track "Unknown"
+    #   decay: hệ số suy giảm độ tin cậy mỗi khung hình của track chưa xác nhận
+    def __init__(self, iou_threshold=0.3, max_misses=10, detect_interval=1, confirm_hits=2,
+                 min_confidence=0.45, decay=0.98, retry_interval=15, alpha=0.6):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.detect_interval = detect_interval
+        self.confirm_hits = confirm_hits
+        self.min_confidence = min_confidence
+        self.decay = decay
+        self.retry_interval = retry_interval
+        self.alpha = alpha
+        self.tracks = []
+        self.frame_index = 0
+        self.resolved = set()  # Sinh viên đã điểm danh: không bao giờ nhận diện lại
+        self.low_power = False  # Cả lớp đã có mặt: chỉ chạy detector, không chạy ArcFace
+        self._ids = itertools.count(1)
+
+    def _advance(self):
+        self.frame_index += 1
+        for track in self.tracks:
+            track.bbox = track.bbox + track.velocity
+            track.face = None
+            if not track.confirmed:
+                track.confidence *= self.decay
+
+    def predict(self):
+        # Khung hình không chạy detector: bbox đi theo vận tốc ước lượng
+        self._advance()
+        return self.visible_tracks()
+
+    def update(self, faces):
+        self._advance()
+        det_boxes = np.asarray([face.bbox for face in faces], dtype=np.float32).reshape(-1, 4)
+        unmatched_tracks = set(range(len(self.tracks)))
+        unmatched_faces = set(range(len(faces)))
+
+        if self.tracks and faces:
+            ious = iou_matrix([t.bbox for t in self.tracks], det_boxes)
+            # Ghép tham lam theo IoU giảm dần
+            for flat in np.argsort(-ious, axis=None):
+                ti, fi = np.unravel_index(flat, ious.shape)
+                if ious[ti, fi] < self.iou_threshold:
+                    break
+                if ti not in unmatched_tracks or fi not in unmatched_faces:
+                    continue
+                unmatched_tracks.discard(ti)
+                unmatched_faces.discard(fi)
+                track = self.tracks[ti]
+                measured = det_boxes[fi]
+                # Khoảng cách giữa hai lần phát hiện thay đổi theo nhịp detector nên chia theo số khung hình
+                gap = max(self.frame_index - track.updated, 1)
+                track.velocity = (self.alpha * (measured - track.measured) / gap
+                                  + (1 - self.alpha) * track.velocity)
+                track.bbox = measured
+                track.measured = measured
+                track.updated = self.frame_index
+                track.face = faces[fi]
+                track.misses = 0
+
+        for ti in unmatched_tracks:
+            self.tracks[ti].misses += 1
+        self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+        for fi in sorted(unmatched_faces):
+            self.tracks.append(Track(next(self._ids), faces[fi], self.frame_index))
+        return self.visible_tracks()
+
+    def should_detect(self):
+        return self.frame_index % self.detect_interval == 0
+
+    def tracks_to_recognize(self):
+        # Chỉ track vừa được detector cập nhật mới có điểm mốc để căn chỉnh khuôn mặt
+        if self.low_power:
+            return []
+        pending = []
+        for track in self.tracks:
+            if track.face is None or track.confirmed:
+                continue
+            if track.last_recognized is None or track.confidence < self.min_confidence:
+                if track.name != "Unknown" or track.last_recognized is None \
+                        or self.frame_index - track.last_recognized >= self.retry_interval:
+                    pending.append(track)
+        return pending
+
+    def set_identity(self, track, name, score):
+        if name != "Unknown" and name == track.name:
+            track.streak += 1
+        else:
+            track.streak = 1 if name != "Unknown" else 0
+        track.name = name
+        track.score = score
+        track.confidence = max(score, 0.0)
+        track.last_recognized = self.frame_index
+        # Khớp với sinh viên đã điểm danh: gắn tên và xác nhận luôn (không ghi nhận lại), track thôi nhận diện
+        if track.streak >= self.confirm_hits or name in self.resolved:
+            track.confirmed = True
+
+    def resolve(self, name):
+        # Đánh dấu sinh viên đã điểm danh, các track đang gắn với người đó thôi nhận diện
+        self.resolved.add(name)
+        for track in self.tracks:
+            if track.name == name:
+                track.confirmed = True
+
+    def visible_tracks(self):
+        return [t for t in self.tracks if t.misses == 0]
+
+    def reset(self):
+        self.tracks = []
+
+
+def track_and_recognize(tracker, face_app, frame, match_fn, client=None, cadence=None):
+    # Một bước của pipeline: phát hiện (hoặc dự đoán) -> cập nhật track -> chỉ tính embedding
+    # cho track cần nhận diện. match_fn nhận danh sách Face đã có embedding và trả về
+    # danh sách (tên, độ tương đồng) như FaceGallery.match_faces.
+    # client (InferenceSession) chuyển việc suy luận sang InferenceService dùng chung,
+    # cadence (AdaptiveCadence) quyết định nhịp chạy detector thay cho detect_interval cố định
+    detect = cadence.should_detect(frame, tracker) if cadence is not None else tracker.should_detect()
+    if not detect:
+        return tracker.predict()
+    start = time.perf_counter()
+    faces = client.detect(frame) if client is not None else detect_faces(face_app, frame)
+    tracks = tracker.update(faces)
+    pending = tracker.tracks_to_recognize()
+    if pending:
+        faces = embed_faces(face_app, frame, [track.face for track in pending], client)
+        for track, (name, score) in zip(pending, match_fn(faces)):
+            tracker.set_identity(track, name, score)
+    if cadence is not None:
+        cadence.record(time.perf_counter() - start)
+    return tracks
@@ -1,8 +1,4 @@
 import cv2
-import pickle
-import numpy as np
-from insightface.app import FaceAnalysis
-import onnxruntime as ort
 from datetime import datetime
 import sqlite3
 import os
@@ -14,10 +10,19 @@ import base64
 from flask import Flask, request, jsonify, Response, render_template, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-import subprocess
-import sys
 from flask_socketio import SocketIO, emit
 import logging
+from gallery import GALLERY_INDEX, GalleryHolder
+from face_tracker import FaceTracker, track_and_recognize
+from cadence import AdaptiveCadence
+from model_loader import load_face_app
+from inference_service import InferenceService
+from frame_ring import LatestChannel
+from stream_encoder import StreamEncoder
+from jpeg_codec import decode_jpeg
+from frame_ingest import IngestRegistry
+from embedding_store import migrate_if_needed
+from enroller import Enroller
 
 # Cấu hình logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,15 +31,18 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DATABASE = os.path.join(BASE_DIR, 'dtb.db')
 dataset_dir = os.path.join(BASE_DIR, '..', 'dataset')
-embeddings_path = os.path.join(BASE_DIR, 'face_embeddings.pkl')
+embeddings_path = os.path.join(BASE_DIR, 'face_embeddings.emb')
+legacy_embeddings_path = os.path.join(BASE_DIR, 'face_embeddings.pkl')
 TEMPLATE_DIR = os.path.join(BASE_DIR, '..', 'Frontend')
 STATIC_DIR = os.path.join(BASE_DIR, '..', 'Frontend')
 
 # Kiểm tra file tồn tại
 if not os.path.exists(DATABASE):
     raise FileNotFoundError(f"Cơ sở dữ liệu {DATABASE} không tồn tại!")
+# Chuyển face_embeddings.pkl cũ sang file memmap .emb nếu chưa có
+migrate_if_needed(legacy_embeddings_path, embeddings_path)
 if not os.path.exists(embeddings_path):
-    raise FileNotFoundError("face_embeddings.pkl không tồn tại!")
+    raise FileNotFoundError("face_embeddings.emb không tồn tại!")
 
 # Khởi tạo Flask app
 app = Flask(__name__, template_folder=TEMPLATE_DIR, static_folder=STATIC_DIR)
@@ -42,7 +50,10 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 socketio = SocketIO(app, cors_allowed_origins="*")
 
 # Khởi tạo biến toàn cục
-frame_queue = queue.Queue(maxsize=10)
+frame_queue = queue.Queue(maxsize=10)  # (sid, seq, khung hình) trình duyệt gửi lên, chỉ process_frames lấy ra
+ingest_registry = IngestRegistry()  # Client gửi khung hình nhị phân: cấu hình đã thỏa thuận và credit
+stream_channel = LatestChannel()  # Khung hình đã vẽ overlay mới nhất cho mọi người xem /stream
+stream_encoder = StreamEncoder(stream_channel.latest)  # Mã hóa JPEG một lần cho mọi người xem
 recognized_faces = {}
 recognized_faces_lock = threading.Lock()
 processing_active = False
@@ -52,12 +63,14 @@ start_time_fps = time.time()
 externals = {}
 pcs = set()
 
-# Khởi tạo FaceAnalysis
-print("Available providers:", ort.get_available_providers())
-with open(embeddings_path, "rb") as f:
-    embeddings = pickle.load(f)
-face_app = FaceAnalysis(name="buffalo_l", providers=['CUDAExecutionProvider'])
-face_app.prepare(ctx_id=0, det_size=(640, 640), det_thresh=0.6)
+# Gallery tự nạp lại khi face_embeddings.emb thay đổi
+gallery_holder = GalleryHolder(embeddings_path, index=GALLERY_INDEX).start_watching()
+# Khởi tạo FaceAnalysis (provider và cấu hình ONNX Runtime theo hồ sơ ORT_PROFILE)
+face_app = load_face_app(det_size=(640, 640), det_thresh=0.6)
+# Một bản model phục vụ mọi phiên: gom lô, chia lượt công bằng giữa các lớp học
+inference_service = InferenceService(face_app)
+# Cập nhật embeddings trong tiến trình, dùng lại face_app ở trên
+enroller = Enroller(face_app, on_update=gallery_holder.reload)
 
 # Hàm kết nối database
 def get_db_connection():
@@ -102,14 +115,20 @@ def save_attendance_to_db(timetable_id, msv, status="Present"):
     except sqlite3.Error as e:
         print(f"Lỗi khi lưu điểm danh: {e}")
 
-def process_frames(class_id=None, timetable_id=None):
+def process_frames(class_id=None, timetable_id=None, foreign_fallback=False):
     global frame_count, fps, start_time_fps, processing_active
     student_list = get_student_list(class_id)
+    student_set = set(student_list)  # Tra cứu O(1) trong vòng lặp
     threshold = 0.5
-    faces = []
+    tracker = FaceTracker()  # Track ID ổn định giữa các khung hình
+    cadence = AdaptiveCadence()  # Nhịp detector theo chuyển động và số track chưa xác nhận
+    inference_session = inference_service.session()
+    tracks = []
     while processing_active:
         try:
-            frame = frame_queue.get(timeout=1.0)
+            sid, seq, frame = frame_queue.get(timeout=1.0)
+            grant_ingest_credit(sid, seq)  # Client được gửi khung hình kế tiếp
+            requeue_parked()  # Hàng đợi vừa có chỗ: đưa khung hình đang giữ của các client vào
             frame_count += 1
             current_time = time.time()
             elapsed_time = current_time - start_time_fps
@@ -117,29 +136,33 @@ def process_frames(class_id=None, timetable_id=None):
                 fps = frame_count / elapsed_time
                 frame_count = 0
                 start_time_fps = current_time
-            if frame_count % 5 == 0:
-                faces = face_app.get(frame)
-            for face in faces:
-                box = face.bbox.astype(int)
-                emb = face.normed_embedding
-                name = "Unknown"
-                max_sim = -1
-                for person_name, person_embs in embeddings.items():
-                    for saved_emb in person_embs:
-                        sim = np.dot(emb, saved_emb)
-                        if sim > max_sim:
-                            max_sim = sim
-                            name = person_name
-                if max_sim < threshold:
-                    name = "Unknown"
-                if name != "Unknown" and name in student_list:
+            if tracker.resolved and not recognized_faces:
+                # Danh sách điểm danh vừa bị xóa: nhận diện lại từ đầu
+                tracker.resolved.clear()
+                tracker.low_power = False
+            # Detector chạy theo nhịp thích ứng, ArcFace chỉ chạy cho track mới hoặc có độ tin cậy
+            # đã suy giảm; so khớp với sinh viên của lớp chưa điểm danh, rồi cả lớp (toàn trường chỉ khi
+            # bật foreign_fallback)
+            tracks = track_and_recognize(
+                tracker, face_app, frame,
+                lambda faces: gallery_holder.current.match_faces(
+                    faces, threshold, class_id, student_list, foreign_fallback,
+                    resolved=tracker.resolved),
+                inference_session, cadence)
+            for track in tracks:
+                name = track.name
+                box = track.bbox.astype(int)
+                if name != "Unknown" and name in student_set:
                     with recognized_faces_lock:
                         if name not in recognized_faces:
                             recognized_faces[name] = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+                            tracker.resolve(name)
                             print(f"-> Ghi nhận có mặt: {name}")
+                            if student_set and student_set <= tracker.resolved:
+                                tracker.low_power = True  # Cả lớp đã có mặt: chỉ chạy detector
                             if timetable_id:
                                 save_attendance_to_db(timetable_id, name)
-                color = (0, 255, 0) if name == "Unknown" or name in student_list else (0, 0, 255)
+                color = (0, 255, 0) if name == "Unknown" or name in student_set else (0, 0, 255)
                 cv2.rectangle(frame, (box[0], box[1]), (box[2], box[3]), color, 2)
                 cv2.putText(frame, f"{name}", (box[0], box[1] - 10),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
@@ -149,27 +172,42 @@ def process_frames(class_id=None, timetable_id=None):
             text_y = 30
             cv2.putText(frame, current_time, (text_x, text_y),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-            cv2.putText(frame, f"So nguoi: {len(faces)}", (text_x, text_y + 35),
+            cv2.putText(frame, f"So nguoi: {len(tracks)}", (text_x, text_y + 35),
                         cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 255), 2)
             cv2.putText(frame, f"FPS: {fps:.2f}", (text_x, text_y + 70),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-            try:
-                frame_queue.put_nowait(frame)
-            except queue.Full:
-                pass
+            stream_channel.publish(frame, time.time())  # Mảng mới mỗi khung hình, không bị ghi đè sau khi publish
         except queue.Empty:
             continue
         except Exception as e:
             print(f"Error in process_frames: {e}")
             break
+    inference_session.close()
     processing_active = False
     print("Đã dừng xử lý khung hình")
 
-def start_processing(class_id=None, timetable_id=None):
+def grant_ingest_credit(sid, seq):
+    client = ingest_registry.get(sid) if sid is not None else None
+    if client is not None:
+        client.return_credit()
+        socketio.emit('ingest_credit', {'grant': 1, 'seq': seq}, to=sid)
+
+def requeue_parked():
+    for client in ingest_registry.parked():
+        try:
+            held = client.requeue(frame_queue.put_nowait)
+        except queue.Full:
+            break
+        if held:
+            # Credit của khung hình giữ lại đã bị thay thế, chưa từng được trả
+            client.return_credit(held)
+            socketio.emit('ingest_credit', {'grant': held, 'seq': None}, to=client.sid)
+
+def start_processing(class_id=None, timetable_id=None, foreign_fallback=False):
     global processing_active, processing_thread
     if not processing_active:
         processing_active = True
-        processing_thread = threading.Thread(target=process_frames, args=(class_id, timetable_id), daemon=True)
+        processing_thread = threading.Thread(target=process_frames, args=(class_id, timetable_id, foreign_fallback), daemon=True)
         processing_thread.start()
         print("Bắt đầu xử lý khung hình")
     else:
@@ -209,21 +247,65 @@ def handle_connect():
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    ingest_registry.close(request.sid)
     logging.info('Client disconnected')
 
+# Nhận khung hình nhị phân (xem giao thức trong frame_ingest.py)
+@socketio.on('ingest_hello')
+def handle_ingest_hello(offer):
+    try:
+        client = ingest_registry.open(request.sid, offer)
+    except ValueError as e:
+        logging.warning(f"Ingest client {request.sid}: ingest_hello không hợp lệ: {e}")
+        emit('ingest_error', {'message': str(e)})
+        return
+    logging.info(f"Ingest client {request.sid}: {client.config['width']}x{client.config['height']} "
+                 f"@ {client.config['fps']} fps, {client.config['format']}")
+    emit('ingest_config', client.config)
+
+@socketio.on('ingest_frame')
+def handle_ingest_frame(data):
+    client = ingest_registry.get(request.sid)
+    if client is None:
+        emit('ingest_error', {'message': 'Chưa gửi ingest_hello'})
+        return
+    if not client.take_credit():
+        logging.debug(f"Ingest client {request.sid} gửi khi hết credit, bỏ khung hình")
+        return
+    try:
+        seq, frame = client.decode(data)
+    except Exception as e:
+        # Khung hình hỏng: trả lại credit để client không bị treo
+        logging.error(f"Error decoding frame: {str(e)}")
+        client.return_credit()
+        emit('ingest_credit', {'grant': 1, 'seq': None})
+        return
+    try:
+        frame_queue.put_nowait((client.sid, seq, frame))
+    except queue.Full:
+        # Hàng đợi đầy khi có nhiều client: giữ khung hình, credit vẫn tính là đang dùng đến khi
+        # process_frames đưa nó vào hàng đợi, nên client gửi chậm lại theo tốc độ xử lý
+        client.park(seq, frame)
+        logging.debug(f"Ingest client {client.sid}: hàng đợi đầy, giữ khung hình {seq}")
+
+# Giao thức cũ: base64 qua sự kiện video_frame, không có flow control
 @socketio.on('video_frame')
 def handle_video_frame(data):
     try:
         frame_data = base64.b64decode(data)
-        nparr = np.frombuffer(frame_data, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        frame_queue.put_nowait(frame)
-        logging.info(f"Received frame from client, queue size: {frame_queue.qsize()}")
+        frame = decode_jpeg(frame_data)  # libjpeg-turbo nếu có, không thì OpenCV
+        frame_queue.put_nowait((None, None, frame))
+        logging.debug(f"Received frame from client, queue size: {frame_queue.qsize()}")
     except queue.Full:
-        logging.warning("Frame queue full, dropping frame")
+        logging.debug("Frame queue full, dropping frame")
     except Exception as e:
         logging.error(f"Error decoding frame: {str(e)}")
 
+@app.route('/api/ingest_stats', methods=['GET'])
+def ingest_stats():
+    # Số khung hình, byte, thời gian giải mã, độ trễ và số lần vượt credit của từng client
+    return jsonify({'status': 'success', 'stats': ingest_registry.stats()}), 200
+
 @app.route('/api/upload', methods=['POST'])
 def upload():
     student_name = request.form.get('student_name')
@@ -249,21 +331,22 @@ def upload():
         file.save(save_path)
         saved_files.append(save_path)
         logging.info(f'Đã lưu ảnh: {save_path}')
-    face_register_path = os.path.join(BASE_DIR, 'face_register.py')
-    if not os.path.exists(face_register_path):
-        logging.error(f'File face_register.py không tồn tại tại: {face_register_path}')
-        return jsonify({'status': 'error', 'message': 'File face_register.py không tồn tại'}), 500
-    try:
-        venv_python = sys.executable
-        logging.info(f'Chạy face_register.py với Python: {venv_python}')
-        subprocess.run([venv_python, face_register_path], check=True)
-        message = f"Ảnh đã được lưu và dữ liệu khuôn mặt đã được cập nhật cho {student_name}."
-        logging.info(message)
-    except subprocess.CalledProcessError as e:
-        message = f"Ảnh đã được lưu nhưng lỗi khi cập nhật dữ liệu khuôn mặt: {str(e)}."
-        logging.error(message)
-        return jsonify({'status': 'error', 'message': message}), 500
-    return jsonify({'status': 'success', 'message': message, 'saved_files': saved_files}), 200
+    job_id = enroller.submit(student_name)
+    message = f"Ảnh đã được lưu, đang cập nhật dữ liệu khuôn mặt cho {student_name}."
+    logging.info(f'{message} (job_id: {job_id})')
+    return jsonify({'status': 'success', 'message': message, 'saved_files': saved_files, 'job_id': job_id}), 200
+
+@app.route('/api/enroll_status/<job_id>', methods=['GET'])
+def enroll_status(job_id):
+    job = enroller.status(job_id)
+    if job is None:
+        logging.error(f'Không tìm thấy công việc cập nhật: {job_id}')
+        return jsonify({'status': 'error', 'message': 'Không tìm thấy công việc cập nhật'}), 404
+    return jsonify({'status': 'success', 'job': job}), 200
+
+@app.route('/api/inference_stats', methods=['GET'])
+def inference_stats():
+    return jsonify({'status': 'success', 'stats': inference_service.stats()}), 200
 
 @app.route('/api/recognize', methods=['POST'])
 def recognize():
@@ -287,11 +370,12 @@ def start_stream():
     data = request.get_json()
     class_id = data.get('class_id')
     timetable_id = data.get('timetable_id')
+    foreign_fallback = bool(data.get('foreign_fallback', False))
     if class_id is None:
         logging.error('Chưa cung cấp class_id')
         return jsonify({'status': 'error', 'message': 'Chưa cung cấp class_id'}), 400
     try:
-        start_processing(class_id, timetable_id)
+        start_processing(class_id, timetable_id, foreign_fallback)
         logging.info(f'Bắt đầu luồng video cho class_id: {class_id}')
         return jsonify({'status': 'success', 'message': 'Bắt đầu luồng video'}), 200
     except Exception as e:
@@ -308,25 +392,24 @@ def stop_stream():
         logging.error(f'Lỗi khi dừng luồng video: {str(e)}')
         return jsonify({'status': 'error', 'message': f'Lỗi khi dừng luồng: {str(e)}'}), 500
 
-def gen_frames():
-    while True:
-        try:
-            frame = frame_queue.get(timeout=0.1)
-            logging.info("Frame retrieved from queue")
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        except queue.Empty:
-            logging.debug("Frame queue empty, waiting...")
-            continue
-        except Exception as e:
-            logging.error(f'Error in gen_frames: {str(e)}')
-            break
+def gen_frames(rendition):
+    # Mỗi người xem chỉ nhận chunk đã mã hóa sẵn của bản stream mình chọn, không tự mã hóa
+    try:
+        yield from stream_encoder.frames(rendition)
+    except Exception as e:
+        logging.error(f'Error in gen_frames: {str(e)}')
 
 @app.route('/stream')
 def stream():
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    rendition = request.args.get('rendition', 'full')
+    if stream_encoder.get(rendition) is None:
+        return jsonify({'status': 'error', 'message': f'Không có bản stream {rendition}'}), 400
+    return Response(gen_frames(rendition), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/api/stream_stats', methods=['GET'])
+def stream_stats():
+    # Thời gian mã hóa, số byte mỗi khung hình và số người xem của từng bản stream
+    return jsonify({'status': 'success', 'stats': stream_encoder.stats()}), 200
 
 # Các API khác từ flask_stream.py
 @app.route('/api/classes', methods=['GET'])
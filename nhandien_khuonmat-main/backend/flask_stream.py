@@ -1,13 +1,10 @@
 import sqlite3
 import os
 from datetime import datetime
-import cv2
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-import subprocess
-import sys
-import queue
+from recognition_events import iter_sse, parse_last_seq
 import logging
 
 # Khởi tạo Flask app
@@ -27,12 +24,12 @@ logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %
 DATABASE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'dtb.db')
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 dataset_dir = os.path.abspath(os.path.join(BASE_DIR, '..', 'dataset'))
-embeddings_path = os.path.join(BASE_DIR, 'face_embeddings.pkl')
+embeddings_path = os.path.join(BASE_DIR, 'face_embeddings.emb')
 
 # Tạo thư mục dataset nếu chưa tồn tại
 os.makedirs(dataset_dir, exist_ok=True)
 
-# Biến toàn cục để lưu trữ frame queue và recognized faces
+# Biến toàn cục để lưu trữ session manager và enroller
 externals = {}
 
 from flask import send_from_directory
@@ -47,9 +44,23 @@ def serve_frontend():
 @app.route('/<path:filename>')
 def serve_static(filename):
     return send_from_directory(FRONTEND_DIR, filename)
-def set_externals(frame_queue, recognized_faces):
-    externals['frame_queue'] = frame_queue
-    externals['recognized_faces'] = recognized_faces
+def set_externals(session_manager, enroller=None):
+    externals['session_manager'] = session_manager
+    if enroller is not None:
+        externals['enroller'] = enroller
+
+
+def resolve_session(session_id):
+    # Trả về (phiên, None) hoặc (None, phản hồi lỗi). Không truyền session_id thì dùng
+    # phiên duy nhất đang có để client một phòng học cũ vẫn chạy được
+    if 'session_manager' not in externals:
+        logging.error('OpenCV chưa khởi tạo')
+        return None, (jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500)
+    session = externals['session_manager'].get(session_id)
+    if session is None:
+        logging.error(f'Không tìm thấy phiên nhận diện: {session_id}')
+        return None, (jsonify({'status': 'error', 'message': 'Không tìm thấy phiên nhận diện'}), 404)
+    return session, None
 
 
 # API upload ảnh sinh viên
@@ -83,42 +94,50 @@ def upload():
         saved_files.append(save_path)
         logging.info(f'Đã lưu ảnh: {save_path}')
 
-    face_register_path = os.path.join(BASE_DIR, 'face_register.py')
-    if not os.path.exists(face_register_path):
-        logging.error(f'File face_register.py không tồn tại tại: {face_register_path}')
-        return jsonify({'status': 'error', 'message': 'File face_register.py không tồn tại'}), 500
+    if 'enroller' not in externals:
+        logging.error('Enroller chưa được khởi tạo')
+        return jsonify({'status': 'error', 'message': 'Enroller chưa được khởi tạo'}), 500
 
-    try:
-        venv_python = sys.executable
-        logging.info(f'Chạy face_register.py với Python: {venv_python}')
-        subprocess.run([venv_python, face_register_path], check=True)
-        message = f"Ảnh đã được lưu và dữ liệu khuôn mặt đã được cập nhật cho {student_name}."
-        logging.info(message)
-    except subprocess.CalledProcessError as e:
-        message = f"Ảnh đã được lưu nhưng lỗi khi cập nhật dữ liệu khuôn mặt: {str(e)}."
-        logging.error(message)
-        return jsonify({'status': 'error', 'message': message}), 500
+    job_id = externals['enroller'].submit(student_name)
+    message = f"Ảnh đã được lưu, đang cập nhật dữ liệu khuôn mặt cho {student_name}."
+    logging.info(f'{message} (job_id: {job_id})')
+    return jsonify({'status': 'success', 'message': message, 'saved_files': saved_files, 'job_id': job_id}), 200
 
-    return jsonify({'status': 'success', 'message': message, 'saved_files': saved_files}), 200
+
+# API kiểm tra trạng thái cập nhật dữ liệu khuôn mặt
+@app.route('/api/enroll_status/<job_id>', methods=['GET'])
+def enroll_status(job_id):
+    if 'enroller' not in externals:
+        logging.error('Enroller chưa được khởi tạo')
+        return jsonify({'status': 'error', 'message': 'Enroller chưa được khởi tạo'}), 500
+    job = externals['enroller'].status(job_id)
+    if job is None:
+        logging.error(f'Không tìm thấy công việc cập nhật: {job_id}')
+        return jsonify({'status': 'error', 'message': 'Không tìm thấy công việc cập nhật'}), 404
+    return jsonify({'status': 'success', 'job': job}), 200
 
 
 # API nhận diện khuôn mặt
 @app.route('/api/recognize', methods=['POST'])
 def recognize():
-    if 'recognized_faces' not in externals:
-        logging.error('OpenCV chưa khởi tạo')
-        return jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500
-    names = list(externals['recognized_faces'].keys())
-    logging.info(f'Nhận diện khuôn mặt: {names}')
-    return jsonify({'status': 'success', 'recognized': names}), 200
+    data = request.get_json(silent=True) or {}
+    session, error = resolve_session(data.get('session_id'))
+    if error:
+        return error
+    names = session.recognized_names()
+    logging.info(f'[{session.session_id}] Nhận diện khuôn mặt: {names}')
+    return jsonify({'status': 'success', 'session_id': session.session_id, 'recognized': names}), 200
 
 
 # API xóa danh sách khuôn mặt đã nhận diện
 @app.route('/api/clear_recognized', methods=['POST'])
 def clear_recognized():
+    data = request.get_json(silent=True) or {}
+    session, error = resolve_session(data.get('session_id'))
+    if error:
+        return error
     try:
-        from opencv_with_queue import clear_recognized_faces
-        clear_recognized_faces()
+        session.clear_recognized()
         logging.info('Đã xóa danh sách khuôn mặt nhận diện')
         return jsonify({'status': 'success', 'message': 'Đã xóa danh sách khuôn mặt nhận diện'}), 200
     except Exception as e:
@@ -126,19 +145,29 @@ def clear_recognized():
         return jsonify({'status': 'error', 'message': f'Lỗi khi xóa danh sách: {str(e)}'}), 500
 
 
-# API bắt đầu stream video
+# API bắt đầu stream video: mỗi phòng học (timetable_id) là một phiên với nguồn camera riêng
 @app.route('/api/start_stream', methods=['POST'])
 def start_stream():
     data = request.get_json()
     class_id = data.get('class_id')
+    timetable_id = data.get('timetable_id')
+    camera = data.get('camera', data.get('source'))  # Mã camera trong cameras.json, không phải URL / đường dẫn
+    foreign_fallback = bool(data.get('foreign_fallback', False))
     if class_id is None:
         logging.error('Chưa cung cấp class_id')
         return jsonify({'status': 'error', 'message': 'Chưa cung cấp class_id'}), 400
+    if 'session_manager' not in externals:
+        logging.error('OpenCV chưa khởi tạo')
+        return jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500
     try:
-        from opencv_with_queue import start_processing
-        start_processing(class_id)
-        logging.info(f'Bắt đầu luồng video cho class_id: {class_id}')
-        return jsonify({'status': 'success', 'message': 'Bắt đầu luồng video'}), 200
+        session = externals['session_manager'].start(class_id, timetable_id, camera, foreign_fallback,
+                                                     data.get('session_id'))
+        logging.info(f'[{session.session_id}] Bắt đầu luồng video cho class_id: {class_id}')
+        return jsonify({'status': 'success', 'message': 'Bắt đầu luồng video',
+                        'session_id': session.session_id}), 200
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         logging.error(f'Lỗi khi bắt đầu luồng video: {str(e)}')
         return jsonify({'status': 'error', 'message': f'Lỗi khi bắt đầu luồng: {str(e)}'}), 500
@@ -147,51 +176,71 @@ def start_stream():
 # API dừng stream video
 @app.route('/api/stop_stream', methods=['POST'])
 def stop_stream():
+    data = request.get_json(silent=True) or {}
+    session, error = resolve_session(data.get('session_id'))
+    if error:
+        return error
     try:
-        from opencv_with_queue import stop_processing
-        stop_processing()
-        logging.info('Đã dừng luồng video')
+        externals['session_manager'].stop(session.session_id)
+        logging.info(f'[{session.session_id}] Đã dừng luồng video')
         return jsonify({'status': 'success', 'message': 'Đã dừng luồng video'}), 200
     except Exception as e:
         logging.error(f'Lỗi khi dừng luồng video: {str(e)}')
         return jsonify({'status': 'error', 'message': f'Lỗi khi dừng luồng: {str(e)}'}), 500
 
 
-# API kiểm tra trạng thái stream
+# API kiểm tra trạng thái stream (một phiên nếu có session_id, không thì toàn bộ)
 @app.route('/api/stream_status', methods=['GET'])
 def stream_status():
+    if 'session_manager' not in externals:
+        return jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500
+    session_id = request.args.get('session_id')
     try:
-        from opencv_with_queue import processing_active
-        logging.info(f'Trạng thái luồng video: {processing_active}')
-        return jsonify({'status': 'success', 'is_streaming': processing_active}), 200
+        if session_id is not None:
+            session, error = resolve_session(session_id)
+            if error:
+                return error
+            return jsonify({'status': 'success', 'is_streaming': session.active, 'session': session.stats()}), 200
+        manager = externals['session_manager']
+        is_streaming = manager.is_active()
+        logging.info(f'Trạng thái luồng video: {is_streaming}')
+        return jsonify({'status': 'success', 'is_streaming': is_streaming, 'sessions': manager.list_sessions()}), 200
     except Exception as e:
         logging.error(f'Lỗi khi kiểm tra trạng thái luồng: {str(e)}')
         return jsonify({'status': 'error', 'message': f'Lỗi khi kiểm tra trạng thái: {str(e)}'}), 500
 
 
-# Hàm tạo frame cho stream video
-def gen_frames():
-    if 'frame_queue' not in externals:
-        logging.error('frame_queue chưa được khởi tạo')
-        raise RuntimeError("frame_queue chưa được khởi tạo!")
-    while True:
-        try:
-            frame = externals['frame_queue'].get(timeout=0.1)
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes() #encode thành ảnh JPEG
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        except queue.Empty:
-            continue
-        except Exception as e:
-            logging.error(f'Error in gen_frames: {str(e)}')
-            break
-
-
-# API stream video
+# Hàm tạo frame cho stream video của một phiên
+def gen_frames(session, rendition):
+    # Mỗi người xem chỉ nhận chunk đã mã hóa sẵn của bản stream mình chọn, không tự mã hóa
+    try:
+        yield from session.encoder.frames(rendition, lambda: session.active)
+    except Exception as e:
+        logging.error(f'Error in gen_frames: {str(e)}')
+
+
+# API stream video: /stream?session_id=...&rendition=full|low
 @app.route('/stream')
 def stream():
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    session, error = resolve_session(request.args.get('session_id'))
+    if error:
+        return error
+    rendition = request.args.get('rendition', 'full')
+    if session.encoder.get(rendition) is None:
+        return jsonify({'status': 'error', 'message': f'Không có bản stream {rendition}'}), 400
+    return Response(gen_frames(session, rendition), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+# Sự kiện điểm danh (SSE) thay cho hỏi /api/recognize định kỳ: /api/recognition_events?session_id=...
+# Kết nối lại tự gửi Last-Event-ID (hoặc ?since=<seq>) để nhận tiếp từ sự kiện cuối cùng
+@app.route('/api/recognition_events')
+def recognition_events():
+    session, error = resolve_session(request.args.get('session_id'))
+    if error:
+        return error
+    last_seq = parse_last_seq(request.headers.get('Last-Event-ID', request.args.get('since')))
+    return Response(iter_sse(session.events, session.snapshot_event, lambda: session.active, last_seq),
+                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 # Hàm kết nối database
@@ -450,9 +499,10 @@ def get_attendance_sessions(timetable_id):
 # Khởi động server
 if __name__ == '__main__':
     try:
-        from opencv_with_queue import frame_queue, recognized_faces
+        from opencv_with_queue import session_manager, face_app, gallery_holder
+        from enroller import Enroller
 
-        set_externals(frame_queue, recognized_faces)
+        set_externals(session_manager, Enroller(face_app, on_update=gallery_holder.reload))
         logging.info('Khởi động server Flask...')
         app.run(debug=False, threaded=True, host='0.0.0.0', port=5000)
     except Exception as e:
@@ -0,0 +1,193 @@
+import math
+import struct
+import threading
+import time
+from jpeg_codec import decode_jpeg
+
+# Giao thức nhận khung hình nhị phân từ trình duyệt (Socket.IO, payload bytes, không base64):
+#  1. client gửi 'ingest_hello' {width, height, fps, formats: ['webp', 'jpeg']}
+#  2. server trả 'ingest_config' {width, height, fps, format, credits, header}: client thu nhỏ khung hình
+#     về đúng kích thước này (không gửi nhiều điểm ảnh hơn detector dùng) và giới hạn fps
+#  3. mỗi khung hình: 'ingest_frame' = header HEADER (big-endian) + bytes JPEG/WebP
+#       seq uint32 | thời điểm chụp float64 (giây, epoch) | rộng uint16 | cao uint16 | định dạng uint8
+#  4. mỗi khung hình tiêu tốn một credit; server trả 'ingest_credit' {grant: 1, seq} khi đã lấy khung hình
+#     ra xử lý. Client hết credit thì chờ (không gửi), nên server không phải âm thầm bỏ khung hình
+#  5. hàng đợi xử lý đầy (nhiều client): khung hình được giữ lại (park) và credit vẫn tính là đang dùng,
+#     process_frames đưa nó vào hàng đợi khi có chỗ. Khung hình giữ lại bị khung mới hơn thay thế thì
+#     credit của nó chỉ được trả khi khung mới vào hàng đợi, nên client vẫn bị giới hạn theo tốc độ xử lý
+HEADER = struct.Struct('!IdHHB')
+FORMATS = {0: 'jpeg', 1: 'webp'}
+FORMAT_IDS = {name: code for code, name in FORMATS.items()}
+
+INGEST_MAX_SIDE = 640  # Cạnh dài tối đa, bằng det_size của detector
+INGEST_MAX_FPS = 15
+INGEST_CREDITS = 2  # Số khung hình một client được gửi trước khi server xác nhận
+
+
+def pack_frame(seq, timestamp, width, height, fmt, payload):
+    return HEADER.pack(seq & 0xFFFFFFFF, timestamp, width, height, FORMAT_IDS[fmt]) + bytes(payload)
+
+
+def unpack_frame(data):
+    # Trả về (seq, timestamp, rộng, cao, định dạng, payload); ValueError nếu khung hình không hợp lệ
+    if not isinstance(data, (bytes, bytearray, memoryview)) or len(data) <= HEADER.size:
+        raise ValueError("Khung hình nhị phân không hợp lệ")
+    seq, timestamp, width, height, fmt = HEADER.unpack_from(data)
+    if fmt not in FORMATS:
+        raise ValueError(f"Định dạng khung hình không hỗ trợ: {fmt}")
+    return seq, timestamp, width, height, FORMATS[fmt], memoryview(data)[HEADER.size:]
+
+
+def _positive(value, default):
+    # Giá trị số client gửi lên: thiếu, không phải số, không hữu hạn hoặc <= 0 thì dùng giá trị mặc định
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return default
+    if not math.isfinite(value) or value <= 0:
+        return default
+    return value
+
+
+def negotiate(offer, max_side=INGEST_MAX_SIDE, max_fps=INGEST_MAX_FPS, credits=INGEST_CREDITS):
+    # Kích thước đích giữ tỉ lệ khung hình của client, cạnh dài không quá max_side (không phóng to).
+    # ValueError nếu offer không phải object; từng trường không hợp lệ thì dùng giá trị mặc định
+    if not isinstance(offer, dict):
+        raise ValueError("ingest_hello phải là object {width, height, fps, formats}")
+    width = max(1, round(_positive(offer.get('width'), max_side)))
+    height = max(1, round(_positive(offer.get('height'), max_side * 3 // 4)))
+    ratio = min(1.0, max_side / max(width, height))
+    fps = min(_positive(offer.get('fps'), max_fps), float(max_fps))
+    formats = offer.get('formats')
+    if not isinstance(formats, (list, tuple)):
+        formats = ['jpeg']
+    fmt = 'webp' if 'webp' in formats else 'jpeg'  # WebP nhỏ hơn JPEG cùng chất lượng
+    return {
+        'width': max(2, round(width * ratio) // 2 * 2),
+        'height': max(2, round(height * ratio) // 2 * 2),
+        'fps': fps,
+        'format': fmt,
+        'credits': credits,
+        'header': {'format': HEADER.format, 'size': HEADER.size, 'formats': FORMAT_IDS},
+    }
+
+
+class IngestClient:
+    # Trạng thái của một client gửi khung hình: cấu hình đã thỏa thuận, credit còn lại và số liệu
+    def __init__(self, sid, config):
+        self.sid = sid
+        self.config = config
+        self.credits = config['credits']
+        self.lock = threading.Lock()
+        self.received = 0
+        self.overruns = 0  # Khung hình gửi khi đã hết credit (client không tuân thủ giao thức)
+        self.oversize = 0  # Khung hình lớn hơn kích thước đã thỏa thuận
+        self.bytes = 0
+        self.decode_time = 0.0
+        self.latency = 0.0
+        self.last_seq = None
+        self.parked = None  # (seq, khung hình) chờ chỗ trong hàng đợi xử lý
+        self.held = 0  # Credit của khung hình giữ lại đã bị thay thế, trả khi khung mới vào hàng đợi
+        self.replaced = 0
+
+    def take_credit(self):
+        with self.lock:
+            if self.credits <= 0:
+                self.overruns += 1
+                return False
+            self.credits -= 1
+            return True
+
+    def return_credit(self, count=1):
+        with self.lock:
+            self.credits = min(self.credits + count, self.config['credits'])
+            return self.credits
+
+    def park(self, seq, frame):
+        # Hàng đợi đầy: chỉ giữ khung hình mới nhất, credit của khung cũ bị thay thế vẫn giữ lại
+        with self.lock:
+            if self.parked is not None:
+                self.held += 1
+                self.replaced += 1
+            self.parked = (seq, frame)
+
+    def requeue(self, put):
+        # Đưa khung hình đang giữ vào hàng đợi bằng put (queue.Full lan ra ngoài, khung hình vẫn được giữ);
+        # trả về số credit giữ lại cần trả cho client, None nếu không có khung hình nào
+        with self.lock:
+            if self.parked is None:
+                return None
+            seq, frame = self.parked
+            put((self.sid, seq, frame))
+            held = self.held
+            self.parked, self.held = None, 0
+            return held
+
+    def decode(self, data):
+        # Giải mã một khung hình nhị phân; khung hình quá cỡ được thu nhỏ ngay khi giải mã (miền DCT)
+        seq, timestamp, width, height, fmt, payload = unpack_frame(data)
+        start = time.perf_counter()
+        frame = decode_jpeg(payload, max(self.config['width'], self.config['height']))
+        elapsed = time.perf_counter() - start
+        if frame is None:
+            raise ValueError(f"Không giải mã được khung hình {seq}")
+        with self.lock:
+            self.received += 1
+            self.bytes += len(payload)
+            self.decode_time += elapsed
+            if width > self.config['width'] or height > self.config['height']:
+                self.oversize += 1
+            if timestamp:
+                self.latency = time.time() - timestamp
+            self.last_seq = seq
+        return seq, frame
+
+    def stats(self):
+        with self.lock:
+            received = self.received
+            return {
+                'config': {k: self.config[k] for k in ('width', 'height', 'fps', 'format')},
+                'credits': self.credits,
+                'received': received,
+                'overruns': self.overruns,
+                'oversize': self.oversize,
+                'parked': self.parked is not None,
+                'replaced': self.replaced,
+                'mean_bytes': round(self.bytes / received) if received else 0,
+                'mean_decode_ms': round(self.decode_time * 1000 / received, 2) if received else 0.0,
+                'latency_ms': round(self.latency * 1000, 1),
+                'last_seq': self.last_seq,
+            }
+
+
+class IngestRegistry:
+    # Các client đang gửi khung hình, theo sid của Socket.IO
+    def __init__(self, max_side=INGEST_MAX_SIDE, max_fps=INGEST_MAX_FPS, credits=INGEST_CREDITS):
+        self.max_side = max_side
+        self.max_fps = max_fps
+        self.credits = credits
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def open(self, sid, offer):
+        client = IngestClient(sid, negotiate(offer or {}, self.max_side, self.max_fps, self.credits))
+        with self._lock:
+            self._clients[sid] = client
+        return client
+
+    def get(self, sid):
+        with self._lock:
+            return self._clients.get(sid)
+
+    def close(self, sid):
+        with self._lock:
+            return self._clients.pop(sid, None)
+
+    def parked(self):
+        with self._lock:
+            return [client for client in self._clients.values() if client.parked is not None]
+
+    def stats(self):
+        with self._lock:
+            clients = list(self._clients.values())
+        return {client.sid: client.stats() for client in clients}
@@ -0,0 +1,195 @@
+import threading
+import numpy as np
+
+
+class FrameHandle:
+    # Tham chiếu tới một ô của FrameRing. Ô không bị ghi đè cho tới khi mọi handle được release()
+    def __init__(self, ring, index, seq=0, timestamp=0.0):
+        self.ring = ring
+        self.index = index
+        self.seq = seq
+        self.timestamp = timestamp
+        self._released = False
+
+    @property
+    def array(self):
+        return self.ring._buffers[self.index]
+
+    def retain(self):
+        # Thêm một tham chiếu cho tầng khác (vd. một người xem nữa) dùng chung ô này
+        return self.ring._retain(self)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.ring._release(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class FrameRing:
+    # Vòng đệm khung hình cấp phát sẵn giữa capture, nhận diện và mã hóa MJPEG:
+    #  - writer lấy ô trống bằng acquire(), đọc thẳng vào đó (cap.read(image=handle.array)),
+    #    vẽ overlay rồi publish(); không cấp phát mảng mới cho mỗi khung hình
+    #  - kênh "giá trị mới nhất": vòng đệm chỉ giữ khung hình publish sau cùng, mỗi người xem chờ
+    #    latest(seq đã nhận) để lấy phiên bản mới hơn, không bao giờ nhận khung hình cũ hay trùng
+    #  - tầng sau giữ handle có đếm tham chiếu, ô chỉ được tái sử dụng khi không còn ai giữ;
+    #    nhiều người xem cùng một khung hình dùng chung một ô
+    #  - writer không bao giờ chờ: khung hình mới thay khung hình cũ chưa ai đọc,
+    #    mọi ô đều đang bị giữ thì acquire() trả về None (bỏ khung hình hiện tại)
+    def __init__(self, shape, dtype=np.uint8, slots=4, seq=0):
+        # seq: tiếp nối số thứ tự của vòng đệm cũ khi dựng lại, để seq người xem đang giữ vẫn hợp lệ
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._buffers = [np.empty(self.shape, self.dtype) for _ in range(slots)]
+        self._refs = [0] * slots
+        self._seqs = [0] * slots
+        self._times = [0.0] * slots
+        self._latest = None  # Ô publish sau cùng, vòng đệm giữ 1 tham chiếu tới ô này
+        self._cond = threading.Condition()
+        self._seq = seq
+        self.dropped = 0
+
+    @property
+    def slots(self):
+        return len(self._buffers)
+
+    def _free_slot(self):
+        for index, refs in enumerate(self._refs):
+            if refs == 0:
+                return index
+        return None
+
+    def acquire(self):
+        with self._cond:
+            index = self._free_slot()
+            if index is None:
+                self.dropped += 1
+                return None
+            self._refs[index] = 1
+            return FrameHandle(self, index)
+
+    def publish(self, handle, timestamp=0.0):
+        # Tham chiếu của writer chuyển cho vòng đệm; writer không được ghi vào ô này nữa.
+        # Ô publish trước đó được trả lại (còn người xem đang giữ thì chưa bị ghi đè)
+        with self._cond:
+            self._seq += 1
+            handle.seq = self._seqs[handle.index] = self._seq
+            handle.timestamp = self._times[handle.index] = timestamp
+            handle._released = True
+            if self._latest is not None:
+                self._refs[self._latest] -= 1
+            self._latest = handle.index
+            self._cond.notify_all()
+        return handle.seq
+
+    def latest(self, after_seq=0, timeout=None):
+        # Chờ khung hình mới hơn after_seq rồi trả về handle của khung hình mới nhất
+        # (người gọi phải release()); hết thời gian chờ thì trả về None
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > after_seq, timeout):
+                return None
+            index = self._latest
+            self._refs[index] += 1
+            return FrameHandle(self, index, self._seqs[index], self._times[index])
+
+    def _retain(self, handle):
+        with self._cond:
+            self._refs[handle.index] += 1
+            return FrameHandle(self, handle.index, handle.seq, handle.timestamp)
+
+    def _release(self, index):
+        with self._cond:
+            self._refs[index] -= 1
+
+    @property
+    def seq(self):
+        return self._seq
+
+
+class ValueHandle:
+    # Handle cho giá trị của LatestChannel, cùng giao diện với FrameHandle (bộ nhớ không bị dùng lại nên
+    # release() không cần làm gì)
+    def __init__(self, value, seq, timestamp):
+        self.array = value
+        self.seq = seq
+        self.timestamp = timestamp
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+class LatestChannel:
+    # Kênh "giá trị mới nhất" cho dữ liệu không dùng lại bộ nhớ (bytes JPEG, mảng mới mỗi khung hình):
+    # bên xử lý publish một giá trị mỗi nhịp, mỗi người xem chờ phiên bản mới hơn phiên bản đã nhận.
+    # Thêm người xem không tốn thêm suy luận và không tranh giá trị với nhau như khi dùng chung hàng đợi
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._value = None
+        self._timestamp = 0.0
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def publish(self, value, timestamp=0.0):
+        with self._cond:
+            self._seq += 1
+            self._value = value
+            self._timestamp = timestamp
+            self._cond.notify_all()
+            return self._seq
+
+    def wait(self, after_seq=0, timeout=None):
+        # Trả về (seq, giá trị) mới hơn after_seq, hoặc (after_seq, None) khi hết thời gian chờ
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > after_seq, timeout):
+                return after_seq, None
+            return self._seq, self._value
+
+    def latest(self, after_seq=0, timeout=None):
+        # Như FrameRing.latest(): handle của giá trị mới hơn after_seq, hoặc None khi hết thời gian chờ
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > after_seq, timeout):
+                return None
+            return ValueHandle(self._value, self._seq, self._timestamp)
+
+
+def read_frame(cap, ring, slots=4):
+    # Đọc thẳng vào ô trống của vòng đệm (cap.read(image=...)), không cấp phát mảng mới cho mỗi
+    # khung hình. Vòng đệm được tạo theo kích thước khung hình đầu tiên và dựng lại nếu kích thước
+    # đổi. Trả về (thành công, handle, ring); handle None nghĩa là bỏ khung hình này
+    if ring is None:
+        success, frame = cap.read()
+        if not success:
+            return False, None, ring
+        ring = FrameRing(frame.shape, frame.dtype, slots)
+        handle = ring.acquire()
+        np.copyto(handle.array, frame)
+        return True, handle, ring
+    handle = ring.acquire()
+    if handle is None:
+        # Mọi ô đều đang bị giữ: vẫn lấy khung hình khỏi camera nhưng không giải mã
+        return cap.grab(), None, ring
+    success, frame = cap.read(image=handle.array)
+    if not success:
+        handle.release()
+        return False, None, ring
+    if frame is not handle.array:
+        handle.release()
+        ring = FrameRing(frame.shape, frame.dtype, slots, ring.seq)
+        handle = ring.acquire()
+        np.copyto(handle.array, frame)
+    return True, handle, ring
+
@@ -0,0 +1,265 @@
+import os
+import threading
+import time
+import numpy as np
+from face_index import EMBEDDING_DIM, FlatIndex, make_index
+from embedding_store import EmbeddingStore, load_embeddings
+
+# Loại index của gallery cho các server, chọn qua biến môi trường GALLERY_INDEX (mặc định 'flat'):
+#  - 'flat': tìm kiếm chính xác, phù hợp vài nghìn embeddings
+#  - 'flat_fp16' / 'flat_int8': flat lượng tử hóa, giảm 2x / 4x bộ nhớ, xếp hạng lại top-k bằng float32
+#  - 'ivf' / 'hnsw': tìm kiếm xấp xỉ cho gallery lớn (hnsw cần hnswlib)
+GALLERY_INDEX = os.environ.get('GALLERY_INDEX', 'flat')
+
+
+class FaceGallery:
+    # Gom toàn bộ embeddings {tên: [emb, ...]} vào một index (mặc định là ma trận float32
+    # liên tục, tìm kiếm chính xác) cùng một mảng nhãn int theo id, để so khớp tất cả
+    # khuôn mặt của một khung hình trong một lần tìm kiếm
+    def __init__(self, embeddings=None, index="flat", **index_params):
+        self.names = []
+        self._label_of = {}  # tên -> nhãn
+        self._id_labels = np.zeros(0, dtype=np.int32)  # id -> nhãn, -1 nếu đã xóa
+        self.index = make_index(index, dim=EMBEDDING_DIM, **index_params)
+        # Cache gallery con: class_id -> (tập sinh viên, gallery con)
+        self._class_galleries = {}
+        # Cache gallery con chỉ gồm sinh viên chưa điểm danh: class_id -> (tập sinh viên, tập đã điểm danh, gallery)
+        self._remaining_galleries = {}
+
+        row_names = []
+        rows = []
+        for person_name, person_embs in (embeddings or {}).items():
+            for emb in person_embs:
+                row_names.append(person_name)
+                rows.append(np.asarray(emb, dtype=np.float32).ravel())
+        if rows:
+            self._add_rows(row_names, np.vstack(rows))
+
+    @classmethod
+    def from_file(cls, path, index="flat", **index_params):
+        if not os.path.exists(path):
+            return cls(index=index, **index_params)
+        embeddings = load_embeddings(path)
+        if isinstance(embeddings, EmbeddingStore):
+            return cls.from_store(embeddings, index=index, **index_params)
+        return cls(embeddings, index=index, **index_params)
+
+    @classmethod
+    def from_store(cls, store, index="flat", **index_params):
+        # Với index flat (kể cả bản lượng tử hóa), dùng thẳng ma trận float32 memmap của store
+        gallery = cls(index=index, **index_params)
+        if len(store.labels) == 0:
+            return gallery
+        if isinstance(gallery.index, FlatIndex) and store.matrix.dtype == np.float32:
+            gallery.names = list(store.names)
+            gallery._label_of = {name: label for label, name in enumerate(gallery.names)}
+            gallery._id_labels = np.array(store.labels, dtype=np.int32)
+            gallery.index.adopt(np.arange(len(store.labels), dtype=np.int64), store.matrix)
+        else:
+            gallery._add_rows([store.names[label] for label in store.labels], store.matrix)
+        return gallery
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def dim(self):
+        return self.index.dim
+
+    def _add_rows(self, row_names, vectors):
+        labels = []
+        for person_name in row_names:
+            label = self._label_of.get(person_name)
+            if label is None:
+                label = len(self.names)
+                self.names.append(person_name)
+                self._label_of[person_name] = label
+            labels.append(label)
+        start = self._id_labels.shape[0]
+        ids = np.arange(start, start + len(labels), dtype=np.int64)
+        self._id_labels = np.concatenate([self._id_labels, np.asarray(labels, dtype=np.int32)])
+        self.index.add(ids, vectors)
+        self._class_galleries.clear()
+        self._remaining_galleries.clear()
+        return ids
+
+    def add(self, person_name, person_embs):
+        # Thêm embeddings của một người (đăng ký mới hoặc bổ sung ảnh) mà không dựng lại index
+        vectors = np.asarray(person_embs, dtype=np.float32).reshape(-1, self.dim)
+        if vectors.shape[0] == 0:
+            return np.zeros(0, dtype=np.int64)
+        return self._add_rows([person_name] * vectors.shape[0], vectors)
+
+    def remove(self, person_name):
+        # Xóa toàn bộ embeddings của một người khỏi index
+        label = self._label_of.get(person_name)
+        if label is None:
+            return 0
+        ids = np.flatnonzero(self._id_labels == label)
+        self.index.remove(ids)
+        self._id_labels[ids] = -1
+        self._class_galleries.clear()
+        self._remaining_galleries.clear()
+        return ids.shape[0]
+
+    def subset(self, names):
+        # Tạo gallery con (tìm kiếm chính xác) chỉ gồm embeddings của những người trong names
+        keep = [self._label_of[name] for name in set(names) if name in self._label_of]
+        ids, vectors = self.index.items()
+        labels = self._id_labels[ids]
+        rows = np.isin(labels, keep)
+
+        sub = FaceGallery()
+        if rows.any():
+            sub._add_rows([self.names[label] for label in labels[rows]], vectors[rows])
+        return sub
+
+    def for_class(self, class_id, student_list):
+        # Gallery con của một lớp, tạo một lần rồi tái sử dụng cho cả buổi học.
+        # Sinh viên đã điểm danh vẫn nằm trong gallery: track mới của họ (quay mặt, mất dấu rồi
+        # xuất hiện lại) phải khớp đúng người, không thành "Unknown" hay khớp nhầm bạn cùng lớp.
+        # Danh sách lớp đổi (hoặc hai phiên truyền danh sách khác nhau) thì dựng lại gallery con
+        students = frozenset(student_list)
+        cached = self._class_galleries.get(class_id)
+        if cached is None or cached[0] != students:
+            cached = (students, self.subset(students))
+            self._class_galleries[class_id] = cached
+        return cached[1]
+
+    def remaining_for_class(self, class_id, student_list, resolved):
+        # Gallery con của lớp đã bỏ các dòng của sinh viên đã điểm danh: tập ứng viên thu hẹp dần
+        # khi lớp đến đủ. Dựng lại từ gallery con của lớp (vài chục dòng) mỗi khi có thêm người điểm danh
+        students = frozenset(student_list)
+        resolved = frozenset(resolved) & students
+        cached = self._remaining_galleries.get(class_id)
+        if cached is None or cached[0] != students or cached[1] != resolved:
+            cached = (students, resolved, self.for_class(class_id, students).subset(students - resolved))
+            self._remaining_galleries[class_id] = cached
+        return cached[2]
+
+    def search(self, query_embs, k=1):
+        # Trả về (điểm, nhãn) dạng (số truy vấn x k); nhãn -1 khi không có kết quả
+        query = np.asarray(query_embs, dtype=np.float32).reshape(-1, self.dim)
+        scores, ids = self.index.search(query, k)
+        labels = np.full(ids.shape, -1, dtype=np.int32)
+        found = ids >= 0
+        labels[found] = self._id_labels[ids[found]]
+        return scores, labels
+
+    def match(self, query_embs, threshold=0.5):
+        # Trả về danh sách (tên, độ tương đồng) cho từng embedding truy vấn
+        query = np.asarray(query_embs, dtype=np.float32).reshape(-1, self.dim)
+        if query.shape[0] == 0:
+            return []
+
+        scores, labels = self.search(query, 1)
+        results = []
+        for score, label in zip(scores[:, 0], labels[:, 0]):
+            if label < 0:
+                results.append(("Unknown", -1.0))
+                continue
+            name = self.names[label] if score >= threshold else "Unknown"
+            results.append((name, float(score)))
+        return results
+
+    def match_class(self, query_embs, class_id, student_list, threshold=0.5, foreign_fallback=False,
+                    resolved=None):
+        # Chỉ so khớp với sinh viên của lớp; nếu bật foreign_fallback thì những khuôn mặt
+        # không khớp sẽ được tra tiếp trên toàn trường.
+        # resolved: sinh viên đã điểm danh, dòng của họ bị loại khỏi lần tìm đầu tiên. Khuôn mặt không
+        # khớp ai trong số còn lại (thường là sinh viên đã điểm danh quay lại, track mới) mới được tra
+        # lại trên cả gallery con của lớp
+        query = np.asarray(query_embs, dtype=np.float32).reshape(-1, self.dim)
+        if resolved:
+            results = self.remaining_for_class(class_id, student_list, resolved).match(query, threshold)
+            unknown = [i for i, (name, _) in enumerate(results) if name == "Unknown"]
+            if unknown:
+                class_gallery = self.for_class(class_id, student_list)
+                for i, result in zip(unknown, class_gallery.match(query[unknown], threshold)):
+                    results[i] = result
+        else:
+            results = self.for_class(class_id, student_list).match(query, threshold)
+        if foreign_fallback:
+            unknown = [i for i, (name, _) in enumerate(results) if name == "Unknown"]
+            if unknown:
+                for i, result in zip(unknown, self.match(query[unknown], threshold)):
+                    if result[0] != "Unknown":
+                        results[i] = result
+        return results
+
+    def match_faces(self, faces, threshold=0.5, class_id=None, student_list=None, foreign_fallback=False,
+                    resolved=None):
+        # Tiện ích cho kết quả face_app.get(): so khớp toàn bộ khuôn mặt của một khung hình.
+        # Khi có lớp thì chỉ tìm trong gallery con của lớp; không có lớp (class_id None,
+        # get_student_list trả về []) thì tìm trên toàn trường
+        if not faces:
+            return []
+        query = np.stack([face.normed_embedding for face in faces])
+        if class_id is None or student_list is None:
+            return self.match(query, threshold)
+        return self.match_class(query, class_id, student_list, threshold, foreign_fallback, resolved)
+
+
+class GalleryHolder:
+    # Giữ gallery hiện tại theo kiểu copy-on-write: luồng nhận diện chỉ đọc thuộc tính
+    # current (không cần khóa), còn khi dữ liệu thay đổi thì dựng một FaceGallery mới
+    # rồi thay thế nguyên khối. Snapshot đã công bố không bao giờ bị sửa
+    def __init__(self, path, index="flat", poll_interval=1.0, **index_params):
+        self.path = path
+        self.index = index
+        self.index_params = index_params
+        self.poll_interval = poll_interval
+        self.version = 0
+        self._lock = threading.Lock()  # Chỉ dùng cho phía ghi
+        self._watch_thread = None
+        self._file_state = self._stat()
+        self.current = self._load()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        gallery = FaceGallery.from_file(self.path, index=self.index, **self.index_params)
+        gallery.version = self.version
+        return gallery
+
+    def publish(self, gallery):
+        # Công bố một snapshot mới; các luồng đang dùng snapshot cũ vẫn chạy bình thường
+        with self._lock:
+            self.version += 1
+            gallery.version = self.version
+            self.current = gallery
+        print(f"Đã nạp gallery phiên bản {self.version}: {len(gallery)} embeddings (index {self.index})")
+
+    def reload(self):
+        with self._lock:
+            state = self._stat()
+            try:
+                gallery = FaceGallery.from_file(self.path, index=self.index, **self.index_params)
+            except Exception as e:
+                print(f"Lỗi khi nạp lại {self.path}: {e}")
+                return False
+            self._file_state = state
+        self.publish(gallery)
+        return True
+
+    def check(self):
+        # Nạp lại nếu file embeddings đã thay đổi (mtime hoặc kích thước)
+        if self._stat() != self._file_state:
+            return self.reload()
+        return False
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.check()
+
+    def start_watching(self):
+        if self._watch_thread is None:
+            self._watch_thread = threading.Thread(target=self._watch, daemon=True)
+            self._watch_thread.start()
+        return self
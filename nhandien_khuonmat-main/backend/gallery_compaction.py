@@ -0,0 +1,135 @@
+import sys
+import numpy as np
+from embedding_store import load_embeddings, write_store
+
+# Thu gọn gallery: mỗi học sinh chỉ còn một vài embedding đại diện (prototype) thay vì
+# một embedding cho mỗi ảnh, nên chi phí so khớp tỉ lệ với số học sinh chứ không phải số ảnh.
+# Trước khi gộp sẽ bỏ ảnh gần như trùng nhau và ảnh ngoại lai (cắt sai, không phải người đó).
+
+
+def _normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def drop_duplicates(embs, dedup_threshold):
+    # Giữ ảnh đầu tiên, bỏ các ảnh có độ tương đồng > dedup_threshold với một ảnh đã giữ
+    kept = []
+    for i in range(embs.shape[0]):
+        if not kept or (embs[kept] @ embs[i]).max() <= dedup_threshold:
+            kept.append(i)
+    return np.asarray(kept, dtype=np.int64)
+
+
+def find_outliers(embs, outlier_threshold):
+    # Ảnh ngoại lai: độ tương đồng với trung bình của các ảnh còn lại < outlier_threshold
+    n = embs.shape[0]
+    if n < 3:
+        return np.zeros(n, dtype=bool)
+    rest_means = _normalize(embs.sum(axis=0)[None, :] - embs)
+    sims = np.einsum("nd,nd->n", embs, rest_means)
+    outliers = sims < outlier_threshold
+    if outliers.all():
+        outliers[sims.argmax()] = False
+    return outliers
+
+
+def k_medoids(embs, k, n_iter=20):
+    # k-medoids theo khoảng cách cosine, khởi tạo kiểu k-means++ tất định (điểm xa nhất)
+    sims = embs @ embs.T
+    medoids = [int(sims.sum(axis=1).argmax())]
+    while len(medoids) < k:
+        medoids.append(int(sims[:, medoids].max(axis=1).argmin()))
+    medoids = np.asarray(medoids)
+    for _ in range(n_iter):
+        assign = sims[:, medoids].argmax(axis=1)
+        new_medoids = medoids.copy()
+        for c in range(k):
+            members = np.flatnonzero(assign == c)
+            if members.shape[0]:
+                new_medoids[c] = members[sims[np.ix_(members, members)].sum(axis=1).argmax()]
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+    return embs[medoids]
+
+
+def _genuine_stats(embs, refs, leave_one_out):
+    # Độ tương đồng tốt nhất của từng ảnh với tập tham chiếu của chính người đó
+    sims = embs @ refs.T
+    if leave_one_out:
+        if refs.shape[0] < 2:
+            return None
+        np.fill_diagonal(sims, -np.inf)
+    best = sims.max(axis=1)
+    return float(best.mean()), float(best.min())
+
+
+def compact_embeddings(embeddings, method="mean", max_prototypes=1,
+                       dedup_threshold=0.98, outlier_threshold=0.3):
+    # Trả về ({tên: [prototype, ...]}, báo cáo theo từng người).
+    # method="mean": trung bình đã chuẩn hóa lại; method="medoids": k-medoids với k=max_prototypes
+    if method not in ("mean", "medoids"):
+        raise ValueError(f"Phương pháp thu gọn không hợp lệ: {method} (hỗ trợ: mean, medoids)")
+    compacted = {}
+    report = {}
+    for person_name, person_embs in embeddings.items():
+        embs = _normalize(np.asarray(person_embs, dtype=np.float32).reshape(len(person_embs), -1))
+        if embs.shape[0] == 0:
+            continue
+        kept = embs[drop_duplicates(embs, dedup_threshold)]
+        outliers = find_outliers(kept, outlier_threshold)
+        clean = kept[~outliers]
+
+        if method == "mean" or clean.shape[0] <= max_prototypes:
+            prototypes = clean if method == "medoids" else _normalize(clean.mean(axis=0, keepdims=True))
+        else:
+            prototypes = k_medoids(clean, max_prototypes)
+        compacted[person_name] = list(prototypes.astype(np.float32))
+        report[person_name] = {
+            "images": embs.shape[0],
+            "duplicates": embs.shape[0] - kept.shape[0],
+            "outliers": int(outliers.sum()),
+            "prototypes": prototypes.shape[0],
+            # Trước: mỗi ảnh so với ảnh khác tốt nhất của cùng người; sau: so với prototype gần nhất
+            "before": _genuine_stats(embs, embs, leave_one_out=True),
+            "after": _genuine_stats(clean, prototypes, leave_one_out=False),
+        }
+
+    # Người khác giống nhất sau khi thu gọn (biên an toàn so với ngưỡng nhận diện)
+    names = list(compacted)
+    if len(names) > 1:
+        protos = np.vstack([np.stack(compacted[name]) for name in names])
+        owner = np.repeat(np.arange(len(names)), [len(compacted[name]) for name in names])
+        sims = protos @ protos.T
+        sims[owner[:, None] == owner[None, :]] = -np.inf
+        for label, name in enumerate(names):
+            report[name]["nearest_other"] = float(sims[owner == label].max())
+    return compacted, report
+
+
+def print_report(report):
+    def fmt(stats):
+        return "     -      -" if stats is None else f"{stats[0]:6.3f} {stats[1]:6.3f}"
+
+    print(f"{'học sinh':<16}{'ảnh':>5}{'trùng':>6}{'lạ':>4}{'proto':>6}"
+          f"{'trước TB/min':>15}{'sau TB/min':>15}{'gần nhất khác':>15}")
+    for name, r in report.items():
+        nearest = r.get("nearest_other")
+        nearest = f"{nearest:15.3f}" if nearest is not None else f"{'-':>15}"
+        print(f"{name:<16}{r['images']:>5}{r['duplicates']:>6}{r['outliers']:>4}{r['prototypes']:>6}"
+              f"  {fmt(r['before'])}  {fmt(r['after'])}{nearest}")
+    total_in = sum(r["images"] for r in report.values())
+    total_out = sum(r["prototypes"] for r in report.values())
+    print(f"Tổng: {total_in} embeddings -> {total_out} prototype")
+
+
+if __name__ == '__main__':
+    # python gallery_compaction.py face_embeddings.emb face_embeddings_compact.emb [mean|medoids] [số prototype]
+    if len(sys.argv) < 3:
+        print("Cách dùng: python gallery_compaction.py <file .emb/.pkl> <file .emb> [mean|medoids] [số prototype]")
+        sys.exit(1)
+    method = sys.argv[3] if len(sys.argv) > 3 else "mean"
+    max_prototypes = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    compacted, report = compact_embeddings(load_embeddings(sys.argv[1]), method, max_prototypes)
+    print_report(report)
+    write_store(sys.argv[2], compacted)
@@ -0,0 +1,319 @@
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import shared_memory
+import numpy as np
+from insightface.app.common import Face
+from face_pipeline import align_faces, embed_crops, faces_from_detections
+from model_loader import load_face_app
+
+# Chế độ nhiều tiến trình cho máy chỉ có CPU: InferenceService chạy mọi phiên trên một luồng sau GIL,
+# InferencePool khởi động N tiến trình worker, mỗi worker có bản model riêng và được ghim vào một
+# nhóm lõi CPU (số luồng ONNX Runtime bằng số lõi của nhóm). Khung hình không bị pickle: mỗi phiên
+# có một vùng shared_memory, chỉ tên vùng nhớ, kích thước và điểm mốc (vài trăm byte) đi qua hàng đợi.
+# Phiên được gán cố định cho worker đang ít tải nhất khi mở.
+READY_TIMEOUT = 300.0  # Giây chờ một worker nạp xong model
+LOAD_WINDOW = 5.0  # Cửa sổ (giây) tính mức bận của worker
+CHECK_INTERVAL = 1.0  # Giây giữa hai lần kiểm tra worker còn sống
+REQUEST_TIMEOUT = 30.0  # Giây chờ tối đa một kết quả, quá hạn thì báo lỗi thay vì chặn mãi
+
+
+def split_cores(num_workers, cores=None):
+    # Chia các lõi CPU được phép dùng thành num_workers nhóm liền nhau; ít lõi hơn worker thì dùng chung
+    if cores is None:
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+    if num_workers <= len(cores):
+        return [[int(c) for c in part] for part in np.array_split(cores, num_workers)]
+    return [[cores[i % len(cores)]] for i in range(num_workers)]
+
+
+def worker_main(index, cores, model_name, det_size, det_thresh, requests, results):
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    # Hồ sơ 'cpu_worker': số luồng ONNX Runtime bằng số lõi được ghim, tránh N worker x số lõi máy luồng tranh nhau
+    face_app = load_face_app(model_name, det_size, det_thresh, profile='cpu_worker', threads=max(1, len(cores)))
+    results.put(('ready', index, os.getpid()))
+    buffers = {}  # Vùng nhớ của các phiên đã gắn, theo tên
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        req_id, kind, name, shape, payload = message
+        if kind == 'release':
+            shm = buffers.pop(name, None)
+            if shm is not None:
+                shm.close()
+            continue
+        start = time.perf_counter()
+        try:
+            if name not in buffers:
+                # Worker dùng chung resource tracker với tiến trình chính (spawn), vùng nhớ chỉ bị hủy
+                # khi phiên unlink, kể cả lúc worker chết giữa chừng
+                buffers[name] = shared_memory.SharedMemory(name=name)
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=buffers[name].buf)
+            if kind == 'detect':
+                result = face_app.det_model.detect(frame, max_num=0, metric='default')
+            else:
+                faces = [Face(kps=kps) for kps in payload]
+                result = embed_crops(face_app, align_faces(face_app, frame, faces))
+            error = None
+        except Exception as e:
+            result, error = None, f"{type(e).__name__}: {e}"
+        results.put(('result', index, req_id, result, error, time.perf_counter() - start))
+    for shm in buffers.values():
+        shm.close()
+
+
+class PoolWorker:
+    # Trạng thái phía tiến trình chính của một worker
+    def __init__(self, index, cores):
+        self.index = index
+        self.cores = cores
+        self.process = None
+        self.requests = None
+        self.pid = None
+        self.ready = threading.Event()
+        self.sessions = 0
+        self.pending = 0
+        self.completed = 0
+        self.errors = 0
+        self.restarts = 0
+        self.busy_time = 0.0
+        self.load = 0.0  # Tỉ lệ thời gian bận trong cửa sổ LOAD_WINDOW gần nhất
+        self._mark = (time.monotonic(), 0.0)
+
+    def update_load(self, now):
+        mark_time, mark_busy = self._mark
+        if now - mark_time >= LOAD_WINDOW:
+            self.load = (self.busy_time - mark_busy) / (now - mark_time)
+            self._mark = (now, self.busy_time)
+
+    def stats(self):
+        completed = self.completed
+        return {
+            'pid': self.pid,
+            'cores': self.cores,
+            'alive': self.process is not None and self.process.is_alive(),
+            'sessions': self.sessions,
+            'pending': self.pending,
+            'completed': completed,
+            'errors': self.errors,
+            'restarts': self.restarts,
+            'load': round(self.load, 3),
+            'mean_ms': round(self.busy_time * 1000 / completed, 2) if completed else 0.0,
+        }
+
+
+class PoolSession:
+    # Đầu mối của một phiên tới worker được gán, thay cho InferenceSession trong track_and_recognize.
+    # Mỗi phiên chỉ có một yêu cầu đang chạy nên một vùng shared_memory là đủ
+    def __init__(self, pool, session_id, worker):
+        self.pool = pool
+        self.session_id = session_id
+        self.worker = worker
+        self._shm = None
+        self._shape = None
+        self._staged = None  # Khung hình đang nằm trong vùng nhớ, dùng lại cho embed ngay sau detect
+
+    def _stage(self, frame):
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if self._shm is None or self._shm.size < frame.nbytes:
+            self._release_buffer()
+            self._shm = shared_memory.SharedMemory(create=True, size=frame.nbytes)
+        np.ndarray(frame.shape, dtype=np.uint8, buffer=self._shm.buf)[...] = frame
+        self._shape = frame.shape
+
+    def _release_buffer(self):
+        if self._shm is None:
+            return
+        self.pool.send(self.worker, (0, 'release', self._shm.name, None, None))
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def abandon_buffer(self):
+        # Yêu cầu quá hạn: worker có thể vẫn đang đọc vùng nhớ, không được ghi đè tại chỗ.
+        # Bỏ vùng nhớ này (lệnh release xếp sau yêu cầu đang chạy, ánh xạ của worker vẫn hợp lệ tới lúc đó),
+        # lần _stage sau cấp phát vùng mới
+        self._staged = None
+        self._release_buffer()
+
+    def detect(self, frame):
+        self._staged = None
+        self._stage(frame)
+        bboxes, kpss = self.pool.submit(self, 'detect')
+        self._staged = frame  # Chỉ dùng lại cho embed khi detect đã thành công
+        return faces_from_detections(bboxes, kpss)
+
+    def embed_faces(self, frame, faces):
+        # Căn chỉnh + ArcFace chạy trong worker trên khung hình đã chép cho detect, chỉ gửi điểm mốc
+        if self._staged is not frame:
+            self._stage(frame)
+        self._staged = None
+        kpss = np.stack([face.kps for face in faces]).astype(np.float32)
+        return self.pool.submit(self, 'embed', kpss)
+
+    def close(self):
+        self._release_buffer()
+        self.pool.close_session(self)
+
+
+class InferencePool:
+    # N tiến trình worker dùng chung cho mọi phiên của SessionManager (truyền vào thay cho InferenceService)
+    def __init__(self, num_workers, model_name="buffalo_l", det_size=(640, 640), det_thresh=0.6, cores=None):
+        self.model_name = model_name
+        self.det_size = det_size
+        self.det_thresh = det_thresh
+        self._ctx = mp.get_context('spawn')  # Không fork tiến trình đang có luồng và session ONNX
+        self._results = self._ctx.Queue()
+        self._lock = threading.Lock()
+        self._pending = {}  # req_id -> (Future, worker)
+        self._sessions = {}
+        self._ids = itertools.count(1)
+        self._closed = False
+        self.workers = [PoolWorker(i, group) for i, group in enumerate(split_cores(num_workers, cores))]
+        for worker in self.workers:
+            self._spawn(worker)
+        self._thread = threading.Thread(target=self._collect, daemon=True)
+        self._thread.start()
+        # Kiểm tra worker theo nhịp riêng: khi các worker khác vẫn trả kết quả liên tục,
+        # hàng đợi kết quả không bao giờ rỗng nên không thể dựa vào lúc _collect rảnh
+        self._monitor_thread = threading.Thread(target=self._monitor, daemon=True)
+        self._monitor_thread.start()
+        for worker in self.workers:
+            deadline = time.monotonic() + READY_TIMEOUT
+            while not worker.ready.wait(0.5):
+                if not worker.process.is_alive() or time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError(f"Worker suy luận {worker.index} không khởi động được")
+        print(f"InferencePool: {num_workers} worker, lõi {[w.cores for w in self.workers]}")
+
+    def _spawn(self, worker):
+        worker.ready.clear()
+        worker.requests = self._ctx.Queue()
+        worker.process = self._ctx.Process(
+            target=worker_main, name=f"inference-{worker.index}", daemon=True,
+            args=(worker.index, worker.cores, self.model_name, self.det_size, self.det_thresh,
+                  worker.requests, self._results))
+        worker.process.start()
+
+    def session(self, session_id=None):
+        if session_id is None:
+            session_id = f"session-{next(self._ids)}"
+        with self._lock:
+            # Worker bận ít nhất trong cửa sổ gần nhất, hòa thì worker ít phiên hơn
+            worker = min(self.workers, key=lambda w: (round(w.load, 1), w.sessions, w.pending))
+            worker.sessions += 1
+            session = PoolSession(self, session_id, worker)
+            self._sessions[session_id] = session
+        return session
+
+    def close_session(self, session):
+        with self._lock:
+            if self._sessions.get(session.session_id) is session:
+                del self._sessions[session.session_id]
+                session.worker.sessions -= 1
+
+    def send(self, worker, message):
+        worker.requests.put(message)
+
+    def submit(self, session, kind, payload=None):
+        # Chặn tới khi worker trả kết quả: (bboxes, kpss) cho detect, ma trận (N, 512) cho embed
+        future = Future()
+        worker = session.worker
+        req_id = next(self._ids)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("InferencePool đã đóng")
+            self._pending[req_id] = (future, worker)
+            worker.pending += 1
+        self.send(worker, (req_id, kind, session._shm.name, session._shape, payload))
+        try:
+            return future.result(REQUEST_TIMEOUT)
+        except FutureTimeout:
+            with self._lock:
+                if self._pending.pop(req_id, None) is not None:
+                    worker.pending -= 1
+            session.abandon_buffer()
+            raise RuntimeError(f"Worker suy luận {worker.index} không trả kết quả sau {REQUEST_TIMEOUT:.0f} giây")
+
+    def _collect(self):
+        while not self._closed:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if message[0] == 'ready':
+                _, index, pid = message
+                self.workers[index].pid = pid
+                self.workers[index].ready.set()
+                continue
+            _, index, req_id, result, error, elapsed = message
+            worker = self.workers[index]
+            with self._lock:
+                entry = self._pending.pop(req_id, None)
+                worker.pending -= entry is not None
+                worker.completed += 1
+                worker.errors += error is not None
+                worker.busy_time += elapsed
+                worker.update_load(time.monotonic())
+            if entry is None:
+                continue
+            if error is not None:
+                entry[0].set_exception(RuntimeError(error))
+            else:
+                entry[0].set_result(result)
+
+    def _monitor(self):
+        while not self._closed:
+            time.sleep(CHECK_INTERVAL)
+            self._check_workers()
+
+    def _check_workers(self):
+        # Worker chết (hết bộ nhớ, lỗi native): báo lỗi cho yêu cầu đang chờ rồi khởi động lại,
+        # các phiên giữ nguyên worker và vùng nhớ của mình. Worker chết trước khi nạp xong model
+        # không được khởi động lại (tránh vòng lặp khi model lỗi), yêu cầu gửi tới nó đều báo lỗi
+        now = time.monotonic()
+        for worker in self.workers:
+            with self._lock:
+                worker.update_load(now)
+            if self._closed or worker.process.is_alive():
+                continue
+            with self._lock:
+                failed = [req_id for req_id, (_, w) in self._pending.items() if w is worker]
+                entries = [self._pending.pop(req_id) for req_id in failed]
+                worker.pending = 0
+            for future, _ in entries:
+                future.set_exception(RuntimeError(f"Worker suy luận {worker.index} đã dừng"))
+            if worker.ready.is_set():
+                print(f"InferencePool: worker {worker.index} (pid {worker.pid}) đã dừng, khởi động lại")
+                worker.restarts += 1
+                self._spawn(worker)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            entries = list(self._pending.values())
+            self._pending.clear()
+        for future, _ in entries:
+            future.set_exception(RuntimeError("InferencePool đã đóng"))
+        for worker in self.workers:
+            worker.requests.put(None)
+        for worker in self.workers:
+            worker.process.join(5)
+
+    def stats(self):
+        # Số liệu cho /api/inference_stats: tải từng worker và worker được gán cho từng phiên
+        with self._lock:
+            return {
+                'workers': [worker.stats() for worker in self.workers],
+                'sessions': {session_id: {'worker': session.worker.index}
+                             for session_id, session in self._sessions.items()},
+            }
@@ -0,0 +1,215 @@
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+from face_pipeline import align_faces, detect_faces, embed_crops
+
+
+class InferenceOverloaded(RuntimeError):
+    # Yêu cầu bị bỏ vì phiên gửi nhanh hơn tốc độ xử lý (quá max_pending yêu cầu đang chờ)
+    pass
+
+
+class _Request:
+    def __init__(self, kind, payload):
+        self.kind = kind  # "detect": một khung hình, "embed": danh sách crop đã căn chỉnh
+        self.payload = payload
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+class InferenceSession:
+    # Đầu mối của một phiên (một lớp học / một camera) tới InferenceService,
+    # dùng được ở mọi chỗ nhận batcher/client trong face_pipeline và face_tracker
+    def __init__(self, service, session_id):
+        self.service = service
+        self.session_id = session_id
+
+    def detect(self, frame):
+        return self.service.submit(self.session_id, "detect", frame)
+
+    def embed(self, crops):
+        if not crops:
+            return embed_crops(self.service.face_app, [])
+        return self.service.submit(self.session_id, "embed", crops)
+
+    def embed_faces(self, frame, faces):
+        # Căn chỉnh trong luồng gọi, chỉ ArcFace đi qua lô dùng chung
+        return self.embed(align_faces(self.service.face_app, frame, faces))
+
+    def close(self):
+        self.service.close_session(self.session_id)
+
+
+class InferenceService:
+    # Một bản model dùng chung cho N lớp học trong cùng tiến trình. Các phiên gửi khung hình
+    # (phát hiện) hoặc crop (ArcFace); một luồng worker lấy yêu cầu theo vòng tròn giữa các
+    # phiên để phiên đông người không chiếm hết model, gom crop của nhiều phiên thành một lô
+    # (tối đa max_batch, chờ tối đa max_wait giây) rồi trả kết quả về từng phiên.
+    # Mỗi phiên chỉ được có max_pending yêu cầu chờ; vượt quá thì yêu cầu cũ nhất bị bỏ
+    # (khung hình cũ không còn giá trị) và được tính vào số liệu backpressure.
+    def __init__(self, face_app, max_batch=64, max_wait=0.005, max_pending=4):
+        self.face_app = face_app
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._order = deque()  # Thứ tự vòng tròn giữa các phiên
+        self._stats = {}
+        self._batches = 0
+        self._batched_crops = 0
+        self._ids = itertools.count(1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def session(self, session_id=None):
+        if session_id is None:
+            session_id = f"session-{next(self._ids)}"
+        with self._cond:
+            self._register(session_id)
+        return InferenceSession(self, session_id)
+
+    def _register(self, session_id):
+        if session_id not in self._queues:
+            self._queues[session_id] = deque()
+            self._order.append(session_id)
+            self._stats[session_id] = {'submitted': 0, 'completed': 0, 'dropped': 0,
+                                       'crops': 0, 'wait_ms': 0.0, 'max_wait_ms': 0.0}
+
+    def close_session(self, session_id):
+        with self._cond:
+            pending = self._queues.pop(session_id, None)
+            if pending is None:
+                return
+            self._order.remove(session_id)
+            self._stats.pop(session_id, None)
+        for request in pending:
+            request.future.set_exception(InferenceOverloaded(f"Phiên {session_id} đã đóng"))
+
+    def submit(self, session_id, kind, payload):
+        # Chặn cho tới khi có kết quả: danh sách Face (detect) hoặc ma trận (N, 512) (embed)
+        request = _Request(kind, payload)
+        dropped = None
+        with self._cond:
+            self._register(session_id)
+            pending = self._queues[session_id]
+            stats = self._stats[session_id]
+            if len(pending) >= self.max_pending:
+                dropped = pending.popleft()
+                stats['dropped'] += 1
+            pending.append(request)
+            stats['submitted'] += 1
+            self._cond.notify()
+        if dropped is not None:
+            dropped.future.set_exception(InferenceOverloaded(f"Phiên {session_id} gửi quá nhanh, bỏ yêu cầu cũ"))
+        return request.future.result()
+
+    def _take_round(self, capacity):
+        # Lấy yêu cầu theo từng vòng, mỗi phiên tối đa một yêu cầu mỗi vòng
+        detects, embeds, size = [], [], 0
+        progress = True
+        while progress and size < capacity:
+            progress = False
+            for session_id in list(self._order):
+                pending = self._queues[session_id]
+                if not pending:
+                    continue
+                request = pending[0]
+                if request.kind == "embed":
+                    n = len(request.payload)
+                    if size and size + n > capacity:
+                        continue
+                    size += n
+                    embeds.append((session_id, request))
+                else:
+                    detects.append((session_id, request))
+                pending.popleft()
+                progress = True
+                if size >= capacity:
+                    break
+            self._order.rotate(-1)
+        return detects, embeds, size
+
+    def _collect(self):
+        with self._cond:
+            while not any(self._queues.values()):
+                self._cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            detects, embeds, size = self._take_round(self.max_batch)
+            # Chỉ chờ thêm crop khi lô còn chỗ và không có khung hình nào đang đợi phát hiện
+            while embeds and not detects and size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+                more_detects, more_embeds, more_size = self._take_round(self.max_batch - size)
+                detects += more_detects
+                embeds += more_embeds
+                size += more_size
+            return detects, embeds
+
+    def _finish(self, session_id, request, crops=0):
+        waited = (time.monotonic() - request.submitted) * 1000
+        with self._cond:
+            stats = self._stats.get(session_id)
+            if stats is not None:
+                stats['completed'] += 1
+                stats['crops'] += crops
+                stats['wait_ms'] += waited
+                stats['max_wait_ms'] = max(stats['max_wait_ms'], waited)
+
+    def _run(self):
+        while True:
+            detects, embeds = self._collect()
+            # SCRFD trong buffalo_l có batch cố định bằng 1 nên từng khung hình chạy riêng
+            for session_id, request in detects:
+                try:
+                    faces = detect_faces(self.face_app, request.payload)
+                except Exception as e:
+                    request.future.set_exception(e)
+                    continue
+                self._finish(session_id, request)
+                request.future.set_result(faces)
+            if not embeds:
+                continue
+            crops = [crop for _, request in embeds for crop in request.payload]
+            try:
+                embs = np.concatenate([embed_crops(self.face_app, crops[i:i + self.max_batch])
+                                       for i in range(0, len(crops), self.max_batch)])
+            except Exception as e:
+                for _, request in embeds:
+                    request.future.set_exception(e)
+                continue
+            with self._cond:
+                self._batches += 1
+                self._batched_crops += len(crops)
+            start = 0
+            for session_id, request in embeds:
+                n = len(request.payload)
+                self._finish(session_id, request, n)
+                request.future.set_result(embs[start:start + n])
+                start += n
+
+    def stats(self):
+        # Số liệu cho /api/inference_stats: độ sâu hàng đợi, số yêu cầu bị bỏ, thời gian chờ theo phiên
+        with self._cond:
+            sessions = {}
+            for session_id, stats in self._stats.items():
+                completed = stats['completed']
+                sessions[session_id] = {
+                    'pending': len(self._queues[session_id]),
+                    'submitted': stats['submitted'],
+                    'completed': completed,
+                    'dropped': stats['dropped'],
+                    'crops': stats['crops'],
+                    'mean_wait_ms': round(stats['wait_ms'] / completed, 2) if completed else 0.0,
+                    'max_wait_ms': round(stats['max_wait_ms'], 2),
+                }
+            return {
+                'batches': self._batches,
+                'mean_batch_size': round(self._batched_crops / self._batches, 2) if self._batches else 0.0,
+                'sessions': sessions,
+            }
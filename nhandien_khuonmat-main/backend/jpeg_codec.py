@@ -0,0 +1,213 @@
+import cv2
+import numpy as np
+
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+DEFAULT_QUALITY = 80
+DEFAULT_SUBSAMPLING = '420'  # '444' nét nhất, '420' nhỏ và nhanh nhất, 'gray' chỉ độ sáng
+SCALES = (1, 2, 4, 8)  # Mẫu số thu nhỏ trong miền DCT mà cả libjpeg-turbo và OpenCV đều hỗ trợ
+
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(data):
+    # Đọc (rộng, cao) từ marker SOF mà không giải mã ảnh; None nếu không phải JPEG hợp lệ
+    data = memoryview(data)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF or 0xD0 <= marker <= 0xD9 or marker == 0x01:
+            i += 2  # Byte đệm hoặc marker không có độ dài
+            continue
+        length = (data[i + 2] << 8) | data[i + 3]
+        if marker in _SOF_MARKERS:
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height
+        i += 2 + length
+    return None
+
+
+def jpeg_orientation(data):
+    # Đọc thẻ Orientation (0x0112) trong EXIF (APP1) của ảnh JPEG; 1 (không xoay) nếu không có
+    data = bytes(memoryview(data)[:65536 + 4])  # EXIF nằm trong một segment APP1, tối đa 64 KB
+    i = 2
+    while i + 4 <= len(data) and data[i] == 0xFF:
+        marker = data[i + 1]
+        if marker in _SOF_MARKERS or marker == 0xDA:
+            break  # Hết phần header: EXIF luôn đứng trước SOF / SOS
+        length = (data[i + 2] << 8) | data[i + 3]
+        if marker == 0xE1 and data[i + 4:i + 10] == b'Exif\x00\x00':
+            return _exif_orientation(data[i + 10:i + 2 + length])
+        i += 2 + length
+    return 1
+
+
+def _exif_orientation(tiff):
+    if len(tiff) < 8 or tiff[:2] not in (b'II', b'MM'):
+        return 1
+    order = 'little' if tiff[:2] == b'II' else 'big'
+    offset = int.from_bytes(tiff[4:8], order)
+    if offset + 2 > len(tiff):
+        return 1
+    count = int.from_bytes(tiff[offset:offset + 2], order)
+    for entry in range(offset + 2, min(offset + 2 + count * 12, len(tiff) - 11), 12):
+        if int.from_bytes(tiff[entry:entry + 2], order) == 0x0112:
+            value = int.from_bytes(tiff[entry + 8:entry + 10], order)
+            return value if 1 <= value <= 8 else 1
+    return 1
+
+
+def apply_orientation(img, orientation):
+    # Xoay / lật ảnh đã giải mã theo thẻ EXIF Orientation, giống cv2.imdecode khi không có
+    # IMREAD_IGNORE_ORIENTATION (libjpeg-turbo bỏ qua EXIF nên phải tự xoay)
+    if orientation == 2:
+        img = img[:, ::-1]
+    elif orientation == 3:
+        img = img[::-1, ::-1]
+    elif orientation == 4:
+        img = img[::-1]
+    elif orientation == 5:
+        img = img.swapaxes(0, 1)
+    elif orientation == 6:
+        img = np.rot90(img, -1)
+    elif orientation == 7:
+        img = img[::-1, ::-1].swapaxes(0, 1)
+    elif orientation == 8:
+        img = np.rot90(img, 1)
+    else:
+        return img
+    return np.ascontiguousarray(img)
+
+
+def choose_scale(size, max_side):
+    # Mẫu số lớn nhất mà ảnh thu nhỏ vẫn có cạnh dài >= max_side (không xuống dưới độ phân giải detector)
+    if size is None or not max_side:
+        return 1
+    longest = max(size)
+    scale = 1
+    for s in SCALES:
+        if longest / s >= max_side:
+            scale = s
+    return scale
+
+
+def _as_array(data):
+    return data if isinstance(data, np.ndarray) else np.frombuffer(data, np.uint8)
+
+
+class OpenCVCodec:
+    # Mặc định: cv2.imdecode / cv2.imencode. Thu nhỏ khi giải mã bằng IMREAD_REDUCED_COLOR_2/4/8
+    # (libjpeg của OpenCV bỏ bớt hệ số DCT, không giải mã đầy đủ rồi resize)
+    name = 'opencv'
+    _reduced = {1: cv2.IMREAD_COLOR,
+                2: getattr(cv2, 'IMREAD_REDUCED_COLOR_2', None),
+                4: getattr(cv2, 'IMREAD_REDUCED_COLOR_4', None),
+                8: getattr(cv2, 'IMREAD_REDUCED_COLOR_8', None)}
+    _sampling = {'444': 'IMWRITE_JPEG_SAMPLING_FACTOR_444',
+                 '422': 'IMWRITE_JPEG_SAMPLING_FACTOR_422',
+                 '420': 'IMWRITE_JPEG_SAMPLING_FACTOR_420'}
+
+    def decode(self, data, scale=1):
+        flags = self._reduced.get(scale)
+        if flags is None:
+            flags = cv2.IMREAD_COLOR
+        return cv2.imdecode(_as_array(data), flags)
+
+    def encode(self, img, quality=DEFAULT_QUALITY, subsampling=DEFAULT_SUBSAMPLING):
+        if subsampling == 'gray' and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        # IMWRITE_JPEG_SAMPLING_FACTOR có từ OpenCV 4.5.5; bản cũ hơn luôn dùng 4:2:0
+        factor = getattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR', None)
+        value = getattr(cv2, self._sampling.get(subsampling, ''), None)
+        if factor is not None and value is not None:
+            params += [factor, value]
+        ret, buffer = cv2.imencode('.jpg', img, params)
+        if not ret:
+            raise RuntimeError("Không mã hóa được ảnh JPEG")
+        return buffer.tobytes()
+
+
+class TurboJPEGCodec:
+    # libjpeg-turbo qua PyTurboJPEG: giải mã / mã hóa SIMD trực tiếp ra BGR, thu nhỏ trong miền DCT.
+    # libjpeg-turbo không đọc EXIF nên ảnh được xoay theo Orientation sau khi giải mã, cho kết quả
+    # giống OpenCVCodec (ảnh chụp dọc từ điện thoại không bị nằm ngang tùy thư viện đã cài)
+    name = 'turbojpeg'
+
+    def __init__(self, lib_path=None):
+        self.jpeg = turbojpeg.TurboJPEG(lib_path)
+        self._sampling = {'444': turbojpeg.TJSAMP_444, '422': turbojpeg.TJSAMP_422,
+                          '420': turbojpeg.TJSAMP_420, 'gray': turbojpeg.TJSAMP_GRAY}
+
+    def decode(self, data, scale=1):
+        data = bytes(data) if not isinstance(data, bytes) else data
+        if scale == 1:
+            img = self.jpeg.decode(data, pixel_format=turbojpeg.TJPF_BGR)
+        else:
+            img = self.jpeg.decode(data, pixel_format=turbojpeg.TJPF_BGR, scaling_factor=(1, scale))
+        return apply_orientation(img, jpeg_orientation(data))
+
+    def encode(self, img, quality=DEFAULT_QUALITY, subsampling=DEFAULT_SUBSAMPLING):
+        if img.ndim == 2:
+            return self.jpeg.encode(img, quality=int(quality), pixel_format=turbojpeg.TJPF_GRAY,
+                                    jpeg_subsample=turbojpeg.TJSAMP_GRAY)
+        return self.jpeg.encode(np.ascontiguousarray(img), quality=int(quality),
+                                pixel_format=turbojpeg.TJPF_BGR,
+                                jpeg_subsample=self._sampling.get(subsampling, turbojpeg.TJSAMP_420))
+
+
+def available_codecs():
+    codecs = {'opencv': OpenCVCodec}
+    if turbojpeg is not None:
+        codecs['turbojpeg'] = TurboJPEGCodec
+    return codecs
+
+
+def make_codec(kind=None):
+    # kind=None: libjpeg-turbo nếu đã cài PyTurboJPEG và tìm thấy thư viện, không thì OpenCV
+    if kind in (None, 'turbojpeg') and turbojpeg is not None:
+        try:
+            return TurboJPEGCodec()
+        except (OSError, RuntimeError) as e:
+            if kind == 'turbojpeg':
+                raise
+            print(f"Không nạp được libjpeg-turbo ({e}), dùng OpenCV")
+    elif kind == 'turbojpeg':
+        raise RuntimeError("Chưa cài PyTurboJPEG (pip install PyTurboJPEG)")
+    elif kind not in (None, 'opencv'):
+        raise ValueError(f"Codec không hợp lệ: {kind}")
+    return OpenCVCodec()
+
+
+_codec = None
+
+
+def get_codec():
+    # Codec dùng chung trong tiến trình (chọn một lần)
+    global _codec
+    if _codec is None:
+        _codec = make_codec()
+    return _codec
+
+
+def decode_jpeg(data, max_side=None):
+    # Giải mã JPEG; có max_side thì thu nhỏ 1/2, 1/4, 1/8 trong lúc giải mã sao cho cạnh dài
+    # vẫn >= max_side (ảnh upload lớn được giải mã thẳng ở độ phân giải detector).
+    # Dữ liệu không phải JPEG (PNG, ...) vẫn giải mã bằng OpenCV như trước
+    size = jpeg_size(data)
+    if size is None:
+        return cv2.imdecode(_as_array(data), cv2.IMREAD_COLOR)
+    return get_codec().decode(data, choose_scale(size, max_side))
+
+
+def encode_jpeg(img, quality=DEFAULT_QUALITY, subsampling=DEFAULT_SUBSAMPLING):
+    return get_codec().encode(img, quality, subsampling)
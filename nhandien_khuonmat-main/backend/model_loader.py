@@ -0,0 +1,187 @@
+import glob
+import os
+import onnxruntime as ort
+from insightface.app import FaceAnalysis
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.scrfd import SCRFD
+from insightface.utils import ensure_available
+from face_pipeline import PIPELINE_MODULES
+
+# Nạp model ONNX ở một chỗ thay cho providers=['CUDAExecutionProvider'] / ctx_id=0 viết cứng trong từng file
+# (máy chỉ có CPU âm thầm chạy với cấu hình CPU mặc định):
+#  - provider chọn theo ort.get_available_providers() và hồ sơ triển khai, luôn có CPU dự phòng
+#  - số luồng intra/inter-op, mức tối ưu đồ thị, memory arena, chế độ thực thi theo hồ sơ
+#  - đồ thị đã tối ưu được lưu (optimized_model_filepath), lần khởi động sau nạp thẳng file này
+#    và bỏ qua bước tối ưu; file gắn với provider và phiên bản ONNX Runtime
+#  - in cấu hình thực tế của từng model khi khởi động
+# Hồ sơ chọn qua tham số profile hoặc biến môi trường ORT_PROFILE (mặc định 'auto')
+PROFILES = {
+    # GPU: tính toán trên CUDA, CPU chỉ điều phối nên một luồng là đủ
+    'gpu': {'providers': ['CUDAExecutionProvider', 'CPUExecutionProvider'], 'intra_threads': 1,
+            'inter_threads': 1, 'execution_mode': 'sequential', 'optimization': 'all',
+            'cpu_arena': True, 'mem_pattern': True, 'spinning': True},
+    # Máy chủ CPU, một tiến trình: mỗi lần suy luận dùng mọi lõi vật lý (0 = ONNX Runtime tự chọn)
+    'cpu': {'providers': ['CPUExecutionProvider'], 'intra_threads': 0, 'inter_threads': 1,
+            'execution_mode': 'sequential', 'optimization': 'all',
+            'cpu_arena': True, 'mem_pattern': True, 'spinning': True},
+    # Worker của InferencePool: số luồng bằng số lõi được ghim, không quay chờ khi rảnh
+    # để các worker không giành lõi của nhau
+    'cpu_worker': {'providers': ['CPUExecutionProvider'], 'intra_threads': 1, 'inter_threads': 1,
+                   'execution_mode': 'sequential', 'optimization': 'all',
+                   'cpu_arena': True, 'mem_pattern': True, 'spinning': False},
+    # Máy yếu / bộ nhớ ít: tắt arena và mem pattern, ít luồng
+    'low_memory': {'providers': ['CPUExecutionProvider'], 'intra_threads': 2, 'inter_threads': 1,
+                   'execution_mode': 'sequential', 'optimization': 'basic',
+                   'cpu_arena': False, 'mem_pattern': False, 'spinning': False},
+}
+OPTIMIZATION_LEVELS = {
+    'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    'sequential': ort.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': ort.ExecutionMode.ORT_PARALLEL,
+}
+# Provider lưu được đồ thị đã tối ưu (TensorRT... biên dịch node riêng, không ghi ra file được)
+CACHEABLE_PROVIDERS = {'CPUExecutionProvider', 'CUDAExecutionProvider'}
+CACHE_DIR_NAME = 'optimized'
+
+
+def resolve_profile(profile=None):
+    # 'auto': có CUDA thì 'gpu', không thì 'cpu'
+    profile = profile or os.environ.get('ORT_PROFILE', 'auto')
+    if profile == 'auto':
+        profile = 'gpu' if 'CUDAExecutionProvider' in ort.get_available_providers() else 'cpu'
+    if profile not in PROFILES:
+        raise ValueError(f"Hồ sơ ONNX Runtime không hợp lệ: {profile} (chọn: {', '.join(PROFILES)})")
+    return profile
+
+
+def select_providers(preferred):
+    # Giữ thứ tự ưu tiên, bỏ provider không có trong bản onnxruntime đã cài, luôn có CPU ở cuối
+    available = ort.get_available_providers()
+    providers = [p for p in preferred if p in available]
+    missing = [p for p in preferred if p not in available]
+    if missing:
+        print(f"ONNX Runtime: không có {', '.join(missing)}, dùng {providers or ['CPUExecutionProvider']}")
+    if 'CPUExecutionProvider' not in providers:
+        providers.append('CPUExecutionProvider')
+    return providers
+
+
+def session_options(config, threads=None):
+    # threads ghi đè intra_threads của hồ sơ (worker của InferencePool truyền số lõi được ghim)
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads if threads is not None else config['intra_threads']
+    options.inter_op_num_threads = config['inter_threads']
+    options.execution_mode = EXECUTION_MODES[config['execution_mode']]
+    options.graph_optimization_level = OPTIMIZATION_LEVELS[config['optimization']]
+    options.enable_cpu_mem_arena = config['cpu_arena']
+    options.enable_mem_pattern = config['mem_pattern']
+    options.add_session_config_entry('session.intra_op.allow_spinning', '1' if config['spinning'] else '0')
+    options.log_severity_level = 3
+    return options
+
+
+def cache_path(model_file, providers, config):
+    tag = providers[0].replace('ExecutionProvider', '').lower()
+    name = os.path.splitext(os.path.basename(model_file))[0]
+    return os.path.join(os.path.dirname(model_file), CACHE_DIR_NAME,
+                        f"{name}.{tag}.{config['optimization']}.ort{ort.__version__}.onnx")
+
+
+def build_session(model_file, providers, config, threads=None, cache=True):
+    # Trả về (session, trạng thái cache: 'hit' | 'miss' | 'off')
+    options = session_options(config, threads)
+    if not cache or providers[0] not in CACHEABLE_PROVIDERS or config['optimization'] == 'disable':
+        return ort.InferenceSession(model_file, sess_options=options, providers=providers), 'off'
+    cached = cache_path(model_file, providers, config)
+    if os.path.exists(cached):
+        # Đồ thị đã tối ưu sẵn: tắt tối ưu để khởi động nhanh
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return ort.InferenceSession(cached, sess_options=options, providers=providers), 'hit'
+        except Exception as e:
+            print(f"ONNX Runtime: bỏ file tối ưu hỏng {cached}: {e}")
+            os.remove(cached)
+            options = session_options(config, threads)
+    os.makedirs(os.path.dirname(cached), exist_ok=True)
+    # Ghi ra file tạm rồi đổi tên: nhiều worker khởi động cùng lúc không ghi đè file của nhau
+    tmp_path = f"{cached}.{os.getpid()}.tmp"
+    options.optimized_model_filepath = tmp_path
+    session = ort.InferenceSession(model_file, sess_options=options, providers=providers)
+    if os.path.exists(tmp_path):
+        os.replace(tmp_path, cached)
+    return session, 'miss'
+
+
+def model_task(session):
+    # Giống ModelRouter của insightface, chỉ cho hai model pipeline dùng
+    inputs, outputs = session.get_inputs(), session.get_outputs()
+    shape = inputs[0].shape
+    if len(outputs) >= 5:
+        return 'detection'
+    if len(inputs) == 1 and shape[2] == shape[3] and isinstance(shape[2], int) \
+            and shape[2] >= 112 and shape[2] % 16 == 0 and shape[2] != 192:
+        return 'recognition'
+    return None  # Landmark 2d/3d (192x192), genderage (96x96)... pipeline không dùng
+
+
+def load_face_app(name="buffalo_l", det_size=(640, 640), det_thresh=0.5, profile=None, threads=None,
+                  allowed_modules=PIPELINE_MODULES, root='~/.insightface', cache=True):
+    # Thay cho FaceAnalysis(...) + prepare(...): FaceAnalysis tạo session với cấu hình mặc định cho
+    # mọi file .onnx (kể cả model bị bỏ), ở đây chỉ tạo session tinh chỉnh cho model được dùng
+    profile = resolve_profile(profile)
+    config = PROFILES[profile]
+    providers = select_providers(config['providers'])
+    face_app = FaceAnalysis.__new__(FaceAnalysis)
+    face_app.model_dir = ensure_available('models', name, root=root)
+    face_app.models = {}
+    report = {}
+    probe = session_options(dict(config, optimization='disable', cpu_arena=False, mem_pattern=False), 1)
+    for onnx_file in sorted(glob.glob(os.path.join(face_app.model_dir, '*.onnx'))):
+        # Nhận dạng model bằng session chưa tối ưu (rẻ), chỉ model cần dùng mới tạo session thật
+        task = model_task(ort.InferenceSession(onnx_file, sess_options=probe, providers=['CPUExecutionProvider']))
+        if task is None or task in face_app.models or task not in allowed_modules:
+            continue
+        session, cache_state = build_session(onnx_file, providers, config, threads, cache)
+        # model_file giữ file gốc: ArcFaceONNX đọc đồ thị gốc để lấy input_mean / input_std
+        model_class = SCRFD if task == 'detection' else ArcFaceONNX
+        face_app.models[task] = model_class(model_file=onnx_file, session=session)
+        report[task] = {'file': os.path.basename(onnx_file), 'providers': session.get_providers(),
+                        'cache': cache_state}
+    if 'detection' not in face_app.models:
+        raise RuntimeError(f"Không tìm thấy model phát hiện trong {face_app.model_dir}")
+    face_app.det_model = face_app.models['detection']
+    # Provider đã cố định khi tạo session: ctx_id < 0 sẽ khiến insightface gọi set_providers và dựng lại
+    # session (tối ưu đồ thị lần nữa), nên luôn truyền ctx_id=0
+    face_app.prepare(ctx_id=0, det_size=det_size, det_thresh=det_thresh)
+    face_app.runtime = {
+        'onnxruntime': ort.__version__,
+        'available_providers': ort.get_available_providers(),
+        'profile': profile,
+        'providers': providers,
+        'intra_threads': threads if threads is not None else config['intra_threads'],
+        'inter_threads': config['inter_threads'],
+        'execution_mode': config['execution_mode'],
+        'optimization': config['optimization'],
+        'cpu_arena': config['cpu_arena'],
+        'mem_pattern': config['mem_pattern'],
+        'spinning': config['spinning'],
+        'det_size': list(det_size),
+        'models': report,
+    }
+    print_runtime(face_app.runtime)
+    return face_app
+
+
+def print_runtime(runtime):
+    print(f"ONNX Runtime {runtime['onnxruntime']}, khả dụng: {runtime['available_providers']}")
+    print(f"  hồ sơ '{runtime['profile']}': providers={runtime['providers']}, "
+          f"intra={runtime['intra_threads']}, inter={runtime['inter_threads']}, "
+          f"mode={runtime['execution_mode']}, opt={runtime['optimization']}, "
+          f"arena={runtime['cpu_arena']}, mem_pattern={runtime['mem_pattern']}, spinning={runtime['spinning']}")
+    for task, info in runtime['models'].items():
+        print(f"  {task}: {info['file']} trên {info['providers'][0]}, cache {info['cache']}")
@@ -1,38 +1,48 @@
 import cv2
-import pickle
-import numpy as np
-from insightface.app import FaceAnalysis
-import onnxruntime as ort
 from datetime import datetime
 import sqlite3
 import os
 import asyncio
 import time
 import threading
-
-# In ra các provider khả dụng
-print("Available providers:", ort.get_available_providers())
+from concurrent.futures import ThreadPoolExecutor
+from gallery import GALLERY_INDEX, GalleryHolder
+from face_tracker import FaceTracker, track_and_recognize
+from cadence import AdaptiveCadence
+from model_loader import load_face_app
+from inference_service import InferenceService
+from frame_ring import read_frame
+from embedding_store import migrate_if_needed
 
 # Đường dẫn
 DATABASE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'dtb.db')
-embeddings_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'face_embeddings.pkl')
+embeddings_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'face_embeddings.emb')
+legacy_embeddings_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'face_embeddings.pkl')
 
 # Kiểm tra file cơ sở dữ liệu
 if not os.path.exists(DATABASE):
     raise FileNotFoundError(f"Cơ sở dữ liệu {DATABASE} không tồn tại!")
+# Chuyển face_embeddings.pkl cũ sang file memmap .emb nếu chưa có
+migrate_if_needed(legacy_embeddings_path, embeddings_path)
 if not os.path.exists(embeddings_path):
-    raise FileNotFoundError("face_embeddings.pkl không tồn tại!")
-
-# Load embeddings
-with open(embeddings_path, "rb") as f:
-    embeddings = pickle.load(f)
-
-# Khởi tạo model nhận diện với tối ưu hóa GPU
-face_app = FaceAnalysis(name="buffalo_l", providers=['CUDAExecutionProvider'])
-face_app.prepare(ctx_id=0, det_size=(640, 640), det_thresh=0.6)
-
-# Tạo hàng đợi bất đồng bộ
-frame_queue = asyncio.Queue(maxsize=100)  # Tăng maxsize để tránh bỏ sót khung hình
+    raise FileNotFoundError("face_embeddings.emb không tồn tại!")
+
+# Load embeddings và gom thành ma trận để so khớp theo lô,
+# tự nạp lại khi file thay đổi (đăng ký sinh viên mới không cần khởi động lại)
+gallery_holder = GalleryHolder(embeddings_path, index=GALLERY_INDEX).start_watching()
+
+# Khởi tạo model nhận diện: GPU nếu có, không thì CPU (hồ sơ ORT_PROFILE), in cấu hình thực tế
+face_app = load_face_app(det_size=(640, 640), det_thresh=0.6)
+# Một bản model phục vụ mọi phiên: gom lô, chia lượt công bằng giữa các lớp học
+inference_service = InferenceService(face_app)
+
+# Vòng đệm khung hình cấp phát sẵn (tạo khi biết kích thước webcam): capture đọc thẳng vào ô trống,
+# người xem chờ frame_ring.latest(seq đã nhận) để lấy khung hình mới nhất rồi release() sau khi dùng;
+# khung hình mới thay khung hình chưa ai đọc, mọi ô đều đang bị giữ thì bỏ khung hình vừa đọc
+frame_ring = None
+# cap.read() và suy luận đều chặn: chạy trong một luồng riêng (giữ đúng thứ tự khung hình cho tracker)
+# để event loop không bị treo
+pipeline_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline')
 recognized_faces = {}
 stop_event = asyncio.Event()
 
@@ -62,7 +72,7 @@ def get_student_list(class_id):
         return []
 
 async def process_frames(class_id=None):
-    global frame_count, fps, start_time_fps
+    global frame_count, fps, start_time_fps, frame_ring
     # Lấy danh sách sinh viên
     student_list = get_student_list(class_id)
 
@@ -78,14 +88,22 @@ async def process_frames(class_id=None):
     start_time_fps = time.time()
     frame_count = 0
     fps = 0
+    tracker = FaceTracker()  # Track ID ổn định giữa các khung hình
+    cadence = AdaptiveCadence()  # Nhịp detector theo chuyển động và số track chưa xác nhận
+    inference_session = inference_service.session()
+    loop = asyncio.get_running_loop()
 
     while not stop_event.is_set():
         try:
             start_time = time.time()
-            success, frame = cap.read()
+            success, handle, frame_ring = await loop.run_in_executor(pipeline_executor, read_frame, cap, frame_ring)
             if not success:
                 print("Không thể đọc khung hình từ webcam!")
                 break
+            if handle is None:
+                await asyncio.sleep(0)
+                continue
+            frame = handle.array
 
             frame_count += 1
             current_time = time.time()
@@ -95,24 +113,17 @@ async def process_frames(class_id=None):
                 frame_count = 0
                 start_time_fps = current_time
 
-            # Nhận diện khuôn mặt trên GPU
-            faces = face_app.get(frame)
+            # Phát hiện khuôn mặt trên GPU, ArcFace chỉ chạy cho track mới hoặc chưa chắc chắn
+            tracks = await loop.run_in_executor(
+                pipeline_executor, track_and_recognize,
+                tracker, face_app, frame,
+                lambda faces: gallery_holder.current.match_faces(faces, threshold),
+                inference_session, cadence)
             print(f"Face detection time: {time.time() - start_time:.3f}s")
 
-            for face in faces:
-                box = face.bbox.astype(int)
-                emb = face.normed_embedding
-                name = "Unknown"
-                max_sim = -1
-                for person_name, person_embs in embeddings.items():
-                    for saved_emb in person_embs:
-                        sim = np.dot(emb, saved_emb)
-                        if sim > max_sim:
-                            max_sim = sim
-                            name = person_name
-
-                if max_sim < threshold:
-                    name = "Unknown"
+            for track in tracks:
+                name = track.name
+                box = track.bbox.astype(int)
 
                 if name != "Unknown" and name not in recognized_faces:
                     recognized_faces[name] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -127,16 +138,11 @@ async def process_frames(class_id=None):
             # Thêm thông tin lên khung hình
             now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             cv2.putText(frame, now_str, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-            cv2.putText(frame, f"So nguoi: {len(faces)}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+            cv2.putText(frame, f"So nguoi: {len(tracks)}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
             cv2.putText(frame, f"FPS: {fps:.2f}", (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
 
-            # Thêm khung hình vào hàng đợi
-            try:
-                await frame_queue.put(frame.copy())
-                print(f"Queue size: {frame_queue.qsize()}")
-            except asyncio.QueueFull:
-                print("Queue full, skipping frame")
-                pass
+            # Đưa khung hình vào vòng đệm, không sao chép
+            frame_ring.publish(handle, current_time)
 
             # Giảm tải CPU
             await asyncio.sleep(0.001)  # Ngủ ngắn để nhường CPU
@@ -146,6 +152,7 @@ async def process_frames(class_id=None):
             break
 
     # Giải phóng tài nguyên
+    inference_session.close()
     cap.release()
     cv2.destroyAllWindows()
     print("Webcam and OpenCV windows released")
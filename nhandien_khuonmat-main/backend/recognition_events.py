@@ -0,0 +1,85 @@
+import json
+import threading
+from collections import deque
+
+KEEPALIVE = 15.0  # Giây giữa hai dòng giữ kết nối SSE khi không có sự kiện
+
+
+class RecognitionEvents:
+    # Nhật ký sự kiện điểm danh của một phiên, thay cho việc client hỏi /api/recognize mỗi 2 giây:
+    #  - chỉ ghi phần thay đổi: 'recognized' {msv, time, score}, 'cleared', 'stopped'
+    #  - mỗi sự kiện có seq tăng dần; client kết nối lại gửi seq cuối cùng (Last-Event-ID) để nhận tiếp
+    #  - seq quá cũ (đã bị cắt khỏi nhật ký) hoặc không khớp thì client nhận một 'snapshot' đầy đủ
+    # Tải server tỉ lệ với số lần ghi nhận, không phải số client x tần suất hỏi
+    def __init__(self, max_events=1000):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=max_events)
+        self._seq = 0
+        self.listeners = []  # Hàm listener(event) gọi sau mỗi sự kiện (server asyncio)
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def publish(self, kind, **data):
+        with self._cond:
+            self._seq += 1
+            event = dict(data, seq=self._seq, type=kind)
+            self._events.append(event)
+            self._cond.notify_all()
+        for listener in tuple(self.listeners):
+            listener(event)
+        return event
+
+    def _since(self, seq):
+        if seq > self._seq or (self._events and seq < self._events[0]['seq'] - 1):
+            return None  # Khoảng trống: client cần snapshot
+        return [event for event in self._events if event['seq'] > seq]
+
+    def since(self, seq):
+        # Sự kiện sau seq, hoặc None nếu client phải nhận snapshot trước
+        with self._cond:
+            return self._since(seq)
+
+    def wait(self, after_seq, timeout=None):
+        # Như since() nhưng chờ tới khi có sự kiện mới; hết thời gian chờ thì trả về []
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != after_seq, timeout)
+            return self._since(after_seq)
+
+
+def format_sse(event):
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def parse_last_seq(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def iter_sse(events, snapshot, is_active, last_seq=0, keepalive=KEEPALIVE):
+    # Generator SSE cho Flask: snapshot() trả về sự kiện 'snapshot' (seq + toàn bộ danh sách đã ghi nhận),
+    # is_active() False thì đóng luồng sau khi gửi hết sự kiện
+    if last_seq == 0 or events.since(last_seq) is None:
+        event = snapshot()
+        last_seq = event['seq']
+        yield format_sse(event)
+    while True:
+        pending = events.wait(last_seq, keepalive)
+        if pending is None:
+            event = snapshot()
+            last_seq = event['seq']
+            yield format_sse(event)
+            continue
+        if not pending:
+            if not is_active():
+                return
+            yield ": keepalive\n\n"
+            continue
+        for event in pending:
+            last_seq = event['seq']
+            yield format_sse(event)
+            if event['type'] == 'stopped':
+                return
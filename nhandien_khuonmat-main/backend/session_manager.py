@@ -0,0 +1,313 @@
+import itertools
+import json
+import os
+import threading
+import time
+from datetime import datetime
+import cv2
+from face_tracker import FaceTracker, track_and_recognize
+from cadence import AdaptiveCadence
+from frame_ring import read_frame
+from stream_encoder import StreamEncoder
+from recognition_events import RecognitionEvents
+
+DEFAULT_SOURCE = 1  # Webcam mặc định như trước đây
+RING_SLOTS = 4  # Ô khung hình cấp phát sẵn cho mỗi phiên (writer + khung hình mới nhất + người xem chậm)
+# Danh sách camera do server cấu hình: {mã camera: chỉ số webcam hoặc URL RTSP / đường dẫn video}.
+# Client chỉ gửi mã camera (hoặc mã phòng), không bao giờ gửi thẳng nguồn cho cv2.VideoCapture,
+# nên không thể bắt server mở URL hay file tùy ý. Mã "default" dùng khi client không chọn camera
+CAMERAS_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'cameras.json')
+
+
+def parse_source(source):
+    # Chỉ số webcam ("0", 1) hoặc URL / đường dẫn video (rtsp://..., file .mp4), chỉ dùng cho cấu hình server
+    if source is None or source == "":
+        return DEFAULT_SOURCE
+    if isinstance(source, int):
+        return source
+    source = str(source).strip()
+    return int(source) if source.isdigit() else source
+
+
+def load_cameras(path=CAMERAS_PATH):
+    if not os.path.exists(path):
+        return {'default': DEFAULT_SOURCE}
+    with open(path, encoding='utf-8') as f:
+        return {str(camera_id): parse_source(source) for camera_id, source in json.load(f).items()}
+
+
+class CameraSession:
+    # Một phòng học: nguồn camera, hàng đợi khung hình, danh sách đã ghi nhận và số liệu riêng.
+    # Model và gallery dùng chung qua SessionManager
+    def __init__(self, manager, session_id, class_id, timetable_id, source, foreign_fallback, student_list):
+        self.manager = manager
+        self.session_id = session_id
+        self.class_id = class_id
+        self.timetable_id = timetable_id
+        self.source = source
+        self.foreign_fallback = foreign_fallback
+        self.student_list = student_list
+        self.ring = None  # FrameRing, tạo khi biết kích thước khung hình đầu tiên
+        self.encoder = StreamEncoder(self.next_frame)  # Mã hóa JPEG một lần cho mọi người xem /stream
+        self.frame_listeners = []  # Hàm listener(session, seq) gọi từ luồng capture sau mỗi khung hình (server asyncio)
+        self.recognized_faces = {}
+        self.recognized_faces_lock = threading.Lock()
+        self.events = RecognitionEvents()  # Sự kiện điểm danh (chỉ phần thay đổi) cho SSE / WebSocket
+        self.tracker = FaceTracker()  # Track ID ổn định giữa các khung hình, giữ tập sinh viên đã điểm danh
+        self.active = False
+        self.cap = None
+        self.thread = None
+        self.cadence = AdaptiveCadence()  # Nhịp chạy detector theo chuyển động, số track chưa xác nhận và ngân sách
+        self.fps = 0.0
+        self.frames = 0
+        self.face_count = 0
+        self.started_at = None
+        self.error = None
+
+    def start(self):
+        self.cap = cv2.VideoCapture(self.source)
+        if not self.cap.isOpened():
+            self.cap.release()
+            raise RuntimeError(f"Không thể mở camera {self.source}")
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)  # Giảm độ phân giải
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        self.active = True
+        self.started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"[{self.session_id}] Bắt đầu xử lý khung hình (lớp {self.class_id}, nguồn {self.source})")
+
+    def stop(self, timeout=2.0):
+        # Luồng xử lý tự giải phóng camera khi thoát vòng lặp
+        self.active = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        print(f"[{self.session_id}] Đã yêu cầu dừng xử lý khung hình")
+
+    def recognized_names(self):
+        with self.recognized_faces_lock:
+            return list(self.recognized_faces.keys())
+
+    def clear_recognized(self):
+        with self.recognized_faces_lock:
+            self.recognized_faces.clear()
+            self.events.publish('cleared')
+        self.tracker.resolved.clear()
+        self.tracker.low_power = False
+        print(f"[{self.session_id}] Đã xóa danh sách khuôn mặt nhận diện")
+
+    def snapshot_event(self):
+        # Toàn bộ danh sách đã ghi nhận kèm seq hiện tại, cho client mới hoặc kết nối lại bị hụt sự kiện
+        with self.recognized_faces_lock:
+            return {'seq': self.events.seq, 'type': 'snapshot', 'active': self.active,
+                    'recognized': [{'msv': msv, 'time': t} for msv, t in self.recognized_faces.items()]}
+
+    def stats(self):
+        return {
+            'session_id': self.session_id,
+            'class_id': self.class_id,
+            'timetable_id': self.timetable_id,
+            'source': str(self.source),
+            'active': self.active,
+            'started_at': self.started_at,
+            'fps': round(self.fps, 2),
+            'frames': self.frames,
+            'faces': self.face_count,
+            'recognized': len(self.recognized_faces),
+            'dropped_frames': self.ring.dropped if self.ring is not None else 0,
+            'remaining': len(set(self.student_list) - self.tracker.resolved),
+            'low_power': self.tracker.low_power,
+            'error': self.error,
+            'cadence': self.cadence.stats(),
+            'stream': self.encoder.stats(),
+        }
+
+    def next_frame(self, after_seq=0, timeout=0.1):
+        # Khung hình đã vẽ overlay mới nhất, mới hơn after_seq (seq người xem đã nhận); người gọi phải
+        # release(). Mỗi người xem /stream tự giữ seq của mình nên ai cũng nhận khung hình mới nhất
+        ring = self.ring
+        if ring is None:
+            time.sleep(timeout)
+            return None
+        return ring.latest(after_seq, timeout)
+
+    def _run(self):
+        manager = self.manager
+        threshold = manager.threshold
+        student_set = set(self.student_list)  # Tra cứu O(1) trong vòng lặp
+        tracker = self.tracker
+        inference_session = manager.inference_service.session(self.session_id)
+        start_time_fps = time.time()
+        frame_count = 0
+
+        try:
+            while self.active:
+                # Đọc thẳng vào ô trống của vòng đệm (người xem giữ vòng cũ tới khi release nếu bị dựng lại)
+                success, handle, self.ring = read_frame(self.cap, self.ring, RING_SLOTS)
+                if not success:
+                    print(f"[{self.session_id}] Không thể đọc khung hình từ camera!")
+                    self.error = "Không thể đọc khung hình từ camera"
+                    break
+                if handle is None:
+                    continue
+                frame = handle.array
+
+                self.frames += 1
+                frame_count += 1
+                current_time = time.time()
+                elapsed_time = current_time - start_time_fps
+                if elapsed_time >= 1.0:
+                    self.fps = frame_count / elapsed_time
+                    frame_count = 0
+                    start_time_fps = current_time
+
+                # Detector chạy theo nhịp thích ứng, ArcFace chỉ chạy cho track mới hoặc có độ tin cậy
+                # đã suy giảm; so khớp trong gallery con của lớp đã bỏ sinh viên đã điểm danh, khuôn mặt không
+                # khớp mới tra lại cả lớp (toàn trường chỉ khi bật foreign_fallback).
+                # Track khớp với sinh viên đã điểm danh được xác nhận ngay, không tính embedding lại
+                tracks = track_and_recognize(
+                    tracker, manager.face_app, frame,
+                    lambda faces: manager.gallery_holder.current.match_faces(
+                        faces, threshold, self.class_id, self.student_list, self.foreign_fallback,
+                        resolved=tracker.resolved),
+                    inference_session, self.cadence)
+                self.face_count = len(tracks)
+
+                for track in tracks:
+                    name = track.name
+                    box = track.bbox.astype(int)
+
+                    if name != "Unknown" and name not in self.recognized_faces and name in student_set:
+                        with self.recognized_faces_lock:
+                            recognized_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                            self.recognized_faces[name] = recognized_at
+                            self.events.publish('recognized', msv=name, time=recognized_at,
+                                                score=round(float(track.score), 3))
+                        tracker.resolve(name)
+                        print(f"[{self.session_id}] -> Ghi nhận: {name}")
+                        if student_set and student_set <= tracker.resolved:
+                            tracker.low_power = True
+                            print(f"[{self.session_id}] Cả lớp đã có mặt, chuyển sang chế độ chỉ phát hiện")
+
+                    color = (0, 255, 0) if name == "Unknown" or name in student_set else (0, 0, 255)
+                    cv2.rectangle(frame, (box[0], box[1]), (box[2], box[3]), color, 2)
+                    cv2.putText(frame, name, (box[0], box[1] - 10),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
+
+                now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                cv2.putText(frame, now_str, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+                cv2.putText(frame, f"So nguoi: {len(tracks)}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+                cv2.putText(frame, f"FPS: {self.fps:.2f}", (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+
+                # Ô chỉ được ghi lại khi bộ mã hóa đã release, nên overlay không bị sửa giữa chừng
+                seq = self.ring.publish(handle, current_time)
+                for listener in tuple(self.frame_listeners):
+                    listener(self, seq)
+        except Exception as e:
+            print(f"[{self.session_id}] Error in process_frames: {e}")
+            self.error = str(e)
+        finally:
+            # Giải phóng tài nguyên
+            self.cap.release()
+            inference_session.close()
+            self.active = False
+            self.events.publish('stopped')  # Đóng các luồng sự kiện đang mở
+            print(f"[{self.session_id}] Đã dừng xử lý khung hình")
+
+
+class SessionManager:
+    # Nhiều phòng học chạy song song trong một tiến trình. Mỗi phiên có khóa session_id
+    # (và timetable_id nếu có), dùng chung face_app / InferenceService / gallery.
+    def __init__(self, face_app, inference_service, gallery_holder, get_student_list,
+                 threshold=0.5, max_sessions=48, cameras=None):
+        self.face_app = face_app
+        self.inference_service = inference_service
+        self.gallery_holder = gallery_holder
+        self.get_student_list = get_student_list
+        self.threshold = threshold
+        self.max_sessions = max_sessions
+        self.cameras = cameras if cameras is not None else load_cameras()
+        self._sessions = {}
+        self._starting = {}  # session_id -> timetable_id của phiên đang mở camera (đã giữ chỗ)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def resolve_camera(self, camera=None):
+        # Mã camera client gửi -> nguồn đã cấu hình; ValueError nếu mã không có trong danh sách
+        camera_id = 'default' if camera is None or camera == "" else str(camera).strip()
+        if camera_id not in self.cameras:
+            raise ValueError(f"Camera không được cấu hình: {camera_id}")
+        return self.cameras[camera_id]
+
+    def start(self, class_id, timetable_id=None, camera=None, foreign_fallback=False, session_id=None):
+        # Phiên của cùng một buổi học (timetable_id) đang chạy thì trả về phiên đó
+        source = self.resolve_camera(camera)
+        student_list = self.get_student_list(class_id)
+        with self._lock:
+            existing = self._sessions.get(session_id) if session_id is not None else self._find(timetable_id)
+            if existing is not None and existing.active:
+                print(f"[{existing.session_id}] Luồng xử lý đã chạy")
+                return existing
+            if session_id in self._starting or (timetable_id is not None and timetable_id in self._starting.values()):
+                raise RuntimeError("Phiên đang được khởi động")
+            active = sum(1 for s in self._sessions.values() if s.active) + len(self._starting)
+            if active >= self.max_sessions:
+                raise RuntimeError(f"Đã đạt số phiên tối đa ({self.max_sessions})")
+            if session_id is None:
+                session_id = existing.session_id if existing is not None else f"session-{next(self._ids)}"
+            self._starting[session_id] = timetable_id  # Giữ chỗ, mở camera bên ngoài khóa
+        session = CameraSession(self, session_id, class_id, timetable_id, source, foreign_fallback, student_list)
+        try:
+            # Mở RTSP có thể mất hàng chục giây: không giữ _lock để get/stop/list của các phòng khác không bị chặn
+            session.start()
+        finally:
+            with self._lock:
+                del self._starting[session_id]
+                if session.active:
+                    self._sessions[session_id] = session
+        return session
+
+    def _find(self, timetable_id):
+        if timetable_id is None:
+            return None
+        for session in self._sessions.values():
+            if session.timetable_id == timetable_id:
+                return session
+        return None
+
+    def get(self, session_id=None):
+        # Không có session_id: dùng phiên duy nhất đang có (tương thích client một phòng)
+        with self._lock:
+            if session_id is not None:
+                return self._sessions.get(session_id)
+            if len(self._sessions) == 1:
+                return next(iter(self._sessions.values()))
+            return None
+
+    def find_by_timetable(self, timetable_id):
+        with self._lock:
+            return self._find(timetable_id)
+
+    def stop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        session.stop()
+        return True
+
+    def stop_all(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.stop()
+
+    def is_active(self):
+        with self._lock:
+            return any(s.active for s in self._sessions.values())
+
+    def list_sessions(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return [s.stats() for s in sessions]
@@ -0,0 +1,125 @@
+import threading
+import time
+import cv2
+from jpeg_codec import encode_jpeg, get_codec
+
+JPEG_QUALITY = 80
+JPEG_SUBSAMPLING = '420'  # Lấy mẫu màu 4:2:0: nhỏ và nhanh hơn 4:4:4, đủ cho xem trực tiếp
+# Các bản stream người xem chọn qua /stream?rendition=...: chiều rộng (None = giữ nguyên) và fps tối đa
+RENDITIONS = {
+    'full': {'width': None, 'fps': None},
+    'low': {'width': 320, 'fps': 5},  # Màn hình phụ, mạng yếu
+}
+
+
+MULTIPART_HEADER = (b'--frame\r\n'
+                    b'Content-Type: image/jpeg\r\n\r\n')
+
+
+def multipart_chunk(jpeg_bytes):
+    return MULTIPART_HEADER + jpeg_bytes + b'\r\n'
+
+
+def chunk_jpeg(chunk):
+    # Bytes JPEG trong chunk multipart (cho người xem qua WebSocket), không sao chép
+    return memoryview(chunk)[len(MULTIPART_HEADER):-2]
+
+
+class Rendition:
+    # Một bản stream: khung hình nguồn được thu nhỏ / giảm fps rồi mã hóa đúng một lần,
+    # chunk multipart được giữ lại cho mọi người xem bản này
+    def __init__(self, name, width=None, fps=None):
+        self.name = name
+        self.width = width
+        self.interval = 1.0 / fps if fps else 0.0
+        self.lock = threading.Lock()
+        self.latest = (0, None)  # (seq khung hình nguồn, chunk), đọc không cần khóa
+        self.next_due = 0.0
+        self.viewers = 0
+        self.frames = 0
+        self.encode_time = 0.0
+        self.bytes = 0
+
+    def encode(self, handle, quality, subsampling):
+        start = time.perf_counter()
+        frame = handle.array
+        if self.width and frame.shape[1] > self.width:
+            height = round(frame.shape[0] * self.width / frame.shape[1])
+            frame = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        jpeg_bytes = encode_jpeg(frame, quality, subsampling)
+        chunk = multipart_chunk(jpeg_bytes)
+        self.latest = (handle.seq, chunk)
+        self.next_due = time.monotonic() + self.interval
+        self.frames += 1
+        self.encode_time += time.perf_counter() - start
+        self.bytes += len(jpeg_bytes)
+
+    def stats(self):
+        frames = self.frames
+        return {
+            'width': self.width,
+            'fps': round(1.0 / self.interval, 2) if self.interval else None,
+            'viewers': self.viewers,
+            'frames': frames,
+            'mean_encode_ms': round(self.encode_time * 1000 / frames, 2) if frames else 0.0,
+            'mean_bytes': round(self.bytes / frames) if frames else 0,
+        }
+
+
+class StreamEncoder:
+    # Tầng mã hóa MJPEG của một phiên: mỗi khung hình publish được mã hóa một lần cho mỗi bản
+    # stream đang có người xem (người xem đầu tiên cần khung hình mới sẽ mã hóa, những người còn lại
+    # nhận lại đúng bộ đệm đó), nên chi phí mã hóa không tăng theo số người xem.
+    # next_frame(after_seq, timeout) trả về handle (array, seq, release()) của khung hình mới hơn after_seq
+    def __init__(self, next_frame, quality=JPEG_QUALITY, subsampling=JPEG_SUBSAMPLING, renditions=None):
+        self.next_frame = next_frame
+        self.quality = quality
+        self.subsampling = subsampling
+        self.renditions = {name: Rendition(name, **options)
+                           for name, options in (renditions or RENDITIONS).items()}
+
+    def get(self, name=None):
+        return self.renditions.get(name or 'full')
+
+    def next_chunk(self, rendition, after_seq=0, timeout=0.5):
+        # Trả về (seq, chunk) mới hơn after_seq, hoặc (after_seq, None) khi chưa có khung hình mới
+        seq, chunk = rendition.latest
+        if seq > after_seq:
+            return seq, chunk  # Đã có người mã hóa khung hình mới hơn
+        delay = rendition.next_due - time.monotonic()
+        if delay > 0:
+            # Bản giảm fps: chờ tới lượt kế tiếp thay vì mã hóa mọi khung hình
+            time.sleep(min(delay, timeout))
+            if delay > timeout:
+                return after_seq, None
+        handle = self.next_frame(max(after_seq, seq), timeout)
+        if handle is None:
+            return after_seq, None
+        try:
+            with rendition.lock:
+                if rendition.latest[0] < handle.seq:
+                    rendition.encode(handle, self.quality, self.subsampling)
+                return rendition.latest
+        finally:
+            handle.release()
+
+    def frames(self, name=None, active=None, timeout=0.5):
+        # Generator chunk multipart cho một người xem; active() trả về False thì dừng
+        rendition = self.get(name)
+        with rendition.lock:
+            rendition.viewers += 1
+        try:
+            seq = 0  # Khung hình cuối cùng người xem này đã nhận
+            while True:
+                seq, chunk = self.next_chunk(rendition, seq, timeout)
+                if chunk is not None:
+                    yield chunk
+                elif active is not None and not active():
+                    break  # Nguồn đã dừng, đóng kết nối của người xem
+        finally:
+            with rendition.lock:
+                rendition.viewers -= 1
+
+    def stats(self):
+        return {'codec': get_codec().name, 'quality': self.quality, 'subsampling': self.subsampling,
+                'renditions': {name: r.stats() for name, r in self.renditions.items()}}
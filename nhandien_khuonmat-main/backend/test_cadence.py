@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+import numpy as np
+from cadence import AdaptiveCadence
+
+
+def static_tracker():
+    return SimpleNamespace(low_power=False, tracks=[])
+
+
+def run(cadence, frames):
+    tracker = static_tracker()
+    return [cadence.should_detect(frame, tracker) for frame in frames]
+
+
+def test_static_scene_backs_off_to_max_interval():
+    cadence = AdaptiveCadence(max_interval=8, motion_threshold=3.0)
+    frame = np.full((48, 64, 3), 100, np.uint8)
+    detections = run(cadence, [frame] * 40)
+    assert detections[0]  # Khung hình đầu tiên luôn chạy detector
+    assert cadence.interval == 8
+    assert sum(detections[-16:]) <= 2
+
+
+def test_slow_motion_accumulates_across_skipped_frames():
+    # Sai khác giữa hai khung hình liền nhau (1 mức xám) luôn dưới ngưỡng, nhưng so với khung hình
+    # chạy detector gần nhất thì vượt ngưỡng sau vài khung hình: detector không bị kẹt ở max_interval
+    cadence = AdaptiveCadence(max_interval=30, motion_threshold=3.0)
+    still = np.full((48, 64, 3), 50, np.uint8)
+    run(cadence, [still] * 40)
+    assert cadence.interval == 30
+    frames = [np.full((48, 64, 3), 50 + i, np.uint8) for i in range(1, 60)]
+    detections = run(cadence, frames)
+    assert sum(detections) >= 10
+    assert cadence.interval <= 4
@@ -0,0 +1,82 @@
+import pickle
+import numpy as np
+import pytest
+from embedding_store import EmbeddingStore, load_embeddings, migrate_if_needed, write_store
+from gallery import FaceGallery
+
+
+def sample_embeddings(seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "2021001": [rng.normal(size=512).astype(np.float32) for _ in range(3)],
+        "Nguyễn Văn A": [rng.normal(size=512).astype(np.float32)],
+        "trống": [],  # Người không có embedding nào không được ghi ra file
+    }
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_round_trip(tmp_path, mmap):
+    embeddings = sample_embeddings()
+    path = str(tmp_path / "face_embeddings.emb")
+    write_store(path, embeddings)
+    store = EmbeddingStore(path, mmap=mmap)
+    assert list(store) == ["2021001", "Nguyễn Văn A"]
+    assert "trống" not in store and len(store) == 2
+    for name in store:
+        assert np.array_equal(np.asarray(store[name]), np.stack(embeddings[name]))
+    assert store.labels.tolist() == [0, 0, 0, 1]
+    assert store.matrix.shape == (4, 512)
+
+
+def test_float16_store(tmp_path):
+    embeddings = sample_embeddings()
+    path = str(tmp_path / "face_embeddings.emb")
+    write_store(path, embeddings, dtype=np.float16)
+    store = EmbeddingStore(path)
+    assert store.matrix.dtype == np.float16
+    assert np.allclose(store["2021001"], np.stack(embeddings["2021001"]), atol=1e-2)
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / "face_embeddings.emb")
+    write_store(path, {})
+    store = EmbeddingStore(path)
+    assert len(store) == 0 and store.matrix.shape == (0, 512)
+    assert len(FaceGallery.from_file(path)) == 0
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "khac.emb"
+    path.write_bytes(b"\x00" * 256)
+    with pytest.raises(ValueError):
+        EmbeddingStore(str(path))
+
+
+def test_migrates_legacy_pickle(tmp_path):
+    embeddings = sample_embeddings()
+    pkl_path = str(tmp_path / "face_embeddings.pkl")
+    store_path = str(tmp_path / "face_embeddings.emb")
+    with open(pkl_path, "wb") as f:
+        pickle.dump(embeddings, f)
+    assert load_embeddings(pkl_path).keys() == embeddings.keys()
+    migrate_if_needed(pkl_path, store_path)
+    store = load_embeddings(store_path)
+    assert isinstance(store, EmbeddingStore)
+    assert np.array_equal(np.asarray(store["Nguyễn Văn A"]), np.stack(embeddings["Nguyễn Văn A"]))
+    # Đã có file .emb thì không ghi đè
+    with open(pkl_path, "wb") as f:
+        pickle.dump({}, f)
+    migrate_if_needed(pkl_path, store_path)
+    assert len(load_embeddings(store_path)) == 2
+
+
+def test_gallery_from_store_matches_gallery_from_dict(tmp_path):
+    embeddings = sample_embeddings()
+    path = str(tmp_path / "face_embeddings.emb")
+    write_store(path, embeddings)
+    query = np.stack([embeddings["2021001"][1], embeddings["Nguyễn Văn A"][0]])
+    query /= np.linalg.norm(query, axis=1, keepdims=True)
+    from_store = FaceGallery.from_file(path)
+    from_dict = FaceGallery({name: embs for name, embs in embeddings.items() if embs})
+    assert [name for name, _ in from_store.match(query, 0.0)] == ["2021001", "Nguyễn Văn A"]
+    assert from_store.match(query, 0.0) == from_dict.match(query, 0.0)
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip('onnxruntime')
+pytest.importorskip('insightface')
+import face_register
+from embedding_store import load_embeddings
+from enroller import Enroller
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    # Ảnh giả (nội dung là văn bản); embed_image được thay bằng embedding ngẫu nhiên và đếm số lần gọi
+    root = tmp_path / "dataset"
+    for person, count in (("2021001", 3), ("2021002", 2)):
+        (root / person).mkdir(parents=True)
+        for i in range(count):
+            (root / person / f"{i}.jpg").write_text(f"{person}-{i}")
+    calls = []
+    rng = np.random.default_rng(0)
+
+    def embed_image(app, img_path):
+        calls.append(os.path.relpath(img_path, root))
+        emb = rng.normal(size=512).astype(np.float32)
+        return emb / np.linalg.norm(emb)
+
+    monkeypatch.setattr(face_register, "embed_image", embed_image)
+    monkeypatch.setattr(face_register, "create_face_app", lambda: pytest.fail("không được nạp model"))
+    paths = dict(root=str(root), output_path=str(tmp_path / "g.emb"),
+                 manifest_file=str(tmp_path / "m.pkl"), settings_file=str(tmp_path / "s.json"))
+    return root, calls, paths
+
+
+def test_incremental_enrollment_through_manifest(dataset):
+    root, calls, paths = dataset
+    stats = face_register.register_dataset(object(), **paths)
+    assert len(stats["added"]) == 5 and len(calls) == 5
+    assert {name: len(embs) for name, embs in load_embeddings(paths["output_path"]).items()} == \
+        {"2021001": 3, "2021002": 2}
+
+    # Không có gì thay đổi: không tính embedding, không nạp model, không ghi lại file embeddings
+    mtime = os.stat(paths["output_path"]).st_mtime_ns
+    stats = face_register.register_dataset(None, **paths)
+    assert stats["unchanged"] == 5 and len(calls) == 5
+    assert os.stat(paths["output_path"]).st_mtime_ns == mtime
+
+    # Thêm một ảnh, sửa một ảnh, xóa một ảnh: chỉ hai ảnh được tính lại
+    (root / "2021002" / "2.jpg").write_text("mới")
+    (root / "2021001" / "0.jpg").write_text("đã sửa nội dung")
+    (root / "2021001" / "1.jpg").unlink()
+    stats = face_register.register_dataset(object(), **paths)
+    assert stats["added"] == ["2021002/2.jpg"]
+    assert stats["updated"] == ["2021001/0.jpg"]
+    assert stats["removed"] == ["2021001/1.jpg"]
+    assert len(calls) == 7
+    assert {name: len(embs) for name, embs in load_embeddings(paths["output_path"]).items()} == \
+        {"2021001": 2, "2021002": 3}
+
+
+def test_compaction_settings_kept_for_later_syncs(dataset):
+    root, calls, paths = dataset
+    face_register.register_dataset(object(), compact={"method": "mean", "max_prototypes": 1}, **paths)
+    (root / "2021002" / "2.jpg").write_text("mới")
+    # Lần đồng bộ sau (Enroller không truyền compact) vẫn thu gọn
+    face_register.register_dataset(object(), **paths)
+    assert {name: len(embs) for name, embs in load_embeddings(paths["output_path"]).items()} == \
+        {"2021001": 1, "2021002": 1}
+    face_register.register_dataset(None, compact=False, **paths)
+    assert {name: len(embs) for name, embs in load_embeddings(paths["output_path"]).items()} == \
+        {"2021001": 3, "2021002": 3}
+
+
+def wait_done(enroller, job_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while enroller.status(job_id)["status"] not in ("done", "error"):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return enroller.status(job_id)
+
+
+def test_enroller_coalesces_jobs_and_reloads_on_change(monkeypatch):
+    release = threading.Event()
+    results = [{"added": ["a/0.jpg"], "updated": [], "removed": [], "unchanged": 0},
+               {"added": [], "updated": [], "removed": [], "unchanged": 1}]
+
+    def register_dataset(app, compact=None):
+        release.wait(5)
+        return results.pop(0)
+
+    monkeypatch.setattr(face_register, "register_dataset", register_dataset)
+    updates = []
+    enroller = Enroller(object(), on_update=lambda: updates.append(1))
+    try:
+        first = enroller.submit("a")
+        while enroller.status(first)["status"] == "queued":
+            time.sleep(0.01)
+        # Job đầu đang chạy: các yêu cầu sau gộp vào một job chờ
+        second = enroller.submit("b")
+        assert enroller.submit("c") == second and enroller.submit("b") == second
+        assert enroller.status(second)["students"] == ["b", "c"]
+        release.set()
+        assert wait_done(enroller, first)["result"]["added"] == 1
+        assert wait_done(enroller, second)["result"]["unchanged"] == 1
+        assert updates == [1]  # Chỉ nạp lại gallery khi dataset thực sự thay đổi
+    finally:
+        enroller.shutdown()
+
+
+def test_enroller_reports_errors(monkeypatch):
+    def register_dataset(app, compact=None):
+        raise OSError("hết dung lượng")
+
+    monkeypatch.setattr(face_register, "register_dataset", register_dataset)
+    enroller = Enroller(object())
+    try:
+        status = wait_done(enroller, enroller.submit("a"))
+        assert status["status"] == "error" and "hết dung lượng" in status["error"]
+    finally:
+        enroller.shutdown()
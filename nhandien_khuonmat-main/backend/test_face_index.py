@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+import face_index
+from face_index import FlatIndex, IVFIndex, make_index
+
+DIM = 64
+
+
+def normalize(x):
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+
+def synthetic_gallery(people=200, per_person=5, seed=0):
+    # Embeddings theo cụm (mỗi người một tâm) và truy vấn là ảnh mới của một số người
+    rng = np.random.default_rng(seed)
+    centers = normalize(rng.normal(size=(people, DIM)).astype(np.float32))
+    vectors = normalize(np.repeat(centers, per_person, axis=0)
+                        + 0.05 * rng.normal(size=(people * per_person, DIM)).astype(np.float32))
+    n = min(people, 100)
+    queries = normalize(centers[:n] + 0.05 * rng.normal(size=(n, DIM)).astype(np.float32))
+    return np.arange(vectors.shape[0], dtype=np.int64), vectors.astype(np.float32), queries.astype(np.float32)
+
+
+def build(kind, ids, vectors, **params):
+    index = make_index(kind, dim=DIM, **params)
+    index.add(ids, vectors)
+    return index
+
+
+def test_flat_search_is_exact():
+    ids, vectors, queries = synthetic_gallery()
+    index = build("flat", ids, vectors)
+    scores, found = index.search(queries, 5)
+    expected = np.argsort(-(queries @ vectors.T), axis=1)[:, :5]
+    assert np.array_equal(found, ids[expected])
+    assert np.allclose(scores[:, 0], (queries @ vectors.T).max(axis=1), atol=1e-5)
+
+
+def test_flat_pads_and_removes():
+    index = FlatIndex(DIM)
+    scores, found = index.search(np.ones(DIM, np.float32), 3)
+    assert found.tolist() == [[-1, -1, -1]] and np.isneginf(scores).all()
+    _, vectors, _ = synthetic_gallery(people=2, per_person=1)
+    index.add([10, 11], vectors)
+    index.remove([10])
+    assert len(index) == 1
+    scores, found = index.search(vectors[0], 2)
+    assert found.tolist() == [[11, -1]]
+
+
+@pytest.mark.parametrize("kind, params, min_top1", [
+    ("flat_fp16", {}, 1.0),
+    ("flat_int8", {}, 0.99),
+    ("flat_int8", {"rerank": 0}, 0.95),
+    ("ivf", {"nlist": 16, "nprobe": 4, "train_size": 200}, 0.9),
+    ("hnsw", {"ef": 64}, 0.95),
+])
+def test_index_top1_matches_flat_baseline(kind, params, min_top1):
+    if kind == "hnsw" and face_index.hnswlib is None:
+        pytest.skip("chưa cài hnswlib")
+    ids, vectors, queries = synthetic_gallery()
+    baseline = build("flat", ids, vectors).search(queries, 10)[1]
+    index = build(kind, ids, vectors, **params)
+    assert len(index) == len(ids)
+    found = index.search(queries, 10)[1]
+    top1 = np.mean(found[:, 0] == baseline[:, 0])
+    recall = np.mean([len(set(f) & set(b)) / 10 for f, b in zip(found, baseline)])
+    assert top1 >= min_top1
+    assert recall >= min_top1 - 0.1
+
+
+def test_ivf_exact_until_trained_then_removes():
+    ids, vectors, queries = synthetic_gallery()
+    index = IVFIndex(DIM, nlist=16, nprobe=16, train_size=len(ids) + 1)
+    index.add(ids, vectors)
+    assert not index.is_trained  # Chưa đủ dữ liệu để train: tìm kiếm chính xác
+    assert np.array_equal(index.search(queries, 1)[1], build("flat", ids, vectors).search(queries, 1)[1])
+    index.add([len(ids)], queries[:1])
+    assert index.is_trained and len(index) == len(ids) + 1
+    index.remove(ids[:5])
+    assert len(index) == len(ids) - 4
+    assert not np.isin(index.search(queries, 10)[1], ids[:5]).any()
+
+
+def test_make_index_rejects_unknown_kind():
+    with pytest.raises(ValueError):
+        make_index("lsh", dim=DIM)
@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+import numpy as np
+from face_tracker import FaceTracker, iou_matrix, track_and_recognize
+
+
+def face(x, y, size=100):
+    return SimpleNamespace(bbox=np.array([x, y, x + size, y + size], np.float32))
+
+
+class ScriptedClient:
+    # Thay InferenceSession: detect trả về khuôn mặt đã định sẵn, embed_faces đếm số khuôn mặt được tính
+    def __init__(self):
+        self.faces = []
+        self.embedded = 0
+
+    def detect(self, frame):
+        return [SimpleNamespace(bbox=f.bbox.copy()) for f in self.faces]
+
+    def embed_faces(self, frame, faces):
+        self.embedded += len(faces)
+        return [np.zeros(512, np.float32) for _ in faces]
+
+
+def step(tracker, client, names):
+    # names: hàm trả về (tên, điểm) cho từng khuôn mặt được gửi tới match_fn
+    def match_fn(faces):
+        return [names(f) for f in faces]
+    return track_and_recognize(tracker, None, None, match_fn, client)
+
+
+def test_iou_matrix():
+    ious = iou_matrix([[0, 0, 10, 10]], [[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30]])
+    assert np.allclose(ious, [[1.0, 1 / 3, 0.0]])
+
+
+def test_ids_stable_and_confirmed_tracks_not_reembedded():
+    tracker = FaceTracker(confirm_hits=2, min_confidence=0.9)
+    client = ScriptedClient()
+    client.faces = [face(0, 0), face(300, 0)]
+    names = lambda f: ("A", 0.8) if f.bbox[0] < 200 else ("B", 0.7)
+    tracks = step(tracker, client, names)
+    ids = {t.name: t.track_id for t in tracks}
+    assert ids.keys() == {"A", "B"} and client.embedded == 2
+    # Độ tin cậy dưới min_confidence: nhận diện lại ở lần phát hiện sau, khớp cùng tên lần thứ hai -> xác nhận
+    client.faces = [face(5, 0), face(305, 0)]
+    tracks = step(tracker, client, names)
+    assert {t.name: t.track_id for t in tracks} == ids
+    assert all(t.confirmed for t in tracks) and client.embedded == 4
+    embedded = client.embedded
+    for dx in range(10, 200, 5):
+        client.faces = [face(dx, 0), face(300 + dx, 0)]
+        step(tracker, client, names)
+    assert client.embedded == embedded  # Track đã xác nhận không bao giờ tính embedding lại
+
+
+def test_confidence_decay_triggers_recognition():
+    tracker = FaceTracker(confirm_hits=3, min_confidence=0.45, decay=0.8)
+    client = ScriptedClient()
+    client.faces = [face(0, 0)]
+    step(tracker, client, lambda f: ("A", 0.5))
+    assert client.embedded == 1
+    step(tracker, client, lambda f: ("A", 0.5))
+    assert client.embedded == 2  # 0.5 * 0.8 < 0.45: nhận diện lại
+    assert tracker.tracks[0].streak == 2 and not tracker.tracks[0].confirmed
+    step(tracker, client, lambda f: ("A", 0.5))
+    assert tracker.tracks[0].confirmed
+
+
+def test_unknown_retried_after_retry_interval():
+    tracker = FaceTracker(retry_interval=5)
+    client = ScriptedClient()
+    client.faces = [face(0, 0)]
+    for _ in range(5):
+        step(tracker, client, lambda f: ("Unknown", 0.2))
+    assert client.embedded == 1
+    step(tracker, client, lambda f: ("Unknown", 0.2))
+    assert client.embedded == 2
+
+
+def test_predict_and_drop_after_misses():
+    tracker = FaceTracker(max_misses=2)
+    client = ScriptedClient()
+    client.faces = [face(0, 0)]
+    step(tracker, client, lambda f: ("A", 0.9))
+    client.faces = [face(10, 0)]
+    step(tracker, client, lambda f: ("A", 0.9))
+    track = tracker.tracks[0]
+    predicted = tracker.predict()[0]
+    assert predicted is track and predicted.bbox[0] > 10  # bbox đi tiếp theo vận tốc
+    client.faces = []
+    for _ in range(2):
+        step(tracker, client, lambda f: ("A", 0.9))
+        assert tracker.tracks == [track] and not tracker.visible_tracks()
+    step(tracker, client, lambda f: ("A", 0.9))
+    assert tracker.tracks == []
+
+
+def test_resolved_students_confirmed_immediately_and_low_power():
+    tracker = FaceTracker(confirm_hits=3)
+    client = ScriptedClient()
+    client.faces = [face(0, 0)]
+    step(tracker, client, lambda f: ("A", 0.6))
+    tracker.resolve("A")
+    assert tracker.tracks[0].confirmed
+    # Track mới của sinh viên đã điểm danh: xác nhận ngay ở lần khớp đầu tiên
+    client.faces = [face(0, 0), face(400, 0)]
+    step(tracker, client, lambda f: ("A", 0.6))
+    assert all(t.confirmed for t in tracker.tracks)
+    tracker.low_power = True
+    client.faces = [face(0, 0), face(400, 0), face(800, 0)]
+    embedded = client.embedded
+    step(tracker, client, lambda f: ("B", 0.9))
+    assert client.embedded == embedded and len(tracker.tracks) == 3
@@ -0,0 +1,66 @@
+import queue
+import pytest
+from frame_ingest import HEADER, IngestClient, negotiate, pack_frame, unpack_frame
+
+
+def test_header_round_trip():
+    data = pack_frame(7, 1700000000.25, 640, 480, 'webp', b'\xff\xd8payload')
+    assert len(data) == HEADER.size + len(b'\xff\xd8payload')
+    seq, timestamp, width, height, fmt, payload = unpack_frame(data)
+    assert (seq, timestamp, width, height, fmt) == (7, 1700000000.25, 640, 480, 'webp')
+    assert bytes(payload) == b'\xff\xd8payload'
+
+
+def test_unpack_rejects_invalid_frames():
+    with pytest.raises(ValueError):
+        unpack_frame('không phải bytes')
+    with pytest.raises(ValueError):
+        unpack_frame(b'\x00' * HEADER.size)  # Chỉ có header, không có ảnh
+    with pytest.raises(ValueError):
+        unpack_frame(HEADER.pack(1, 0.0, 640, 480, 9) + b'x')  # Định dạng không hỗ trợ
+
+
+def test_negotiate_downscales_to_detector_size():
+    config = negotiate({'width': 1920, 'height': 1080, 'fps': 30, 'formats': ['jpeg', 'webp']})
+    assert (config['width'], config['height']) == (640, 360)
+    assert config['fps'] == 15.0
+    assert config['format'] == 'webp'
+    assert config['header'] == {'format': HEADER.format, 'size': HEADER.size, 'formats': {'jpeg': 0, 'webp': 1}}
+    # Nhỏ hơn max_side thì giữ nguyên, không phóng to
+    small = negotiate({'width': 320, 'height': 240, 'fps': 10})
+    assert (small['width'], small['height'], small['fps'], small['format']) == (320, 240, 10.0, 'jpeg')
+
+
+@pytest.mark.parametrize('offer', [
+    {},
+    {'width': 'abc', 'height': None, 'fps': 'nhanh'},
+    {'width': 0, 'height': -480, 'fps': 0},
+    {'width': float('nan'), 'height': float('inf'), 'fps': -5, 'formats': 'webp'},
+])
+def test_negotiate_falls_back_to_defaults(offer):
+    config = negotiate(offer)
+    assert (config['width'], config['height']) == (640, 480)
+    assert config['fps'] == 15.0
+    assert config['format'] == 'jpeg'
+
+
+def test_negotiate_rejects_non_object_offer():
+    with pytest.raises(ValueError):
+        negotiate('640x480')
+
+
+def test_credit_held_while_queue_full():
+    client = IngestClient('sid', negotiate({}))
+    assert client.take_credit() and client.take_credit()
+    assert not client.take_credit()  # Hết credit: client phải chờ
+    frames = queue.Queue(maxsize=1)
+    frames.put('khung khác')
+    client.park(1, 'f1')
+    client.park(2, 'f2')  # Thay khung hình đang giữ, credit của f1 vẫn bị giữ
+    with pytest.raises(queue.Full):
+        client.requeue(frames.put_nowait)
+    assert client.credits == 0
+    frames.get()
+    assert client.requeue(frames.put_nowait) == 1
+    assert frames.get() == ('sid', 2, 'f2')
+    assert client.requeue(frames.put_nowait) is None
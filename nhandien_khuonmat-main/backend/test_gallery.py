@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+import numpy as np
+from gallery import FaceGallery
+
+
+def make_embeddings(names, per_person=3, seed=0):
+    # Mỗi người một tâm ngẫu nhiên, các ảnh là tâm cộng nhiễu nhỏ (đã chuẩn hóa như normed_embedding)
+    rng = np.random.default_rng(seed)
+    embeddings = {}
+    centers = {}
+    for name in names:
+        center = rng.normal(size=512).astype(np.float32)
+        centers[name] = center / np.linalg.norm(center)
+        embs = centers[name] + 0.05 * rng.normal(size=(per_person, 512)).astype(np.float32)
+        embeddings[name] = list(embs / np.linalg.norm(embs, axis=1, keepdims=True))
+    return embeddings, centers
+
+
+def faces_of(*vectors):
+    return [SimpleNamespace(normed_embedding=v) for v in vectors]
+
+
+def test_match_faces_without_class_uses_whole_gallery():
+    # class_id None: get_student_list trả về [], vẫn phải nhận diện trên toàn trường
+    embeddings, centers = make_embeddings(["A", "B", "C"])
+    gallery = FaceGallery(embeddings)
+    results = gallery.match_faces(faces_of(centers["B"]), 0.5, None, [])
+    assert results[0][0] == "B"
+
+
+def test_match_faces_with_class_only_matches_class_students():
+    embeddings, centers = make_embeddings(["A", "B", "C"])
+    gallery = FaceGallery(embeddings)
+    faces = faces_of(centers["A"], centers["C"])
+    assert [name for name, _ in gallery.match_faces(faces, 0.5, "L1", ["A", "B"])] == ["A", "Unknown"]
+    # Sinh viên ngoài lớp chỉ được tra khi bật foreign_fallback
+    results = gallery.match_faces(faces, 0.5, "L1", ["A", "B"], foreign_fallback=True)
+    assert [name for name, _ in results] == ["A", "C"]
+
+
+def test_class_gallery_rebuilt_when_roster_changes():
+    embeddings, centers = make_embeddings(["A", "B", "C"])
+    gallery = FaceGallery(embeddings)
+    first = gallery.for_class("L1", ["A", "B"])
+    assert gallery.for_class("L1", ["B", "A"]) is first
+    assert gallery.match_faces(faces_of(centers["C"]), 0.5, "L1", ["A", "B"])[0][0] == "Unknown"
+    # Cùng class_id nhưng danh sách khác: không dùng lại gallery con cũ
+    assert gallery.match_faces(faces_of(centers["C"]), 0.5, "L1", ["A", "B", "C"])[0][0] == "C"
+
+
+def test_resolved_students_masked_from_candidates():
+    embeddings, centers = make_embeddings(["A", "B", "C"])
+    gallery = FaceGallery(embeddings)
+    roster = ["A", "B", "C"]
+    assert len(gallery.remaining_for_class("L1", roster, {"A"})) == 6  # Chỉ còn dòng của B và C
+    assert len(gallery.remaining_for_class("L1", roster, {"A", "B"})) == 3
+    faces = faces_of(centers["C"], centers["A"])
+    # A đã điểm danh quay lại (track mới): không khớp ai còn lại nên được tra lại cả lớp
+    results = gallery.match_faces(faces, 0.5, "L1", roster, resolved={"A", "B"})
+    assert [name for name, _ in results] == ["C", "A"]
+    results = gallery.match_faces(faces, 0.5, "L1", roster, resolved=set(roster))
+    assert [name for name, _ in results] == ["C", "A"]
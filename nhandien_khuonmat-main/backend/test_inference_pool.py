@@ -0,0 +1,44 @@
+import itertools
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('onnxruntime')
+pytest.importorskip('insightface')
+import inference_pool
+from inference_pool import InferencePool, PoolSession, PoolWorker
+
+
+def silent_pool(sent):
+    # InferencePool không có tiến trình worker: yêu cầu được ghi lại nhưng không bao giờ có kết quả
+    pool = InferencePool.__new__(InferencePool)
+    pool._lock = threading.Lock()
+    pool._pending = {}
+    pool._ids = itertools.count(1)
+    pool._closed = False
+    pool.send = lambda worker, message: sent.append(message)
+    return pool
+
+
+def test_timed_out_request_abandons_shared_buffer(monkeypatch):
+    monkeypatch.setattr(inference_pool, 'REQUEST_TIMEOUT', 0.05)
+    sent = []
+    worker = PoolWorker(0, [0])
+    session = PoolSession(silent_pool(sent), 's1', worker)
+    frame = np.zeros((48, 64, 3), np.uint8)
+
+    with pytest.raises(RuntimeError):
+        session.detect(frame)
+    req_id, kind, name, shape, _ = sent[0]
+    assert (kind, shape) == ('detect', frame.shape)
+    assert worker.pending == 0
+    # Worker có thể vẫn đang đọc vùng nhớ cũ: phiên bỏ vùng đó thay vì ghi đè tại chỗ
+    assert sent[1][1:3] == ('release', name)
+    assert session._shm is None
+
+    # embed sau detect thất bại không được dùng lại khung hình "đã chép": chép lại vào vùng nhớ mới
+    faces = [type('F', (), {'kps': np.zeros((5, 2), np.float32)})()]
+    with pytest.raises(RuntimeError):
+        session.embed_faces(frame, faces)
+    assert sent[2][1] == 'embed' and sent[2][2] != name
+    session._release_buffer()
@@ -0,0 +1,70 @@
+import struct
+import numpy as np
+import pytest
+import jpeg_codec
+from jpeg_codec import apply_orientation, jpeg_orientation
+
+
+def with_orientation(jpeg, orientation, byte_order='MM'):
+    # Chèn segment APP1 EXIF chỉ có thẻ Orientation ngay sau SOI
+    fmt = '>' if byte_order == 'MM' else '<'
+    tiff = byte_order.encode() + struct.pack(fmt + 'HI', 42, 8)
+    tiff += struct.pack(fmt + 'H', 1) + struct.pack(fmt + 'HHIHH', 0x0112, 3, 1, orientation, 0)
+    tiff += struct.pack(fmt + 'I', 0)
+    payload = b'Exif\x00\x00' + tiff
+    return jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload + jpeg[2:]
+
+
+# SOI + APP0 (JFIF) + SOF0 64x48: đủ cho các hàm chỉ đọc header
+HEADER_ONLY = (b'\xff\xd8' + b'\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+               + b'\xff\xc0\x00\x11\x08\x00\x30\x00\x40\x03' + b'\x01\x22\x00\x02\x11\x01\x03\x11\x01')
+
+
+@pytest.mark.parametrize('byte_order', ['MM', 'II'])
+def test_reads_exif_orientation(byte_order):
+    assert jpeg_orientation(HEADER_ONLY) == 1
+    for orientation in range(1, 9):
+        data = with_orientation(HEADER_ONLY, orientation, byte_order)
+        assert jpeg_orientation(data) == orientation
+        assert jpeg_codec.jpeg_size(data) == (64, 48)
+
+
+def test_apply_orientation_matches_exif_definition():
+    img = np.arange(6, dtype=np.uint8).reshape(2, 3)
+    # Ảnh hiển thị đúng là img; ảnh lưu trong file ứng với từng giá trị Orientation
+    stored = {
+        1: img,
+        2: img[:, ::-1],
+        3: img[::-1, ::-1],
+        4: img[::-1],
+        5: img.T,
+        6: np.rot90(img, 1),
+        7: img[::-1, ::-1].T,
+        8: np.rot90(img, -1),
+    }
+    for orientation, raw in stored.items():
+        fixed = apply_orientation(raw, orientation)
+        assert np.array_equal(fixed, img), orientation
+        assert fixed.flags['C_CONTIGUOUS']
+
+
+def test_turbojpeg_matches_opencv_orientation():
+    # Cùng một ảnh JPEG có EXIF xoay: hai codec phải trả về ảnh cùng hướng
+    pytest.importorskip('turbojpeg')
+    if not hasattr(jpeg_codec.cv2, 'imdecode'):
+        pytest.skip('cần OpenCV thật')
+    try:
+        turbo = jpeg_codec.TurboJPEGCodec()
+    except (OSError, RuntimeError):
+        pytest.skip('không nạp được libjpeg-turbo')
+    opencv = jpeg_codec.OpenCVCodec()
+    img = np.zeros((64, 96, 3), np.uint8)
+    img[:32, :48] = (255, 255, 255)  # Góc trên trái sáng để phân biệt hướng
+    base = opencv.encode(img, quality=95, subsampling='444')
+    for orientation in (1, 3, 6, 8):
+        data = with_orientation(base, orientation)
+        for scale in (1, 2):
+            a = turbo.decode(data, scale).astype(np.int16)
+            b = opencv.decode(data, scale).astype(np.int16)
+            assert a.shape == b.shape, (orientation, scale)
+            assert np.abs(a - b).mean() < 4, (orientation, scale)
@@ -0,0 +1,19 @@
+import numpy as np
+from frame_ring import LatestChannel
+from stream_encoder import MULTIPART_HEADER, StreamEncoder
+
+
+def test_encoder_pulls_chunk_from_latest_channel():
+    # fastapi_stream dựng StreamEncoder(stream_channel.latest): phải lấy được chunk khung hình mới nhất
+    channel = LatestChannel()
+    encoder = StreamEncoder(channel.latest)
+    rendition = encoder.get()
+    assert encoder.next_chunk(rendition, 0, timeout=0.01) == (0, None)
+
+    seq = channel.publish(np.zeros((48, 64, 3), np.uint8), 1.0)
+    got_seq, chunk = encoder.next_chunk(rendition, 0, timeout=0.5)
+    assert got_seq == seq
+    assert chunk.startswith(MULTIPART_HEADER) and chunk.endswith(b'\r\n')
+    # Người xem thứ hai nhận lại đúng bộ đệm đã mã hóa, không mã hóa lại
+    assert encoder.next_chunk(rendition, 0, timeout=0.5) == (got_seq, chunk)
+    assert rendition.frames == 1
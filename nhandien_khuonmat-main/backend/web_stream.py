@@ -1,13 +1,10 @@
 import sqlite3
 import os
 from datetime import datetime
-import cv2
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-import subprocess
-import sys
-import queue
+from recognition_events import iter_sse, parse_last_seq
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -15,14 +12,24 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 DATABASE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'dtb.db')
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 dataset_dir = os.path.abspath(os.path.join(BASE_DIR, '..', 'dataset'))
-embeddings_path = os.path.join(BASE_DIR, 'face_embeddings.pkl')
+embeddings_path = os.path.join(BASE_DIR, 'face_embeddings.emb')
 
 os.makedirs(dataset_dir, exist_ok=True)
 
 externals = {}
-def set_externals(frame_queue, recognized_faces):
-    externals['frame_queue'] = frame_queue
-    externals['recognized_faces'] = recognized_faces
+def set_externals(session_manager, enroller=None):
+    externals['session_manager'] = session_manager
+    if enroller is not None:
+        externals['enroller'] = enroller
+
+def resolve_session(session_id):
+    # Không truyền session_id thì dùng phiên duy nhất đang có (client một phòng học)
+    if 'session_manager' not in externals:
+        return None, (jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500)
+    session = externals['session_manager'].get(session_id)
+    if session is None:
+        return None, (jsonify({'status': 'error', 'message': 'Không tìm thấy phiên nhận diện'}), 404)
+    return session, None
 
 @app.route('/api/upload', methods=['POST'])
 def upload():
@@ -47,28 +54,40 @@ def upload():
         save_path = os.path.join(student_folder, filename)
         file.save(save_path)
 
-    face_register_path = os.path.join(BASE_DIR, 'face_register.py')
-    try:
-        venv_python = sys.executable
-        subprocess.run([venv_python, face_register_path], check=True)
-        message = f"Ảnh đã được lưu và dữ liệu khuôn mặt đã được cập nhật cho {student_name}."
-    except subprocess.CalledProcessError as e:
-        message = f"Ảnh đã được lưu nhưng lỗi khi cập nhật dữ liệu khuôn mặt: {str(e)}."
+    if 'enroller' not in externals:
+        return jsonify({'status': 'error', 'message': 'Enroller chưa được khởi tạo'}), 500
+
+    job_id = externals['enroller'].submit(student_name)
+    message = f"Ảnh đã được lưu, đang cập nhật dữ liệu khuôn mặt cho {student_name}."
 
-    return jsonify({'status': 'success', 'message': message}), 200
+    return jsonify({'status': 'success', 'message': message, 'job_id': job_id}), 200
+
+@app.route('/api/enroll_status/<job_id>', methods=['GET'])
+def enroll_status(job_id):
+    if 'enroller' not in externals:
+        return jsonify({'status': 'error', 'message': 'Enroller chưa được khởi tạo'}), 500
+    job = externals['enroller'].status(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Không tìm thấy công việc cập nhật'}), 404
+    return jsonify({'status': 'success', 'job': job}), 200
 
 @app.route('/api/recognize', methods=['POST'])
 def recognize():
-    if 'recognized_faces' not in externals:
-        return jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500
-    names = list(externals['recognized_faces'].keys())
-    return jsonify({'status': 'success', 'recognized': names}), 200
+    data = request.get_json(silent=True) or {}
+    session, error = resolve_session(data.get('session_id'))
+    if error:
+        return error
+    return jsonify({'status': 'success', 'session_id': session.session_id,
+                    'recognized': session.recognized_names()}), 200
 
 @app.route('/api/clear_recognized', methods=['POST'])
 def clear_recognized():
+    data = request.get_json(silent=True) or {}
+    session, error = resolve_session(data.get('session_id'))
+    if error:
+        return error
     try:
-        from opencv_with_queue import clear_recognized_faces
-        clear_recognized_faces()
+        session.clear_recognized()
         return jsonify({'status': 'success', 'message': 'Đã xóa danh sách khuôn mặt nhận diện'}), 200
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Lỗi khi xóa danh sách: {str(e)}'}), 500
@@ -77,51 +96,76 @@ def clear_recognized():
 def start_stream():
     data = request.get_json()
     class_id = data.get('class_id')
+    foreign_fallback = bool(data.get('foreign_fallback', False))
     if class_id is None:
         return jsonify({'status': 'error', 'message': 'Chưa cung cấp class_id'}), 400
+    if 'session_manager' not in externals:
+        return jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500
     try:
-        from opencv_with_queue import start_processing
-        start_processing(class_id)
-        return jsonify({'status': 'success', 'message': 'Bắt đầu luồng video'}), 200
+        # camera: mã camera trong cameras.json của server ('source' cũ cũng được hiểu là mã camera)
+        session = externals['session_manager'].start(class_id, data.get('timetable_id'),
+                                                     data.get('camera', data.get('source')),
+                                                     foreign_fallback, data.get('session_id'))
+        return jsonify({'status': 'success', 'message': 'Bắt đầu luồng video',
+                        'session_id': session.session_id}), 200
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Lỗi khi bắt đầu luồng: {str(e)}'}), 500
 
 @app.route('/api/stop_stream', methods=['POST'])
 def stop_stream():
+    data = request.get_json(silent=True) or {}
+    session, error = resolve_session(data.get('session_id'))
+    if error:
+        return error
     try:
-        from opencv_with_queue import stop_processing
-        stop_processing()
+        externals['session_manager'].stop(session.session_id)
         return jsonify({'status': 'success', 'message': 'Đã dừng luồng video'}), 200
     except Exception as e:
         return jsonify({'status': 'error', 'message': f'Lỗi khi dừng luồng: {str(e)}'}), 500
 
 @app.route('/api/stream_status', methods=['GET'])
 def stream_status():
+    if 'session_manager' not in externals:
+        return jsonify({'status': 'error', 'message': 'OpenCV chưa khởi tạo'}), 500
+    session_id = request.args.get('session_id')
+    if session_id is not None:
+        session, error = resolve_session(session_id)
+        if error:
+            return error
+        return jsonify({'status': 'success', 'is_streaming': session.active, 'session': session.stats()}), 200
+    manager = externals['session_manager']
+    return jsonify({'status': 'success', 'is_streaming': manager.is_active(),
+                    'sessions': manager.list_sessions()}), 200
+
+def gen_frames(session, rendition):
+    # Mỗi người xem chỉ nhận chunk đã mã hóa sẵn của bản stream mình chọn, không tự mã hóa
     try:
-        from opencv_with_queue import processing_active
-        return jsonify({'status': 'success', 'is_streaming': processing_active}), 200
+        yield from session.encoder.frames(rendition, lambda: session.active)
     except Exception as e:
-        return jsonify({'status': 'error', 'message': f'Lỗi khi kiểm tra trạng thái: {str(e)}'}), 500
-
-def gen_frames():
-    if 'frame_queue' not in externals:
-        raise RuntimeError("frame_queue chưa được khởi tạo!")
-    while True:
-        try:
-            frame = externals['frame_queue'].get(timeout=0.1)
-            ret, buffer = cv2.imencode('.jpg', frame)
-            frame_bytes = buffer.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        except queue.Empty:
-            continue
-        except Exception as e:
-            print(f"Error in gen_frames: {e}")
-            break
+        print(f"Error in gen_frames: {e}")
 
 @app.route('/stream')
 def stream():
-    return Response(gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    session, error = resolve_session(request.args.get('session_id'))
+    if error:
+        return error
+    rendition = request.args.get('rendition', 'full')
+    if session.encoder.get(rendition) is None:
+        return jsonify({'status': 'error', 'message': f'Không có bản stream {rendition}'}), 400
+    return Response(gen_frames(session, rendition), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+# Sự kiện điểm danh (SSE) thay cho hỏi /api/recognize định kỳ: /api/recognition_events?session_id=...
+# Kết nối lại tự gửi Last-Event-ID (hoặc ?since=<seq>) để nhận tiếp từ sự kiện cuối cùng
+@app.route('/api/recognition_events')
+def recognition_events():
+    session, error = resolve_session(request.args.get('session_id'))
+    if error:
+        return error
+    last_seq = parse_last_seq(request.headers.get('Last-Event-ID', request.args.get('since')))
+    return Response(iter_sse(session.events, session.snapshot_event, lambda: session.active, last_seq),
+                    mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 def get_db_connection():
     conn = sqlite3.connect(DATABASE)
@@ -223,6 +267,7 @@ def save_attendance():
         return jsonify({'status': 'error', 'message': f'Lỗi khi lưu điểm danh: {str(e)}'}), 500
 
 if __name__ == '__main__':
-    from opencv_with_queue import frame_queue, recognized_faces
-    set_externals(frame_queue, recognized_faces)
+    from opencv_with_queue import session_manager, face_app, gallery_holder
+    from enroller import Enroller
+    set_externals(session_manager, Enroller(face_app, on_update=gallery_holder.reload))
     app.run(debug=False, threaded=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -1,38 +1,45 @@
 import cv2
-import pickle
-import numpy as np
-from insightface.app import FaceAnalysis
-import onnxruntime as ort
 from datetime import datetime
 import sqlite3
 import os
-import queue
 import threading
 import time
+import sys
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), 'backend'))
+from gallery import GALLERY_INDEX, GalleryHolder
+from face_tracker import FaceTracker, track_and_recognize
+from cadence import AdaptiveCadence
+from model_loader import load_face_app
+from inference_service import InferenceService
+from frame_ring import read_frame
+from embedding_store import migrate_if_needed
 
-# In ra các provider khả dụng
-print("Available providers:", ort.get_available_providers())
 
 # Đường dẫn
 DATABASE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'dtb.db')
-embeddings_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'face_embeddings.pkl')
+embeddings_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'face_embeddings.emb')
+legacy_embeddings_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'face_embeddings.pkl')
 
 # Kiểm tra file cơ sở dữ liệu và embeddings
 if not os.path.exists(DATABASE):
     raise FileNotFoundError(f"Cơ sở dữ liệu {DATABASE} không tồn tại!")
+# Chuyển face_embeddings.pkl cũ sang file memmap .emb nếu chưa có
+migrate_if_needed(legacy_embeddings_path, embeddings_path)
 if not os.path.exists(embeddings_path):
-    raise FileNotFoundError("face_embeddings.pkl không tồn tại!")
+    raise FileNotFoundError("face_embeddings.emb không tồn tại!")
 
-# Load embeddings
-with open(embeddings_path, "rb") as f:
-    embeddings = pickle.load(f)
+# Load embeddings và gom thành ma trận để so khớp theo lô,
+# tự nạp lại khi file thay đổi (đăng ký sinh viên mới không cần khởi động lại)
+gallery_holder = GalleryHolder(embeddings_path, index=GALLERY_INDEX).start_watching()
 
 # Khởi tạo model nhận diện
-face_app = FaceAnalysis(name="buffalo_l", providers=['CUDAExecutionProvider'])
-face_app.prepare(ctx_id=0, det_size=(320, 320), det_thresh=0.7)  # Giảm det_size để tăng FPS
+face_app = load_face_app(det_size=(320, 320), det_thresh=0.7)  # Giảm det_size để tăng FPS
+# Một bản model phục vụ mọi phiên: gom lô, chia lượt công bằng giữa các lớp học
+inference_service = InferenceService(face_app)
 
-# Tạo hàng đợi và biến trạng thái
-frame_queue = queue.Queue(maxsize=10)  # Giảm maxsize để tiết kiệm bộ nhớ
+# Vòng đệm khung hình cấp phát sẵn và biến trạng thái
+frame_ring = None  # FrameRing, tạo khi biết kích thước khung hình đầu tiên
 recognized_faces = {}
 recognized_faces_lock = threading.Lock()  # Khóa để bảo vệ truy cập đồng thời
 processing_active = False
@@ -62,9 +69,10 @@ def get_student_list(class_id):
         print(f"Database error: {e}")
         return []
 
-def process_frames(class_id=None):
-    global frame_count, fps, start_time_fps, cap, processing_active
+def process_frames(class_id=None, foreign_fallback=False):
+    global frame_count, fps, start_time_fps, cap, processing_active, frame_ring
     student_list = get_student_list(class_id)
+    student_set = set(student_list)  # Tra cứu O(1) trong vòng lặp
 
     # Khởi tạo webcam
     cap = cv2.VideoCapture(1)
@@ -79,14 +87,20 @@ def process_frames(class_id=None):
     start_time_fps = time.time()
     frame_count = 0
     fps = 0
-    faces = []  # Lưu kết quả nhận diện để tái sử dụng
+    tracker = FaceTracker()  # Track ID ổn định giữa các khung hình
+    cadence = AdaptiveCadence()  # Nhịp detector theo chuyển động và số track chưa xác nhận
+    inference_session = inference_service.session()
+    tracks = []
 
     while processing_active:
         try:
-            success, frame = cap.read()
+            success, handle, frame_ring = read_frame(cap, frame_ring)  # Đọc thẳng vào ô trống
             if not success:
                 print("Không thể đọc khung hình từ webcam!")
                 break
+            if handle is None:
+                continue
+            frame = handle.array
 
             frame_count += 1
             current_time = time.time()
@@ -96,44 +110,43 @@ def process_frames(class_id=None):
                 frame_count = 0
                 start_time_fps = current_time
 
-            # Chỉ nhận diện mỗi 5 khung hình
-            if frame_count % 5 == 0:
-                faces = face_app.get(frame)
-
-            for face in faces:
-                box = face.bbox.astype(int)
-                emb = face.normed_embedding
-                name = "Unknown"
-                max_sim = -1
-                for person_name, person_embs in embeddings.items():
-                    for saved_emb in person_embs:
-                        sim = np.dot(emb, saved_emb)
-                        if sim > max_sim:
-                            max_sim = sim
-                            name = person_name
-
-                if max_sim < threshold:
-                    name = "Unknown"
-
-                if name != "Unknown" and name not in recognized_faces and name in student_list:
+            if tracker.resolved and not recognized_faces:
+                # Danh sách điểm danh vừa bị xóa: nhận diện lại từ đầu
+                tracker.resolved.clear()
+                tracker.low_power = False
+            # Detector chạy theo nhịp thích ứng, ArcFace chỉ chạy cho track mới hoặc có độ tin cậy
+            # đã suy giảm; so khớp với sinh viên của lớp chưa điểm danh, rồi cả lớp (toàn trường chỉ khi
+            # bật foreign_fallback)
+            tracks = track_and_recognize(
+                tracker, face_app, frame,
+                lambda faces: gallery_holder.current.match_faces(
+                    faces, threshold, class_id, student_list, foreign_fallback,
+                    resolved=tracker.resolved),
+                inference_session, cadence)
+
+            for track in tracks:
+                name = track.name
+                box = track.bbox.astype(int)
+
+                if name != "Unknown" and name not in recognized_faces and name in student_set:
                     with recognized_faces_lock:
                         recognized_faces[name] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    tracker.resolve(name)
                     print(f"-> Ghi nhận: {name}")
+                    if student_set and student_set <= tracker.resolved:
+                        tracker.low_power = True  # Cả lớp đã có mặt: chỉ chạy detector
 
-                color = (0, 255, 0) if name == "Unknown" or name in student_list else (0, 0, 255)
+                color = (0, 255, 0) if name == "Unknown" or name in student_set else (0, 0, 255)
                 cv2.rectangle(frame, (box[0], box[1]), (box[2], box[3]), color, 2)
                 cv2.putText(frame, name, (box[0], box[1] - 10),
                             cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
 
             now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             cv2.putText(frame, now_str, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-            cv2.putText(frame, f"So nguoi: {len(faces)}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+            cv2.putText(frame, f"So nguoi: {len(tracks)}", (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
             cv2.putText(frame, f"FPS: {fps:.2f}", (10, 90), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
 
-            try:
-                frame_queue.put_nowait(frame)  # Không sao chép khung hình
-            except queue.Full:
-                pass  # Bỏ qua nếu hàng đợi đầy
+            frame_ring.publish(handle, current_time)  # Không sao chép, đầy thì bỏ khung hình cũ nhất
 
         except Exception as e:
             print(f"Error in process_frames: {e}")
@@ -143,14 +156,15 @@ def process_frames(class_id=None):
     if cap is not None:
         cap.release()
     cv2.destroyAllWindows()
+    inference_session.close()
     processing_active = False
     print("Đã dừng xử lý khung hình")
 
-def start_processing(class_id=None):
+def start_processing(class_id=None, foreign_fallback=False):
     global processing_active, processing_thread
     if not processing_active:
         processing_active = True
-        processing_thread = threading.Thread(target=process_frames, args=(class_id,), daemon=True)
+        processing_thread = threading.Thread(target=process_frames, args=(class_id, foreign_fallback), daemon=True)
         processing_thread.start()
         print("Bắt đầu xử lý khung hình")
     else: